@@ -4,8 +4,26 @@ from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterVectorLayer
 from qgis.core import QgsProcessingParameterNumber
 from qgis.core import QgsProcessingParameterFeatureSink
-import processing
-from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import QgsProcessingParameterString
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingOutputNumber
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingUtils
+from qgis.core import QgsCoordinateReferenceSystem
+from qgis.core import QgsCoordinateTransform
+from qgis.core import QgsGeometry
+from qgis.core import QgsProcessingParameterRasterLayer
+from qgis.core import QgsFeature, QgsFeatureSink, QgsField, QgsFields, QgsWkbTypes
+import numpy as np
+from qgis.PyQt.QtCore import QCoreApplication, QVariant
+
+from gwat.utils.idf import fit_idf, idf_table, idgw, parse_numbers, station_arrays
+from gwat.utils.pipeline import MEMORY_OUTPUT
+from gwat.utils.rasters import band_metadata, zonal_means
+from gwat.utils.tracing import run_child, traced
+
+# Outputs of the fitted IDF relation, by station parameter
+FIT_OUTPUTS = {"κ": "kappa", "λ΄": "lambda", "ψ΄": "psi", "θ": "theta", "η": "eta"}
 
 
 class IdfCurves(QgsProcessingAlgorithm):
@@ -46,18 +64,81 @@ class IdfCurves(QgsProcessingAlgorithm):
                 defaultValue=1,
             )
         )
+        self.addParameter(
+            QgsProcessingParameterString(
+                "ReturnPeriods",
+                "IDF table: return periods (T, in years, comma separated)",
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                "RainfallDurations",
+                "IDF table: rainfall durations (d, in hours, comma separated)",
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                "FitCurve",
+                "IDF table: fit the IDF relation (κ, λ΄, ψ΄, θ, η) of the basin",
+                defaultValue=False,
+            )
+        )
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 "NearestStationsWithIdgw",
-                "Nearest Stations with IDGW",
+                "Nearest Stations with IDGW (not written by a grid lookup)",
                 type=QgsProcessing.TypeVectorPoint,
+                optional=True,
                 createByDefault=True,
                 defaultValue=None,
             )
         )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                "IdfTable",
+                "IDF table (weighted intensity, mm/hr)",
+                type=QgsProcessing.TypeVector,
+                optional=True,
+                createByDefault=False,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterRasterLayer(
+                "IntensityGrid",
+                "Precomputed intensity grid (lookup instead of the station search)",
+                optional=True,
+            )
+        )
+        self.addOutput(QgsProcessingOutputNumber("Intensity", "Intensity (mm/hr)"))
+        for name in FIT_OUTPUTS.values():
+            self.addOutput(QgsProcessingOutputNumber(name, name))
 
+    @traced
     def processAlgorithm(self, parameters, context, feedback):
-        feedback = QgsProcessingMultiStepFeedback(2, feedback)
+        try:
+            return_periods = parse_numbers(
+                self.parameterAsString(parameters, "ReturnPeriods", context)
+            )
+            durations = parse_numbers(
+                self.parameterAsString(parameters, "RainfallDurations", context)
+            )
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        table = bool(return_periods or durations)
+        if table and not (return_periods and durations):
+            raise QgsProcessingException(
+                "The IDF table needs both return periods and rainfall durations"
+            )
+
+        grid = self.parameterAsRasterLayer(parameters, "IntensityGrid", context)
+        if grid is not None:
+            return self.grid_lookup(
+                parameters, context, feedback, grid, return_periods, durations
+            )
+
+        feedback = QgsProcessingMultiStepFeedback(3 if table else 2, feedback)
         results = {}
         outputs = {}
 
@@ -65,14 +146,13 @@ class IdfCurves(QgsProcessingAlgorithm):
         alg_params = {
             "Basin": parameters["Basin"],
             "Number_of_Stations": parameters["NumberofStations"],
-            "NearestStations": QgsProcessing.TEMPORARY_OUTPUT,
+            "NearestStations": MEMORY_OUTPUT,
         }
-        outputs["Idgw1LocateNearestMeteoStations"] = processing.run(
+        outputs["Idgw1LocateNearestMeteoStations"] = run_child(
             "gwat:nearby_meteo_stations",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
 
         feedback.setCurrentStep(1)
@@ -86,16 +166,142 @@ class IdfCurves(QgsProcessingAlgorithm):
             "ReturnPeriod": parameters["ReturnPeriodTinyears"],
             "OUTPUT": parameters["NearestStationsWithIdgw"],
         }
-        outputs["Idgw2InverseDistanceGageWeighting"] = processing.run(
+        outputs["Idgw2InverseDistanceGageWeighting"] = run_child(
             "gwat:inverse_dist_gage_weighting",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
         results["NearestStationsWithIdgw"] = outputs[
             "Idgw2InverseDistanceGageWeighting"
         ]["OUTPUT"]
+
+        # The basin intensity is the sum of the weighted station intensities
+        stations_layer = QgsProcessingUtils.mapLayerFromString(
+            outputs["Idgw1LocateNearestMeteoStations"]["NearestStations"], context
+        )
+        stations = station_arrays(stations_layer.getFeatures())
+        T = self.parameterAsInt(parameters, "ReturnPeriodTinyears", context)
+        d = self.parameterAsDouble(parameters, "RainfallDurationdinhours", context)
+        results["Intensity"] = float(idgw(stations, T, d)["weighted"].sum())
+        feedback.pushInfo(f"T={T:g}, d={d:g}h: {results['Intensity']:.2f} mm/hr")
+
+        if table:
+            feedback.setCurrentStep(2)
+            if feedback.isCanceled():
+                return {}
+            results.update(
+                self.idf_table(
+                    parameters,
+                    context,
+                    feedback,
+                    stations,
+                    return_periods,
+                    durations,
+                )
+            )
+        return results
+
+    def grid_lookup(
+        self, parameters, context, feedback, grid, return_periods, durations
+    ):
+        """
+        Basin-averaged intensities read from a grid of `gwat:idf_intensity_grid`, for the
+        return period and duration of the run and for the IDF table if requested. No
+        station is searched, so the Nearest Stations with IDGW output is not written.
+        """
+        basin = self.parameterAsVectorLayer(parameters, "Basin", context)
+        transform = QgsCoordinateTransform(
+            basin.crs(), grid.crs(), context.transformContext()
+        )
+        geometry = QgsGeometry.unaryUnion([f.geometry() for f in basin.getFeatures()])
+        geometry.transform(transform)
+        box = geometry.boundingBox()
+        means = zonal_means(
+            grid.source(),
+            bytes(geometry.asWkb()),
+            (box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum()),
+        )
+        bands = {
+            (float(meta["RETURN_PERIOD"]), float(meta["DURATION"])): means[band]
+            for band, meta in enumerate(band_metadata(grid.source()))
+            if "RETURN_PERIOD" in meta and "DURATION" in meta
+        }
+
+        def _lookup(T, d):
+            if (T, d) not in bands:
+                raise QgsProcessingException(
+                    f"The intensity grid has no band for T={T:g}, d={d:g}h"
+                )
+            return float(bands[(T, d)])
+
+        T = self.parameterAsDouble(parameters, "ReturnPeriodTinyears", context)
+        d = self.parameterAsDouble(parameters, "RainfallDurationdinhours", context)
+        results = {"Intensity": _lookup(T, d)}
+        feedback.pushInfo(f"T={T:g}, d={d:g}h: {results['Intensity']:.2f} mm/hr")
+
+        if return_periods:
+            intensity = np.array(
+                [[_lookup(T, d) for d in durations] for T in return_periods]
+            )
+            results.update(
+                self.write_idf_table(
+                    parameters, context, feedback, intensity, return_periods, durations
+                )
+            )
+        return results
+
+    def idf_table(
+        self, parameters, context, feedback, stations, return_periods, durations
+    ):
+        """
+        Weighted intensity for every return period and duration, and its fitted IDF
+        relation if requested.
+        """
+        intensity = idf_table(stations, return_periods, durations)
+        return self.write_idf_table(
+            parameters, context, feedback, intensity, return_periods, durations
+        )
+
+    def write_idf_table(
+        self, parameters, context, feedback, intensity, return_periods, durations
+    ):
+        """
+        Write an IDF table, and fit its IDF relation if requested.
+        """
+        results = {}
+
+        fields = QgsFields()
+        fields.append(QgsField("T (years)", QVariant.Double))
+        for d in durations:
+            fields.append(QgsField(f"i d={d:g}h (mm/hr)", QVariant.Double))
+        (sink, dest_id) = self.parameterAsSink(
+            parameters,
+            "IdfTable",
+            context,
+            fields,
+            QgsWkbTypes.NoGeometry,
+            QgsCoordinateReferenceSystem(),
+        )
+        for T, row in zip(return_periods, intensity.tolist()):
+            feedback.pushInfo(
+                f"T={T:g}: " + ", ".join(f"{i:.2f}" for i in row) + " mm/hr"
+            )
+            if sink is not None:
+                out_feat = QgsFeature(fields)
+                out_feat.setAttributes([T] + row)
+                sink.addFeature(out_feat, QgsFeatureSink.FastInsert)
+        if sink is not None:
+            results["IdfTable"] = dest_id
+
+        if self.parameterAsBool(parameters, "FitCurve", context):
+            try:
+                fit = fit_idf(return_periods, durations, intensity)
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
+            for parameter, name in FIT_OUTPUTS.items():
+                feedback.pushInfo(f"{parameter} = {fit[parameter]:.4f}")
+                results[name] = fit[parameter]
         return results
 
     def name(self):
@@ -118,7 +324,7 @@ class IdfCurves(QgsProcessingAlgorithm):
         Returns a localised short help string for the algorithm.
         """
         return self.tr(
-            "Using the dataset of the Greek Meteo stations network, this algorithm calculates the input parameters for IDF Curve creation,  for the stations nearest to the basin \n\n\n\n\nDeveloped by E. Lymperis\n2021, Geomeletitiki S.A."
+            "Using the dataset of the Greek Meteo stations network, this algorithm calculates the input parameters for IDF Curve creation,  for the stations nearest to the basin. The Intensity output is the sum of their IDGW-weighted intensities.\n\nWith a precomputed intensity grid, the intensities are averaged over the basin from the grid instead and the Nearest Stations with IDGW output is not written.\n\n\n\n\nDeveloped by E. Lymperis\n2021, Geomeletitiki S.A."
         )
 
     def tr(self, string):
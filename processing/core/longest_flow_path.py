@@ -4,20 +4,37 @@ from qgis.core import QgsProcessingAlgorithm
 from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterVectorLayer
 from qgis.core import QgsProcessingParameterField
+from qgis.core import QgsProcessingParameterRasterLayer
 from qgis.core import (
     QgsProcessingParameterFeatureSink,
     QgsProcessingFeatureSourceDefinition,
     QgsProcessingParameterEnum,
+    QgsProcessingException,
 )
+from qgis.core import (
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsField,
+    QgsGeometry,
+    QgsPointXY,
+    QgsVectorLayer,
+)
+from qgis.PyQt.QtCore import QVariant
 
 from PyQt5.QtCore import QCoreApplication
 
-try:
-    import processing
-except:
-    from qgis import processing
-
 from gwat.utils.files import get_plugin_output_dir, get_or_create_path
+from gwat.utils.networks import ChannelGraph, NetworkIndex
+from gwat.utils import hydrology
+from gwat.utils.pipeline import MEMORY_OUTPUT
+from gwat.utils.rasters import read_raster, cell_size, world_to_cell
+from gwat.utils.tracing import run_child, traced
+
+import numpy as np
+
+
+METHOD_EXACT = 3
+METHOD_FLOW_LENGTH = 4
 
 
 class LongestFlowPath(QgsProcessingAlgorithm):
@@ -51,6 +68,7 @@ class LongestFlowPath(QgsProcessingAlgorithm):
                 parentLayerParameterName="PourPoint",
                 allowMultiple=False,
                 defaultValue="",
+                optional=True,
             )
         )
         self.addParameter(
@@ -69,9 +87,19 @@ class LongestFlowPath(QgsProcessingAlgorithm):
                     "Custom Ranges (fastest)",
                     "Linear 10%",
                     "Brute Force (extremely slow)",
+                    "Exact (network graph)",
+                    "Raster flow length (flow directions)",
                 ],
                 allowMultiple=False,
-                defaultValue=["Linear 10%"],
+                defaultValue=METHOD_EXACT,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterRasterLayer(
+                "FlowDirection",
+                "Flow Direction (Step 1, for the raster flow length method)",
+                optional=True,
+                defaultValue=None,
             )
         )
         self.addParameter(
@@ -84,7 +112,21 @@ class LongestFlowPath(QgsProcessingAlgorithm):
             )
         )
 
+    @traced
     def processAlgorithm(self, parameters, context, model_feedback):
+        method = self.parameterAsEnum(parameters, "Method", context)
+        if method == METHOD_EXACT:
+            return self.process_exact(parameters, context, model_feedback)
+        if method == METHOD_FLOW_LENGTH:
+            return self.process_flow_length(parameters, context, model_feedback)
+        id_field = self.parameterAsString(parameters, "PourPointIDField", context)
+        if not id_field:
+            raise QgsProcessingException(
+                self.tr(
+                    "The Pour Point ID field is required by the Custom Ranges, Linear 10% and Brute Force methods"
+                )
+            )
+
         # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
         # overall progress through the whole algorithm
         feedback = QgsProcessingMultiStepFeedback(7, model_feedback)
@@ -99,71 +141,59 @@ class LongestFlowPath(QgsProcessingAlgorithm):
             "METHOD": 0,
             "PREDICATE": [0, 6],
         }
-        outputs["SelectChannelsWithinBasin"] = processing.run(
+        outputs["SelectChannelsWithinBasin"] = run_child(
             "native:selectbylocation",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
 
         feedback.setCurrentStep(1)
         if feedback.isCanceled():
             return {}
 
-        # 2. Extract the first vertex of each line feature representing a stream channel.
-        #    TODO: Rather than extracting all these vertices, calculate only the Springs & Junctions of the network
-        alg_params = {
-            "INPUT": QgsProcessingFeatureSourceDefinition(
-                parameters["ChannelNetwork"], selectedFeaturesOnly=True, featureLimit=-1
-            ),
-            "VERTICES": "0",
-            "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT,
+        # 2. The springs of the selected channels, from the topology index of the network
+        #    (built once per network and stored next to it)
+        channels = self.parameterAsVectorLayer(parameters, "ChannelNetwork", context)
+        outputs["Springs"] = {
+            "OUTPUT": self.springs_layer(
+                NetworkIndex.for_layer(channels), channels, selected_only=True
+            )
         }
-        outputs["ExtractFirstVertices"] = processing.run(
-            "native:extractspecificvertices",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
 
         feedback.setCurrentStep(2)
         if feedback.isCanceled():
             return {}
 
-        # 3. Create spatial index for the previously extracted vertices, to gain performance
+        # 3. Create spatial index for the springs, to gain performance
         #    benefit when calculating distances
-        alg_params = {"INPUT": outputs["ExtractFirstVertices"]["OUTPUT"]}
-        outputs["CreateSpatialIndex"] = processing.run(
+        alg_params = {"INPUT": outputs["Springs"]["OUTPUT"]}
+        outputs["CreateSpatialIndex"] = run_child(
             "native:createspatialindex",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
 
         feedback.setCurrentStep(3)
         if feedback.isCanceled():
             return {}
 
-        # 4. Calculate the Distance Matrix between the extracted vertices, some of which correspond to springs,
-        #    and the Pour Point, which corresponds to the discharge point
+        # 4. Calculate the Distance Matrix between the springs and the Pour Point, which corresponds to the discharge point
         alg_params = {
             "INPUT": parameters["PourPoint"],
-            "INPUT_FIELD": parameters["PourPointIDField"],
+            "INPUT_FIELD": id_field,
             "MATRIX_TYPE": 0,
             "NEAREST_POINTS": 0,
             "TARGET": outputs["CreateSpatialIndex"]["OUTPUT"],
             "TARGET_FIELD": "SegmentID",
-            "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT,
+            "OUTPUT": MEMORY_OUTPUT,
         }
-        outputs["DistanceMatrixVerticesToPourPoint"] = processing.run(
+        outputs["DistanceMatrixVerticesToPourPoint"] = run_child(
             "qgis:distancematrix",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
 
         feedback.setCurrentStep(4)
@@ -178,12 +208,11 @@ class LongestFlowPath(QgsProcessingAlgorithm):
         #     be chosen accordingly
         alg_params = {"INPUT": outputs["DistanceMatrixVerticesToPourPoint"]["OUTPUT"]}
         # Store the number of features (points that correspond to channel net vertices) in variable total_feats_count
-        total_feats_count = processing.run(
+        total_feats_count = run_child(
             "gwat:count_feats",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )["count"]
 
         max_feats_count = self.select_max_feats(
@@ -205,12 +234,11 @@ class LongestFlowPath(QgsProcessingAlgorithm):
             "INPUT": outputs["DistanceMatrixVerticesToPourPoint"]["OUTPUT"],
             "METHOD": 0,
         }
-        outputs["Top10FarthestPoints"] = processing.run(
+        outputs["Top10FarthestPoints"] = run_child(
             "qgis:selectbyexpression",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
 
         feedback.setCurrentStep(5)
@@ -247,14 +275,13 @@ class LongestFlowPath(QgsProcessingAlgorithm):
             "VALUE_BACKWARD": "",
             "VALUE_BOTH": "",
             "VALUE_FORWARD": "",
-            "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT,
+            "OUTPUT": MEMORY_OUTPUT,
         }
-        outputs["ShortestPathPointToLayer"] = processing.run(
+        outputs["ShortestPathPointToLayer"] = run_child(
             "native:shortestpathpointtolayer",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
 
         # 7. Select the point with the maximum network cost. Since the cost calc method was
@@ -266,12 +293,11 @@ class LongestFlowPath(QgsProcessingAlgorithm):
             "INPUT": outputs["ShortestPathPointToLayer"]["OUTPUT"],
             "METHOD": 0,
         }
-        outputs["Longest_Stream"] = processing.run(
+        outputs["Longest_Stream"] = run_child(
             "qgis:selectbyexpression",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
 
         feedback.setCurrentStep(6)
@@ -281,14 +307,13 @@ class LongestFlowPath(QgsProcessingAlgorithm):
         # 8. Save the max cost path to a new layer (final output)
         alg_params = {
             "INPUT": outputs["ShortestPathPointToLayer"]["OUTPUT"],
-            "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT,
+            "OUTPUT": MEMORY_OUTPUT,
         }
-        outputs["Longest_Stream"] = processing.run(
+        outputs["Longest_Stream"] = run_child(
             "native:saveselectedfeatures",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
 
         # 9. Calculate the Elongarion Ratio (Re) & Rename the layer
@@ -297,18 +322,216 @@ class LongestFlowPath(QgsProcessingAlgorithm):
             "BASIN": parameters["WatershedBasin"],
             "OUTPUT": parameters["Longest_Stream"],
         }
-        outputs["Longest_Flow_Path"] = processing.run(
+        outputs["Longest_Flow_Path"] = run_child(
             "gwat:elongation_ratio",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
 
         # 10. Pack the dict key/value pair Longest_Stream in the results and return it
         results["Longest_Flow_Path"] = outputs["Longest_Flow_Path"]["OUTPUT"]
         return results
 
+    def process_exact(self, parameters, context, model_feedback):
+        """
+        Exact longest flow path: build the channels of the basin as a graph joined at their
+        end points, rooted at the discharge point, and walk it once to the farthest spring.
+        """
+        feedback = QgsProcessingMultiStepFeedback(2, model_feedback)
+        results = {}
+        outputs = {}
+
+        channels = self.parameterAsVectorLayer(parameters, "ChannelNetwork", context)
+        basin_layer = self.parameterAsVectorLayer(parameters, "WatershedBasin", context)
+        pp_layer = self.parameterAsVectorLayer(parameters, "PourPoint", context)
+
+        # 1. Graph of the channels that fall within the basin
+        basin = QgsGeometry.unaryUnion(
+            [f.geometry() for f in basin_layer.getFeatures()]
+        )
+        engine = QgsGeometry.createGeometryEngine(basin.constGet())
+        engine.prepareGeometry()
+        request = QgsFeatureRequest().setFilterRect(basin.boundingBox())
+        request.setNoAttributes()
+
+        graph = ChannelGraph()
+        for f in channels.getFeatures(request):
+            geometry = f.geometry()
+            if not engine.intersects(geometry.constGet()):
+                continue
+            if geometry.isMultipart():
+                parts = geometry.asMultiPolyline()
+            else:
+                parts = [geometry.asPolyline()]
+            for part in parts:
+                graph.add_edge([(p.x(), p.y()) for p in part])
+        if not graph.edges:
+            raise QgsProcessingException(
+                self.tr("No channel of the network falls within the basin")
+            )
+
+        feedback.setCurrentStep(1)
+        if feedback.isCanceled():
+            return {}
+
+        # 2. Root the graph at the discharge point (on the nearest channel) and find the
+        #    farthest point upstream: its path is the longest flow path
+        pp = list(pp_layer.getFeatures())[0]
+        x = pp.geometry().asPoint().x()
+        y = pp.geometry().asPoint().y()
+        edge, along = graph.nearest_edge((x, y))
+        root = graph.split_edge(edge, along)
+        cost, path = graph.longest_path(root)
+
+        outputs["Longest_Stream"] = self.path_layer(channels.crs(), path, (x, y), cost)
+
+        feedback.setCurrentStep(2)
+        if feedback.isCanceled():
+            return {}
+
+        # 3. Calculate the Elongarion Ratio (Re) & Rename the layer
+        results["Longest_Flow_Path"] = self.elongation_ratio(
+            parameters, context, feedback, outputs
+        )
+        return results
+
+    def process_flow_length(self, parameters, context, model_feedback):
+        """
+        Longest flow path on the flow direction grid: the flow length of every cell of the
+        basin in one sweep of the D8 graph, then the trace back from the outlet along the
+        predecessors carrying the longest length.
+        """
+        feedback = QgsProcessingMultiStepFeedback(2, model_feedback)
+        results = {}
+        outputs = {}
+
+        fdir_layer = self.parameterAsRasterLayer(parameters, "FlowDirection", context)
+        if fdir_layer is None:
+            raise QgsProcessingException(
+                self.tr("The raster flow length method needs the Flow Direction grid")
+            )
+        pp_layer = self.parameterAsVectorLayer(parameters, "PourPoint", context)
+        pp = list(pp_layer.getFeatures())[0]
+        x = pp.geometry().asPoint().x()
+        y = pp.geometry().asPoint().y()
+
+        # 1. Upslope area of the discharge point, cropped to its extent
+        fdir, valid, geotransform, _ = read_raster(fdir_layer.source())
+        fdir = np.where(valid, fdir, hydrology.NO_FLOW).astype(np.int16)
+        del valid
+        row, col = world_to_cell(geotransform, x, y)
+        if not (0 <= row < fdir.shape[0] and 0 <= col < fdir.shape[1]):
+            raise QgsProcessingException(
+                self.tr("The discharge point is outside the flow direction grid")
+            )
+        basin = hydrology.upslope_area(fdir, row, col)
+        basin_rows = np.flatnonzero(basin.any(axis=1))
+        basin_cols = np.flatnonzero(basin.any(axis=0))
+        row0, col0 = int(basin_rows[0]), int(basin_cols[0])
+        window = (
+            slice(row0, int(basin_rows[-1]) + 1),
+            slice(col0, int(basin_cols[-1]) + 1),
+        )
+        fdir = np.where(basin[window], fdir[window], hydrology.NO_FLOW)
+        del basin
+        fdir[row - row0, col - col0] = hydrology.NO_FLOW
+
+        feedback.setCurrentStep(1)
+        if feedback.isCanceled():
+            return {}
+
+        # 2. Flow length sweep and trace back from the outlet
+        n_cols = fdir.shape[1]
+        length, predecessor = hydrology.upstream_flow_length(
+            hydrology.downstream_index(fdir),
+            hydrology.flow_steps(fdir, cell_size(geotransform)),
+        )
+        outlet = (row - row0) * n_cols + col - col0
+        cells = np.array(hydrology.trace_back(predecessor, outlet))
+        xs = geotransform[0] + (cells % n_cols + col0 + 0.5) * geotransform[1]
+        ys = geotransform[3] + (cells // n_cols + row0 + 0.5) * geotransform[5]
+        path = list(zip(xs.tolist(), ys.tolist()))
+        outputs["Longest_Stream"] = self.path_layer(
+            pp_layer.crs(), path, path[-1], float(length[outlet])
+        )
+
+        feedback.setCurrentStep(2)
+        if feedback.isCanceled():
+            return {}
+
+        # 3. Calculate the Elongarion Ratio (Re) & Rename the layer
+        results["Longest_Flow_Path"] = self.elongation_ratio(
+            parameters, context, feedback, outputs
+        )
+        return results
+
+    def springs_layer(self, index, channels, selected_only=False):
+        """
+        Memory layer of the springs of a channel network, with the SegmentID of the channel
+        starting at each of them.
+        """
+        selected = set(channels.selectedFeatureIds()) if selected_only else None
+        layer = QgsVectorLayer(
+            "Point?crs={}".format(channels.crs().authid()), "springs", "memory"
+        )
+        layer.dataProvider().addAttributes([QgsField("SegmentID", QVariant.Int)])
+        layer.updateFields()
+        features = []
+        for s in index.spring_segments():
+            if selected is not None and index.fids[s] not in selected:
+                continue
+            feat = QgsFeature(layer.fields())
+            feat.setGeometry(
+                QgsGeometry.fromPointXY(QgsPointXY(*index.point(index.node_a[s])))
+            )
+            feat.setAttributes([index.segment_ids[s]])
+            features.append(feat)
+        layer.dataProvider().addFeatures(features)
+        return layer
+
+    def path_layer(self, crs, path, start, cost):
+        """
+        Memory layer holding the longest path (spring to discharge point), with the fields
+        of native:shortestpathpointtolayer.
+        """
+        layer = QgsVectorLayer(
+            "LineString?crs={}".format(crs.authid()), "path", "memory"
+        )
+        layer.dataProvider().addAttributes(
+            [
+                QgsField("start", QVariant.String),
+                QgsField("end", QVariant.String),
+                QgsField("cost", QVariant.Double),
+            ]
+        )
+        layer.updateFields()
+        feat = QgsFeature(layer.fields())
+        feat.setGeometry(QgsGeometry.fromPolylineXY([QgsPointXY(*p) for p in path]))
+        feat.setAttributes(
+            [
+                "{},{}".format(*start),
+                "{},{}".format(*path[0]),
+                cost,
+            ]
+        )
+        layer.dataProvider().addFeature(feat)
+        return layer
+
+    def elongation_ratio(self, parameters, context, feedback, outputs):
+        alg_params = {
+            "CHANNELS": outputs["Longest_Stream"],
+            "BASIN": parameters["WatershedBasin"],
+            "OUTPUT": parameters["Longest_Stream"],
+        }
+        outputs["Longest_Flow_Path"] = run_child(
+            "gwat:elongation_ratio",
+            alg_params,
+            context=context,
+            feedback=feedback,
+        )
+        return outputs["Longest_Flow_Path"]["OUTPUT"]
+
     def tr(self, string):
         """
         Returns a translatable string with the self.tr() function.
@@ -332,7 +555,7 @@ class LongestFlowPath(QgsProcessingAlgorithm):
 
     def shortHelpString(self):
         return self.tr(
-            "\n\n Extract the longest flow path. Note that the <b>discharge point</b> should be <b>ON</b> the Channel Network. Ensure this by editing the layer containing the point, and moving it with <b>Snapping</b> enabled. Note also that the Discharge Point layer must contain a unique integer field (an ID field). This has no functional role, but it is rather a result of the implementation of the algorithm. \n\n\n<b>Method</b> refers to the way the candidate <b>longest streams</b> are selected, based on their edge vertices' distances from the Discharge Point. Before building a graph and calculating on-network distances, the algorithm filters the channel network vertices that fall the farthest away from the discharge point, in order to save time building and analyzing the graph. \n\n1. <b>Custom ranges</b> is an optimised number of points to include, based on the total vertices of the network, and is the <b>fastest</b> approach. \n2. <b>Linear 10%</b> includes the 10 percent of the total points that are the farthest away from the Discharge. It is the recommended method. \n3. <b>Brute Force</b> builds a graph including all the vertices of the network (most of which are <b>NOT</b> actual springs/extreme points). It is by far the slowest, especially for big and complex networks, but is also <b>the most reliable</b>. \n\n For relatively large networks it is generally recommended to use one of the first two methods. The third one was included for <b>validation</b> and for special cases where the geometry of the channel network is irregular, so that none of the <b>most distant springs</b> (absolute linear distance to the discharge) is not actually the springs of the longest channel.     \n\n\n\n\nDeveloped by E. Lymperis\n2021, Geomeletitiki S.A."
+            "\n\n Extract the longest flow path. Note that the <b>discharge point</b> should be <b>ON</b> the Channel Network. Ensure this by editing the layer containing the point, and moving it with <b>Snapping</b> enabled. Note also that the first three methods need a unique integer field (an ID field) of the Discharge Point layer. This has no functional role, but it is rather a result of the implementation of the algorithm. \n\n\n<b>Method</b> refers to the way the candidate <b>longest streams</b> are selected, based on their edge vertices' distances from the Discharge Point. Before building a graph and calculating on-network distances, the algorithm filters the channel network vertices that fall the farthest away from the discharge point, in order to save time building and analyzing the graph. \n\n1. <b>Custom ranges</b> is an optimised number of points to include, based on the total vertices of the network, and is the <b>fastest</b> of the first three methods. \n2. <b>Linear 10%</b> includes the 10 percent of the total points that are the farthest away from the Discharge. \n3. <b>Brute Force</b> builds a graph including all the vertices of the network (most of which are <b>NOT</b> actual springs/extreme points). It is by far the slowest, especially for big and complex networks, but is also <b>the most reliable</b>. \n4. <b>Exact</b> (default) builds the channel network as a graph, rooted at the Discharge Point, and finds the farthest upstream point with a single traversal. It always gives the true longest flow path and is faster than all the other methods; the Pour Point ID field is not used. \n5. <b>Raster flow length</b> does not use the channel network: it traces the longest flow path on the <b>Flow Direction</b> grid of Step 1, from the Discharge Point up to the farthest cell of its basin, so the point does not need to be snapped on the network. \n\n The first three methods are kept for reference: of these, the first two are quicker, while the third one was included for <b>validation</b> and for special cases where the geometry of the channel network is irregular, so that none of the <b>most distant springs</b> (absolute linear distance to the discharge) is not actually the springs of the longest channel.     \n\n\n\n\nDeveloped by E. Lymperis\n2021, Geomeletitiki S.A."
         )
 
     def select_max_feats(self, total_feats_count, method):
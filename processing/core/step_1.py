@@ -1,19 +1,56 @@
 import os
+import shutil
+import tempfile
 
+from qgis.PyQt.QtCore import QVariant
 from qgis.core import QgsProcessing
 from qgis.core import QgsProcessingAlgorithm
 from qgis.core import QgsProcessingMultiStepFeedback
+from qgis.core import QgsProcessingUtils
 from qgis.core import QgsProcessingParameterRasterLayer
 from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterBoolean
 from qgis.core import QgsProcessingParameterRasterDestination
 from qgis.core import QgsProcessingParameterVectorDestination
+from qgis.core import (
+    QgsFeature,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsPointXY,
+    QgsWkbTypes,
+)
 
-try:
-    from qgis import processing
-except:
-    import processing
+from osgeo import gdal
+import numpy as np
 
 from gwat.utils.files import get_plugin_output_dir, get_or_create_path
+from gwat.utils import hydrology
+from gwat.utils.rasters import read_raster, write_raster, copy_raster, cell_size
+from gwat.utils.hydrology_cache import HydrologyCache
+from gwat.utils.pipeline import Pipeline
+from gwat.utils.vectors import create_writer
+from gwat.utils.tiled_hydrology import TiledHydrology, tile_size_for_budget
+from gwat.utils.tracing import run_child, traced
+
+
+# Minimum slope (degrees) preserved by the Wang & Liu fill
+MINSLOPE = 0.01
+# Flow routing of the catchment area: [0] Deterministic 8
+ROUTING_METHOD = 0
+
+BACKENDS = ["SAGA NextGen (reference)", "Native (NumPy, in-process)"]
+BACKEND_SAGA = 0
+BACKEND_NATIVE = 1
+
+
+def cell_threshold(threshold, geotransform):
+    """
+    The channel initiation threshold as a cell count. SAGA compares it with the catchment
+    area in cell area units (FLOW_UNIT 1), the native accumulation counts cells.
+    """
+    return threshold / abs(geotransform[1] * geotransform[5])
 
 
 class WATStep1(QgsProcessingAlgorithm):
@@ -29,12 +66,37 @@ class WATStep1(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterNumber(
                 "channel_initiation_threshold",
-                "Channel initiation threshold (how many pixels must drain through a cell to be considered a channel)",
+                "Channel initiation threshold (catchment area, in square map units, that must drain through a cell to be considered a channel)",
                 type=QgsProcessingParameterNumber.Integer,
                 minValue=1,
                 defaultValue=40000,
             )
         )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                "backend",
+                "Processing backend",
+                options=BACKENDS,
+                allowMultiple=False,
+                defaultValue=BACKEND_SAGA,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                "tile_memory_mb",
+                "Tile memory budget in MB, for DEMs larger than RAM (Native backend only, 0 = whole DEM in memory)",
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                "use_cache",
+                "Reuse the filled DEM, flow directions and catchment area of previous runs on the same DEM",
+                defaultValue=True,
+            )
+        )
         self.addParameter(
             QgsProcessingParameterRasterDestination(
                 "Channel_network_raster",
@@ -69,71 +131,144 @@ class WATStep1(QgsProcessingAlgorithm):
             )
         )
 
+    @traced
     def processAlgorithm(self, parameters, context, model_feedback):
+        backend = self.parameterAsEnum(parameters, "backend", context)
+        tile_memory = self.parameterAsInt(parameters, "tile_memory_mb", context)
+
+        # Threshold-independent grids, reused from previous runs on the same DEM
+        cache, cache_key = None, None
+        if self.parameterAsBool(parameters, "use_cache", context):
+            dem_layer = self.parameterAsRasterLayer(parameters, "dem", context)
+            cache = HydrologyCache()
+            cache_key = cache.key(
+                dem_layer.source(),
+                minslope=MINSLOPE,
+                method=ROUTING_METHOD,
+                engine="saga" if backend == BACKEND_SAGA else "native",
+            )
+
+        if backend == BACKEND_NATIVE and tile_memory > 0:
+            return self.process_tiled(
+                parameters,
+                context,
+                model_feedback,
+                tile_size_for_budget(tile_memory),
+                cache,
+                cache_key,
+            )
+        if backend == BACKEND_NATIVE:
+            return self.process_native(
+                parameters, context, model_feedback, cache, cache_key
+            )
+        return self.process_saga(parameters, context, model_feedback, cache, cache_key)
+
+    def from_cache(self, parameters, context, feedback, cache, cache_key):
+        """
+        Look the DEM up in the hydrology cache. On a hit, copy the cached filled DEM and flow
+        directions to the requested outputs and return the cached grids.
+        """
+        cached = cache.lookup(cache_key) if cache is not None else None
+        if cached is None:
+            return None, {}
+        feedback.pushInfo(
+            "Filled DEM, flow directions and catchment area found in the hydrology cache"
+        )
+        results = {
+            "Filled_dem": copy_raster(
+                cached["filled"],
+                self.parameterAsOutputLayer(parameters, "Filled_dem", context),
+            ),
+            "Flow_direction": copy_raster(
+                cached["flow_directions"],
+                self.parameterAsOutputLayer(parameters, "Flow_direction", context),
+            ),
+        }
+        return cached, results
+
+    def process_saga(self, parameters, context, model_feedback, cache, cache_key):
         # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
         # overall progress through the model
         feedback = QgsProcessingMultiStepFeedback(3, model_feedback)
-        results = {}
         outputs = {}
 
-        # Fill sinks (wang & liu)
-        alg_params = {
-            "ELEV": parameters["dem"],
-            "MINSLOPE": 0.01,
-            "WSHED": "TEMPORARY_OUTPUT",
-            "FDIR": parameters["Flow_direction"],
-            "FILLED": parameters["Filled_dem"],
-            "WSHED": QgsProcessing.TEMPORARY_OUTPUT,
-        }
-        outputs["FillSinksWangLiu"] = processing.run(
-            "sagang:fillsinkswangliu",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        cached, results = self.from_cache(
+            parameters, context, feedback, cache, cache_key
         )
-        results["Filled_dem"] = outputs["FillSinksWangLiu"]["FILLED"]
-        results["Flow_direction"] = outputs["FillSinksWangLiu"]["FDIR"]
+        if cached is not None:
+            filled = cached["filled"]
+            accumulation = cached["accumulation"]
+        else:
+            # Fill sinks (wang & liu)
+            alg_params = {
+                "ELEV": parameters["dem"],
+                "MINSLOPE": MINSLOPE,
+                "WSHED": "TEMPORARY_OUTPUT",
+                "FDIR": parameters["Flow_direction"],
+                "FILLED": parameters["Filled_dem"],
+                "WSHED": QgsProcessing.TEMPORARY_OUTPUT,
+            }
+            outputs["FillSinksWangLiu"] = run_child(
+                "sagang:fillsinkswangliu",
+                alg_params,
+                context=context,
+                feedback=feedback,
+            )
+            results["Filled_dem"] = outputs["FillSinksWangLiu"]["FILLED"]
+            results["Flow_direction"] = outputs["FillSinksWangLiu"]["FDIR"]
 
-        feedback.setCurrentStep(1)
-        if feedback.isCanceled():
-            return {}
+            feedback.setCurrentStep(1)
+            if feedback.isCanceled():
+                return {}
 
-        # Catchment area
-        alg_params = {
-            "ACCU_LEFT": "TEMPORARY_OUTPUT",
-            "ACCU_MATERIAL": None,
-            "ACCU_RIGHT": "TEMPORARY_OUTPUT",
-            "ACCU_TARGET": outputs["FillSinksWangLiu"]["FILLED"],
-            "ACCU_TOTAL": "TEMPORARY_OUTPUT",
-            "CONVERGENCE": 1.1,
-            "ELEVATION": outputs["FillSinksWangLiu"]["FILLED"],
-            "FLOW": "TEMPORARY_OUTPUT",
-            "FLOW_LENGTH": "TEMPORARY_OUTPUT",
-            "FLOW_UNIT": 1,  # [1] cell area
-            "LINEAR_DIR": None,
-            "LINEAR_DO": False,
-            "LINEAR_MIN": 500,
-            "LINEAR_VAL": None,
-            "METHOD": 0,  # [0] Deterministic 8
-            "MFD_CONTOUR": False,
-            "NO_NEGATIVES": True,
-            "SINKROUTE": None,
-            "STEP": 1,
-            "VAL_INPUT": None,
-            "VAL_MEAN": "TEMPORARY_OUTPUT",
-            "WEIGHTS": None,
-            "WEIGHT_LOSS": "TEMPORARY_OUTPUT",
-            "FLOW": QgsProcessing.TEMPORARY_OUTPUT,
-            "VAL_MEAN": QgsProcessing.TEMPORARY_OUTPUT,
-        }
-        outputs["CatchmentArea"] = processing.run(
-            "sagang:catchmentarea",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
+            # Catchment area
+            alg_params = {
+                "ACCU_LEFT": "TEMPORARY_OUTPUT",
+                "ACCU_MATERIAL": None,
+                "ACCU_RIGHT": "TEMPORARY_OUTPUT",
+                "ACCU_TARGET": outputs["FillSinksWangLiu"]["FILLED"],
+                "ACCU_TOTAL": "TEMPORARY_OUTPUT",
+                "CONVERGENCE": 1.1,
+                "ELEVATION": outputs["FillSinksWangLiu"]["FILLED"],
+                "FLOW": "TEMPORARY_OUTPUT",
+                "FLOW_LENGTH": "TEMPORARY_OUTPUT",
+                "FLOW_UNIT": 1,  # [1] cell area
+                "LINEAR_DIR": None,
+                "LINEAR_DO": False,
+                "LINEAR_MIN": 500,
+                "LINEAR_VAL": None,
+                "METHOD": ROUTING_METHOD,  # [0] Deterministic 8
+                "MFD_CONTOUR": False,
+                "NO_NEGATIVES": True,
+                "SINKROUTE": None,
+                "STEP": 1,
+                "VAL_INPUT": None,
+                "VAL_MEAN": "TEMPORARY_OUTPUT",
+                "WEIGHTS": None,
+                "WEIGHT_LOSS": "TEMPORARY_OUTPUT",
+                "FLOW": QgsProcessing.TEMPORARY_OUTPUT,
+                "VAL_MEAN": QgsProcessing.TEMPORARY_OUTPUT,
+            }
+            outputs["CatchmentArea"] = run_child(
+                "sagang:catchmentarea",
+                alg_params,
+                context=context,
+                feedback=feedback,
+            )
+            filled = outputs["FillSinksWangLiu"]["FILLED"]
+            accumulation = outputs["CatchmentArea"]["FLOW"]
+
+            if cache is not None:
+                cache.store(
+                    cache_key,
+                    {
+                        "filled": filled,
+                        "flow_directions": outputs["FillSinksWangLiu"]["FDIR"],
+                        "accumulation": accumulation,
+                    },
+                    dem=self.parameterAsRasterLayer(parameters, "dem", context).source(),
+                    engine="saga",
+                )
 
         feedback.setCurrentStep(2)
         if feedback.isCanceled():
@@ -143,8 +278,8 @@ class WATStep1(QgsProcessingAlgorithm):
         alg_params = {
             "DIV_CELLS": 5,
             "DIV_GRID": None,
-            "ELEVATION": outputs["FillSinksWangLiu"]["FILLED"],
-            "INIT_GRID": outputs["CatchmentArea"]["FLOW"],
+            "ELEVATION": filled,
+            "INIT_GRID": accumulation,
             "INIT_METHOD": 2,  # [2] Greater than
             "INIT_VALUE": parameters["channel_initiation_threshold"],
             "MINLEN": 1,
@@ -154,17 +289,304 @@ class WATStep1(QgsProcessingAlgorithm):
             "CHNLROUTE": QgsProcessing.TEMPORARY_OUTPUT,
             "SHAPES": parameters["Channel_network_vector"],
         }
-        outputs["ChannelNetwork"] = processing.run(
+        outputs["ChannelNetwork"] = run_child(
             "sagang:channelnetwork",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
         results["Channel_network_raster"] = outputs["ChannelNetwork"]["CHNLNTWRK"]
         results["Channel_network_vector"] = outputs["ChannelNetwork"]["SHAPES"]
         return results
 
+    def process_native(self, parameters, context, model_feedback, cache, cache_key):
+        """
+        Same outputs as the SAGA chain, computed in memory with the NumPy D8 engine:
+        fill (Wang & Liu) -> D8 directions -> accumulation -> channel network.
+        """
+        feedback = QgsProcessingMultiStepFeedback(4, model_feedback)
+
+        dem_layer = self.parameterAsRasterLayer(parameters, "dem", context)
+        threshold = self.parameterAsInt(
+            parameters, "channel_initiation_threshold", context
+        )
+
+        cached, results = self.from_cache(
+            parameters, context, feedback, cache, cache_key
+        )
+        if cached is not None:
+            fdir, _, geotransform, projection = read_raster(cached["flow_directions"])
+            fdir = fdir.astype(np.int16)
+            acc = read_raster(cached["accumulation"])[0]
+        else:
+            dem, valid, geotransform, projection = read_raster(dem_layer.source())
+            cells = cell_size(geotransform)
+
+            # Fill sinks (wang & liu)
+            filled = hydrology.fill_sinks(
+                dem,
+                valid,
+                cells,
+                MINSLOPE,
+                progress=lambda p: feedback.setProgress(p * 100)
+                or feedback.isCanceled(),
+            )
+            if filled is None or feedback.isCanceled():
+                return {}
+            del dem
+            results["Filled_dem"] = write_raster(
+                self.parameterAsOutputLayer(parameters, "Filled_dem", context),
+                filled,
+                geotransform,
+                projection,
+                gdal.GDT_Float32,
+                -99999,
+            )
+
+            feedback.setCurrentStep(1)
+            if feedback.isCanceled():
+                return {}
+
+            # Flow directions
+            fdir = hydrology.flow_directions(filled, cells)
+            del filled
+            results["Flow_direction"] = write_raster(
+                self.parameterAsOutputLayer(parameters, "Flow_direction", context),
+                fdir,
+                geotransform,
+                projection,
+                gdal.GDT_Int16,
+                hydrology.NO_FLOW,
+            )
+
+            feedback.setCurrentStep(2)
+            if feedback.isCanceled():
+                return {}
+
+            # Catchment area (cell count, D8)
+            acc = hydrology.flow_accumulation(fdir, valid)
+
+            if cache is not None:
+                # The accumulation grid is only written for the cache, which copies it
+                with Pipeline() as pipeline:
+                    accumulation = write_raster(
+                        pipeline.raster("accumulation"),
+                        np.where(valid, acc, np.nan),
+                        geotransform,
+                        projection,
+                        gdal.GDT_Float64,
+                        -99999,
+                    )
+                    cache.store(
+                        cache_key,
+                        {
+                            "filled": results["Filled_dem"],
+                            "flow_directions": results["Flow_direction"],
+                            "accumulation": accumulation,
+                        },
+                        dem=dem_layer.source(),
+                        engine="native",
+                    )
+            del valid
+
+        feedback.setCurrentStep(3)
+        if feedback.isCanceled():
+            return {}
+
+        # Channel network
+        down = hydrology.downstream_index(fdir)
+        channels, receivers = hydrology.channel_cells(
+            acc, down, cell_threshold(threshold, geotransform)
+        )
+        del acc, down
+        results.update(
+            self.write_channel_network(
+                parameters,
+                context,
+                fdir.shape,
+                geotransform,
+                projection,
+                channels,
+                receivers,
+                dem_layer.crs(),
+            )
+        )
+        return results
+
+    def process_tiled(
+        self, parameters, context, model_feedback, tile_size, cache, cache_key
+    ):
+        """
+        Native backend, streaming the DEM in tiles so that memory is bounded by the tile
+        budget. The outputs are identical to `process_native`.
+        """
+        feedback = QgsProcessingMultiStepFeedback(4, model_feedback)
+
+        dem_layer = self.parameterAsRasterLayer(parameters, "dem", context)
+        threshold = self.parameterAsInt(
+            parameters, "channel_initiation_threshold", context
+        )
+        scratch_dir = tempfile.mkdtemp(dir=QgsProcessingUtils.tempFolder())
+        tiled = TiledHydrology(
+            dem_layer.source(),
+            tile_size,
+            scratch_dir,
+            progress=lambda p: feedback.setProgress(p * 100) or feedback.isCanceled(),
+        )
+        feedback.pushInfo(
+            f"Processing {tiled.cols}x{tiled.rows} cells in {len(tiled.tiles)} tiles of {tile_size}x{tile_size}"
+        )
+
+        try:
+            cached, results = self.from_cache(
+                parameters, context, feedback, cache, cache_key
+            )
+            if cached is not None:
+                feedback.setCurrentStep(3)
+                network = tiled.channel_cells(
+                    cell_threshold(threshold, tiled.geotransform),
+                    cached["flow_directions"],
+                    cached["accumulation"],
+                )
+            else:
+                # Fill sinks (wang & liu), reconciling spill elevations across tiles
+                if not tiled.fill(MINSLOPE) or feedback.isCanceled():
+                    return {}
+                results["Filled_dem"] = tiled.write_filled(
+                    self.parameterAsOutputLayer(parameters, "Filled_dem", context)
+                )
+
+                feedback.setCurrentStep(1)
+                if feedback.isCanceled():
+                    return {}
+
+                # Flow directions
+                flow_direction = self.parameterAsOutputLayer(
+                    parameters, "Flow_direction", context
+                )
+                if not tiled.flow_directions(flow_direction):
+                    return {}
+                results["Flow_direction"] = flow_direction
+
+                feedback.setCurrentStep(2)
+                if feedback.isCanceled():
+                    return {}
+
+                # Catchment area, reconciled across tile borders
+                if not tiled.accumulate():
+                    return {}
+                if cache is not None:
+                    cache.store(
+                        cache_key,
+                        {
+                            "filled": results["Filled_dem"],
+                            "flow_directions": tiled.fdir_path,
+                            "accumulation": tiled.accumulation_path,
+                        },
+                        dem=dem_layer.source(),
+                        engine="native",
+                    )
+
+                feedback.setCurrentStep(3)
+                if feedback.isCanceled():
+                    return {}
+                network = tiled.channel_cells(
+                    cell_threshold(threshold, tiled.geotransform)
+                )
+
+            if network is None or feedback.isCanceled():
+                return {}
+
+            # Channel network
+            channels, receivers = network
+            results.update(
+                self.write_channel_network(
+                    parameters,
+                    context,
+                    tiled.shape,
+                    tiled.geotransform,
+                    tiled.projection,
+                    channels,
+                    receivers,
+                    dem_layer.crs(),
+                    tiled=tiled,
+                )
+            )
+        finally:
+            tiled = None
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        return results
+
+    def write_channel_network(
+        self,
+        parameters,
+        context,
+        shape,
+        geotransform,
+        projection,
+        channels,
+        receivers,
+        crs,
+        tiled=None,
+    ):
+        """
+        Write the channel network raster (Strahler order) and vector (one line per segment,
+        with the attributes of SAGA's channel network shapes).
+        """
+        order, to = hydrology.strahler_order(channels, receivers)
+        raster_path = self.parameterAsOutputLayer(
+            parameters, "Channel_network_raster", context
+        )
+        if tiled is not None:
+            tiled.write_strahler(raster_path, channels, order)
+        else:
+            write_raster(
+                raster_path,
+                hydrology.strahler_grid(shape, channels, order),
+                geotransform,
+                projection,
+                gdal.GDT_Int16,
+                0,
+            )
+
+        fields = QgsFields()
+        fields.append(QgsField("SegmentID", QVariant.Int))
+        fields.append(QgsField("Node_A", QVariant.Int))
+        fields.append(QgsField("Node_B", QVariant.Int))
+        fields.append(QgsField("Order", QVariant.Int))
+        fields.append(QgsField("Length", QVariant.Double))
+
+        vector_path = self.parameterAsOutputLayer(
+            parameters, "Channel_network_vector", context
+        )
+        writer = create_writer(
+            vector_path, fields, QgsWkbTypes.LineString, crs, context
+        )
+
+        n_cols = shape[1]
+        segments = hydrology.channel_segments(
+            channels, to, order, hydrology.step_lengths(n_cols, cell_size(geotransform))
+        )
+        for segment_id, (path, seg_order, node_a, node_b, length) in enumerate(
+            segments, start=1
+        ):
+            xs = geotransform[0] + (path % n_cols + 0.5) * geotransform[1]
+            ys = geotransform[3] + (path // n_cols + 0.5) * geotransform[5]
+            feat = QgsFeature(fields)
+            feat.setGeometry(
+                QgsGeometry.fromPolylineXY(
+                    [QgsPointXY(x, y) for x, y in zip(xs.tolist(), ys.tolist())]
+                )
+            )
+            feat.setAttributes([segment_id, node_a, node_b, seg_order, length])
+            writer.addFeature(feat)
+        del writer
+
+        return {
+            "Channel_network_raster": raster_path,
+            "Channel_network_vector": vector_path,
+        }
+
     def name(self):
         return "step_1"
 
@@ -181,4 +603,4 @@ class WATStep1(QgsProcessingAlgorithm):
         return WATStep1()
 
     def shortHelpString(self):
-        return "Note: Use this module first, <b>if</b> you NEED TO SPECIFY THE DISCHARGE POINT and <b>then</b> run module 2. If you already know the exact position of the discharge point you can directly use module 2 \n\n<b>Note</b>: the Channel Initiation Threshold is the minimum number of cells (raster pixels) that drain through a particular cell A, in order for A to be labeled as part of a Channel. The default value is 40,000 and was specified to produce an adequately dense Channel Network on a 10Km x 8Km DEM with 3m spatial resolution. This number needs to be adjusted based on the size of the basin as well as the quality of the DEM.\n\n\n\n\nDeveloped by E. Lymperis\n2021, Geomeletitiki S.A."
+        return "Note: Use this module first, <b>if</b> you NEED TO SPECIFY THE DISCHARGE POINT and <b>then</b> run module 2. If you already know the exact position of the discharge point you can directly use module 2 \n\n<b>Note</b>: the Channel Initiation Threshold is the minimum catchment area (in square map units, i.e. number of cells times the cell area) that drains through a particular cell A, in order for A to be labeled as part of a Channel. The default value is 40,000 and was specified to produce an adequately dense Channel Network on a 10Km x 8Km DEM with 3m spatial resolution. This number needs to be adjusted based on the size of the basin as well as the quality of the DEM.\n\n<b>Backend</b>: SAGA NextGen runs the reference SAGA tools. The Native backend computes the same outputs (Wang & Liu fill, D8 flow directions, catchment area and Strahler-ordered channel network) in memory with NumPy, without the intermediate SAGA grids. For DEMs larger than RAM, set a <b>tile memory budget</b>: the DEM is then streamed in tiles and the results are reconciled across tile borders, giving the same outputs.\n\n<b>Cache</b>: the filled DEM, flow directions and catchment area do not depend on the Channel Initiation Threshold. They are cached per DEM (by content checksum) in the plugin output folder, so re-running with another threshold only extracts the channel network. Use the <i>Hydrology Cache</i> tool to inspect or purge the cache.\n\n\n\n\nDeveloped by E. Lymperis\n2021, Geomeletitiki S.A."
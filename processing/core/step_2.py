@@ -5,8 +5,10 @@ Group :
 With QGIS : 33411
 """
 
+from qgis.PyQt.QtCore import QVariant
 from qgis.core import QgsProcessing
 from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
 from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterRasterLayer
 from qgis.core import QgsProcessingParameterFeatureSource
@@ -14,15 +16,46 @@ from qgis.core import QgsProcessingParameterRasterDestination
 from qgis.core import QgsProcessingParameterFeatureSink
 from qgis.core import QgsProcessingParameterVectorDestination
 from qgis.core import QgsProcessingParameterVectorLayer
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingParameterField
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingUtils
 from qgis.core import QgsExpression
 from qgis.core import QgsProject
+from qgis.core import QgsFeature, QgsField, QgsFields, QgsGeometry, QgsVectorLayer
+from qgis.core import QgsCoordinateTransform
+from qgis.core import QgsFeatureSink, QgsWkbTypes
+from qgis.core import NULL
 
-import processing
 import os
-import ast
+
+import numpy as np
+from osgeo import gdal
 
 # from ..utils.files import get_plugin_output_dir
 from gwat.utils.files import get_plugin_output_dir, get_or_create_path
+from gwat.utils import hydrology
+from gwat.utils.rasters import read_raster, write_raster, cell_size, world_to_cell
+from gwat.utils.rasters import clip_to_polygon
+from gwat.utils.vectors import merge_keyed, mask_geometry
+from gwat.utils.parallel import TaskGraph
+from gwat.utils.artifact_cache import ArtifactCache, run_cached
+from gwat.utils.pipeline import Pipeline, raster_input
+from gwat.utils.tracing import run_child, traced
+
+
+DELINEATIONS = [
+    "SAGA upslope area, polygonized (reference)",
+    "Raster boundary trace",
+]
+DELINEATION_POLYGONIZE = 0
+DELINEATION_TRACE = 1
+
+CN_OVERLAYS = [
+    "Vector (SAGA polygon union)",
+    "Raster (fast)",
+]
 
 
 class WATStep2(QgsProcessingAlgorithm):
@@ -54,6 +87,71 @@ class WATStep2(QgsProcessingAlgorithm):
                 # help="The channel network to be used for the analysis",
             )
         )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                "delineation",
+                "Watershed delineation",
+                options=DELINEATIONS,
+                defaultValue=DELINEATION_POLYGONIZE,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                "cn_overlay",
+                "Curve Number overlay",
+                options=CN_OVERLAYS,
+                defaultValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                "contour_intervals",
+                "Contours: number of intervals over the basin's elevation range",
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=10,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                "contour_interval",
+                "Contours: fixed interval (m, 0: from the number of intervals)",
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                defaultValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                "use_cache",
+                "Reuse the outputs of previous runs whose inputs and parameters are unchanged",
+                defaultValue=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                "batch",
+                "Batch mode: delineate every discharge point of the layer",
+                defaultValue=False,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                "point_id_field",
+                "Discharge point ID field (batch mode, unique and not NULL, feature ID if not set)",
+                parentLayerParameterName="discharge_point",
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                "workers",
+                "Parallel workers for the per-basin stages (0: parallel_workers setting, or one per CPU)",
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=0,
+            )
+        )
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 "BasinRaw",
@@ -145,7 +243,25 @@ class WATStep2(QgsProcessingAlgorithm):
             )
         )
 
+    @traced
     def processAlgorithm(self, parameters, context, model_feedback):
+        # Child algorithm outputs, reused across runs
+        cache = (
+            ArtifactCache()
+            if self.parameterAsBool(parameters, "use_cache", context)
+            else None
+        )
+        # Intermediates stay in memory, released once the run is over
+        with Pipeline() as pipeline:
+            if self.parameterAsBool(parameters, "batch", context):
+                return self.process_batch(
+                    parameters, context, model_feedback, pipeline, cache
+                )
+            return self.process_single(
+                parameters, context, model_feedback, pipeline, cache
+            )
+
+    def process_single(self, parameters, context, model_feedback, pipeline, cache=None):
         Pour_Point = self.parameterAsVectorLayer(parameters, "discharge_point", context)
 
         # Specify the Pour Point from the points layer
@@ -163,10 +279,83 @@ class WATStep2(QgsProcessingAlgorithm):
 
         # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
         # overall progress through the model
-        feedback = QgsProcessingMultiStepFeedback(8, model_feedback)
+        feedback = QgsProcessingMultiStepFeedback(6, model_feedback)
         results = {}
         outputs = {}
 
+        delineation = self.parameterAsEnum(parameters, "delineation", context)
+        if delineation == DELINEATION_TRACE:
+            delineated = self.delineate_trace(
+                parameters, context, feedback, x, y, outputs, results, cache
+            )
+        else:
+            delineated = self.delineate_polygonize(
+                parameters, context, feedback, x, y, outputs, results, pipeline, cache
+            )
+        if delineated is None:
+            return {}
+        basin, area, perimeter = delineated
+
+        feedback.setCurrentStep(5)
+        if feedback.isCanceled():
+            return {}
+
+        # Clip, contours, channel network, stats & CN, run concurrently
+        graph = TaskGraph()
+        self.add_basin_stages(
+            graph,
+            "",
+            self.basin_inputs(parameters, context, pipeline, cache),
+            QgsProcessingUtils.mapLayerFromString(basin, context),
+            area,
+            perimeter,
+            pour_point_name,
+            {
+                "BasinDEM": self.parameterAsOutputLayer(
+                    parameters, "BasinDEM", context
+                ),
+                "BasinContours": parameters["BasinContours"],
+                "BasinChannelNetwork": parameters["BasinChannelNetwork"],
+                "Basincn": parameters["Basincn"],
+                "Basincorine": parameters["Basincorine"],
+                "Basinscs": parameters["Basinscs"],
+            },
+        )
+        stages = graph.run(
+            context,
+            feedback,
+            self.parameterAsInt(parameters, "workers", context),
+        )
+        if stages is None:
+            return {}
+        outputs.update(stages)
+        results["BasinDEM"] = stages["BasinDEM"]
+        results["BasinContours"] = stages["BasinContours"]
+        results["BasinChannelNetwork"] = stages["BasinChannelNetwork"]
+        results["Basincn"] = stages["Basincn"]["Watershed_CN"]
+        # results["Basincorine"] = stages["Basincn"]["W_Corine"]
+        # results["Basinscs"] = stages["Basincn"]["W_LandUseSCS"]
+
+        return results
+
+    def delineate_polygonize(
+        self,
+        parameters,
+        context,
+        feedback,
+        x,
+        y,
+        outputs,
+        results,
+        pipeline,
+        cache=None,
+    ):
+        """
+        Basin of the discharge point through SAGA's upslope area, polygonized, fixed and
+        dissolved by GDAL/QGIS, then filtered by the point.
+
+        :return: (basin layer, area, perimeter), None if cancelled
+        """
         # Upslope area
         alg_params = {
             "CONVERGE": 1.1,
@@ -179,18 +368,14 @@ class WATStep2(QgsProcessingAlgorithm):
             "TARGET_PT_Y": y,
             "AREA": "TEMPORARY_OUTPUT",  # parameters["DischargePointBasin"],
         }
-        outputs["UpslopeArea"] = processing.run(
-            "sagang:upslopearea",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        outputs["UpslopeArea"] = run_cached(
+            cache, "sagang:upslopearea", alg_params, context, feedback
         )
         results["UpslopeArea"] = outputs["UpslopeArea"]["AREA"]
 
         feedback.setCurrentStep(1)
         if feedback.isCanceled():
-            return {}
+            return None
 
         # Polygonize (raster to vector)
         alg_params = {
@@ -201,84 +386,223 @@ class WATStep2(QgsProcessingAlgorithm):
             "INPUT": outputs["UpslopeArea"]["AREA"],
             "OUTPUT": parameters["BasinRaw"],
         }
-        outputs["BasinRaw"] = processing.run(
-            "gdal:polygonize",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        outputs["BasinRaw"] = run_cached(
+            cache, "gdal:polygonize", alg_params, context, feedback
         )
 
         feedback.setCurrentStep(2)
         if feedback.isCanceled():
-            return {}
+            return None
 
         # Fix geometries
         alg_params = {
             "INPUT": outputs["BasinRaw"]["OUTPUT"],
             "METHOD": 1,  # Structure
-            "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT,
+            "OUTPUT": pipeline.vector("fixed"),
         }
-        outputs["FixGeometries"] = processing.run(
-            "native:fixgeometries",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        outputs["FixGeometries"] = run_cached(
+            cache, "native:fixgeometries", alg_params, context, feedback
         )
 
         feedback.setCurrentStep(3)
         if feedback.isCanceled():
-            return {}
+            return None
 
         # Dissolve
         alg_params = {
             "FIELD": ["DN"],
             "INPUT": outputs["FixGeometries"]["OUTPUT"],
             "SEPARATE_DISJOINT": False,
-            "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT,
+            "OUTPUT": pipeline.vector("dissolved"),
         }
-        outputs["Dissolve"] = processing.run(
-            "native:dissolve",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        outputs["Dissolve"] = run_cached(
+            cache, "native:dissolve", alg_params, context, feedback
         )
 
         feedback.setCurrentStep(4)
         if feedback.isCanceled():
-            return {}
+            return None
 
         # 5. Filter the watershed layer, keep only the needed watershed & attrs
         alg_params = {
             "Watershed": outputs["Dissolve"]["OUTPUT"],
             "pour_point": str(x) + "," + str(y),
             "Filtered_Watershed": parameters["UpslopeBasin"],
-            "Area_Perimeter": "TEMPORARY_OUTPUT",
         }
-        outputs["GeomeletitikiWatershedAttributes"] = processing.run(
-            "gwat:watershed_attributes",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        outputs["GeomeletitikiWatershedAttributes"] = run_cached(
+            cache, "gwat:watershed_attributes", alg_params, context, feedback
         )
         results["UpslopeBasin"] = outputs["GeomeletitikiWatershedAttributes"][
             "Filtered_Watershed"
         ]
 
-        area_per = ast.literal_eval(
-            outputs["GeomeletitikiWatershedAttributes"]["Area_Perimeter"]
+        return (
+            outputs["GeomeletitikiWatershedAttributes"]["Filtered_Watershed"],
+            outputs["GeomeletitikiWatershedAttributes"]["Area"],
+            outputs["GeomeletitikiWatershedAttributes"]["Perimeter"],
         )
-        area = area_per[0]
-        perimeter = area_per[1]
 
-        feedback.setCurrentStep(5)
+    def delineate_trace(
+        self, parameters, context, feedback, x, y, outputs, results, cache=None
+    ):
+        """
+        Basin of the discharge point traced straight from its upslope area grid.
+
+        :return: (basin layer, area, perimeter), None if cancelled
+        """
+        alg_params = {
+            "filled_dem": parameters["filled_dem"],
+            "pour_point": str(x) + "," + str(y),
+            "Watershed": parameters["UpslopeBasin"],
+        }
+        outputs["WatershedDelineation"] = run_cached(
+            cache, "gwat:watershed_delineation", alg_params, context, feedback
+        )
+        results["UpslopeBasin"] = outputs["WatershedDelineation"]["Watershed"]
+
+        feedback.setCurrentStep(4)
+        if feedback.isCanceled():
+            return None
+        return (
+            outputs["WatershedDelineation"]["Watershed"],
+            outputs["WatershedDelineation"]["Area"],
+            outputs["WatershedDelineation"]["Perimeter"],
+        )
+
+    def process_batch(self, parameters, context, model_feedback, pipeline, cache=None):
+        """
+        Delineate every discharge point of the layer from a single flow-direction pass,
+        then run the per-basin stages. Each output holds the features of all the basins,
+        keyed by the point ID.
+        """
+        Pour_Point = self.parameterAsVectorLayer(parameters, "discharge_point", context)
+        pour_point_name = (os.path.basename(Pour_Point.source()).split("|")[0]).split(
+            "."
+        )[0]
+        id_field_name = self.parameterAsString(parameters, "point_id_field", context)
+        if id_field_name:
+            id_field = QgsField(Pour_Point.fields().field(id_field_name))
+            id_field.setName("point_id")
+        else:
+            id_field = QgsField("point_id", QVariant.LongLong)
+
+        delineation = self.parameterAsEnum(parameters, "delineation", context)
+        feedback = QgsProcessingMultiStepFeedback(5, model_feedback)
+        results = {}
+        outputs = {}
+
+        # Flow directions of the filled DEM, and the cell of every discharge point
+        dem_layer = self.parameterAsRasterLayer(parameters, "filled_dem", context)
+        dem, valid, geotransform, projection = read_raster(dem_layer.source())
+        fdir = hydrology.flow_directions(
+            np.where(valid, dem, np.nan), cell_size(geotransform)
+        )
+        del dem
+        rows, cols = fdir.shape
+
+        point_ids, seeds = [], []
+        seen_ids = set()
+        for f in Pour_Point.getFeatures():
+            point_id = f[id_field_name] if id_field_name else f.id()
+            # The ID keys the stages and the output features of every basin
+            if point_id is None or point_id == NULL:
+                raise QgsProcessingException(
+                    f"Discharge point {f.id()} has no {id_field_name}"
+                )
+            if point_id in seen_ids:
+                raise QgsProcessingException(
+                    f"Several discharge points have the {id_field_name} {point_id}"
+                )
+            seen_ids.add(point_id)
+            point = f.geometry().asPoint()
+            row, col = world_to_cell(geotransform, point.x(), point.y())
+            if not (0 <= row < rows and 0 <= col < cols and valid[row, col]):
+                feedback.reportError(
+                    f"Discharge point {point_id} is outside the DEM, skipped", False
+                )
+                continue
+            cell = row * cols + col
+            if cell in seeds:
+                feedback.reportError(
+                    f"Discharge point {point_id} falls on the same cell as point {point_ids[seeds.index(cell)]}, skipped",
+                    False,
+                )
+                continue
+            point_ids.append(point_id)
+            seeds.append(cell)
+        if not seeds:
+            raise QgsProcessingException("No discharge point falls on the DEM")
+        del valid
+
+        # Upslope areas of all the points at once: every cell is labelled with the first
+        # point downstream of it, nested basins are unions of these labels
+        labels, members = hydrology.nested_basins(
+            hydrology.downstream_index(fdir), np.array(seeds, dtype=np.int64)
+        )
+        del fdir
+
+        feedback.setCurrentStep(1)
+        if feedback.isCanceled():
+            return {}
+
+        if delineation == DELINEATION_TRACE:
+            # Outline of every full basin, traced straight from the label grid
+            geometries = self.trace_basins(labels, members, (rows, cols), geotransform)
+            del labels
+        else:
+            geometries = self.polygonize_basins(
+                parameters,
+                context,
+                feedback,
+                labels.reshape(rows, cols),
+                members,
+                geotransform,
+                projection,
+                pipeline,
+                cache,
+            )
+            if geometries is None:
+                return {}
+
+        feedback.setCurrentStep(2)
+        if feedback.isCanceled():
+            return {}
+
+        fields = QgsFields()
+        fields.append(id_field)
+        fields.append(QgsField("Area (sq. Km)", QVariant.Double))
+        fields.append(QgsField("Perimeter (Km)", QVariant.Double))
+        (sink, dest_id) = self.parameterAsSink(
+            parameters,
+            "UpslopeBasin",
+            context,
+            fields,
+            QgsWkbTypes.MultiPolygon,
+            dem_layer.crs(),
+        )
+        basins = []
+        for point_id, geometry in zip(point_ids, geometries):
+            if geometry is None or geometry.isEmpty():
+                feedback.reportError(
+                    f"Discharge point {point_id} has an empty upslope area, skipped",
+                    False,
+                )
+                continue
+            area = geometry.area() / 1000000
+            perimeter = geometry.length() / 1000
+            feat = QgsFeature(fields)
+            feat.setGeometry(geometry)
+            feat.setAttributes([point_id, area, perimeter])
+            sink.addFeature(feat, QgsFeatureSink.FastInsert)
+            basins.append((point_id, feat, area, perimeter))
+        del sink
+        results["UpslopeBasin"] = dest_id
+
+        feedback.setCurrentStep(3)
         if feedback.isCanceled():
             return {}
 
-        # Clip the DEM to the watershed
+        # Clip the DEM to all the watersheds
         alg_params = {
             "ALPHA_BAND": False,
             "CROP_TO_CUTLINE": True,
@@ -286,8 +610,8 @@ class WATStep2(QgsProcessingAlgorithm):
             "EXTRA": "",
             "INPUT": parameters["filled_dem"],
             "KEEP_RESOLUTION": False,
-            "MASK": outputs["GeomeletitikiWatershedAttributes"]["Filtered_Watershed"],
-            "MULTITHREADING": False,
+            "MASK": dest_id,
+            "MULTITHREADING": True,
             "NODATA": None,
             "OPTIONS": "",
             "SET_RESOLUTION": False,
@@ -296,113 +620,320 @@ class WATStep2(QgsProcessingAlgorithm):
             "TARGET_EXTENT": None,
             "X_RESOLUTION": None,
             "Y_RESOLUTION": None,
-            "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT,
+            "OUTPUT": parameters["BasinDEM"],
         }
-        outputs["BasinDEM"] = processing.run(
-            "gdal:cliprasterbymasklayer",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        outputs["BasinDEM"] = run_cached(
+            cache, "gdal:cliprasterbymasklayer", alg_params, context, feedback
         )
         results["BasinDEM"] = outputs["BasinDEM"]["OUTPUT"]
 
-        feedback.setCurrentStep(6)
+        feedback.setCurrentStep(4)
         if feedback.isCanceled():
             return {}
 
-        # Contour lines
-        alg_params = {
-            "GRID": outputs["BasinDEM"]["OUTPUT"],
-            "LINE_PARTS": True,
-            "POLY_PARTS": False,
-            "SCALE": 1,
-            "VERTEX": 0,  # [0] x, y
-            "ZMAX": 1000,
-            "ZMIN": 0,
-            "ZSTEP": 100,
-            "CONTOUR": parameters["BasinContours"],
-        }
-        outputs["ContourLines"] = processing.run(
-            "sagang:contourlines",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        # Per-basin stages, run concurrently across basins
+        inputs = self.basin_inputs(parameters, context, pipeline, cache)
+        graph = TaskGraph()
+        for point_id, feat, area, perimeter in basins:
+            basin_layer = QgsVectorLayer(
+                f"MultiPolygon?crs={dem_layer.crs().authid()}", "basin", "memory"
+            )
+            basin_layer.dataProvider().addFeature(QgsFeature(feat))
+            self.add_basin_stages(
+                graph,
+                f"{point_id}/",
+                inputs,
+                basin_layer,
+                area,
+                perimeter,
+                f"{pour_point_name}_{point_id}",
+                {
+                    "BasinDEM": pipeline.raster("basin_dem"),
+                    "BasinContours": pipeline.vector("contours"),
+                    "BasinChannelNetwork": pipeline.vector("channel_network"),
+                    "Basincn": pipeline.vector("cn"),
+                    "Basincorine": pipeline.vector("corine"),
+                    "Basinscs": pipeline.vector("scs"),
+                },
+            )
+        stages = graph.run(
+            context,
+            feedback,
+            self.parameterAsInt(parameters, "workers", context),
         )
-        results["BasinContours"] = outputs["ContourLines"]["CONTOUR"]
+        if stages is None:
+            return {}
+        outputs.update(stages)
+        keyed = {
+            "BasinContours": [],
+            "BasinChannelNetwork": [],
+            "Basincn": [],
+            "Basincorine": [],
+            "Basinscs": [],
+        }
+        for point_id, _, _, _ in basins:
+            keyed["BasinContours"].append(
+                (point_id, stages[f"{point_id}/BasinContours"])
+            )
+            keyed["BasinChannelNetwork"].append(
+                (point_id, stages[f"{point_id}/BasinChannelNetwork"])
+            )
+            cn = stages[f"{point_id}/Basincn"]
+            keyed["Basincn"].append((point_id, cn["Watershed_CN"]))
+            keyed["Basincorine"].append((point_id, cn["W_Corine"]))
+            keyed["Basinscs"].append((point_id, cn["W_LandUseSCS"]))
 
-        feedback.setCurrentStep(7)
+        feedback.setCurrentStep(5)
         if feedback.isCanceled():
             return {}
 
-        # Clip
+        # Merge the per-basin outputs, keyed by point ID
+        for name, parts in keyed.items():
+            results[name] = merge_keyed(
+                self.parameterAsOutputLayer(parameters, name, context),
+                parts,
+                id_field,
+                context,
+            )
+        return results
+
+    def polygonize_basins(
+        self,
+        parameters,
+        context,
+        feedback,
+        labels,
+        members,
+        geotransform,
+        projection,
+        pipeline,
+        cache=None,
+    ):
+        """
+        Basin polygons of a batch through GDAL: polygonize the label grid, fix, dissolve
+        by label, then merge the labels of each basin.
+        """
+        outputs = {}
+        outputs["UpslopeArea"] = write_raster(
+            QgsProcessingUtils.generateTempFilename("upslope_areas.tif"),
+            labels,
+            geotransform,
+            projection,
+            gdal.GDT_Int32,
+            -1,
+        )
+        del labels
+
+        # Polygonize (raster to vector)
         alg_params = {
-            "INPUT": parameters["channel_network"],
-            "OVERLAY": outputs["GeomeletitikiWatershedAttributes"][
-                "Filtered_Watershed"
-            ],
-            "OUTPUT": parameters["BasinChannelNetwork"],
+            "BAND": 1,
+            "EIGHT_CONNECTEDNESS": False,
+            "EXTRA": "",
+            "FIELD": "DN",
+            "INPUT": outputs["UpslopeArea"],
+            "OUTPUT": parameters["BasinRaw"],
         }
-        outputs["Clip"] = processing.run(
-            "native:clip",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        outputs["BasinRaw"] = run_cached(
+            cache, "gdal:polygonize", alg_params, context, feedback
         )
-        results["BasinChannelNetwork"] = outputs["Clip"]["OUTPUT"]
 
-        feedback.setCurrentStep(8)
-        if feedback.isCanceled():
-            return {}
+        # Fix geometries
+        alg_params = {
+            "INPUT": outputs["BasinRaw"]["OUTPUT"],
+            "METHOD": 1,  # Structure
+            "OUTPUT": pipeline.vector("fixed"),
+        }
+        outputs["FixGeometries"] = run_cached(
+            cache, "native:fixgeometries", alg_params, context, feedback
+        )
 
-        # Geomeletitiki Watershed Stats
+        # Dissolve
         alg_params = {
-            "Area": area,
-            "Clipped_DEM": outputs["BasinDEM"]["OUTPUT"],
-            "Perimeter": perimeter,
-            "Pour_Point_Name": os.path.basename(Pour_Point.source()).split(".")[
-                0
-            ],  # pour_point_name,
+            "FIELD": ["DN"],
+            "INPUT": outputs["FixGeometries"]["OUTPUT"],
+            "SEPARATE_DISJOINT": False,
+            "OUTPUT": pipeline.vector("dissolved"),
         }
-        outputs["GeomeletitikiWatershedStats"] = processing.run(
-            "gwat:watershed_statistics",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        outputs["Dissolve"] = run_cached(
+            cache, "native:dissolve", alg_params, context, feedback
         )
 
-        feedback.setCurrentStep(9)
         if feedback.isCanceled():
-            return {}
-
-        # Watershed Curve Numbers
-        alg_params = {
-            "Conditions": 1,  # Mean
-            "Pour_Point_Name": os.path.basename(Pour_Point.source()).split(".")[0],
-            "Watershed": outputs["GeomeletitikiWatershedAttributes"][
-                "Filtered_Watershed"
-            ],
-            "W_Corine": parameters["Basincorine"],
-            "W_LandUseSCS": parameters["Basinscs"],
-            "Watershed_CN": parameters["Basincn"],
-            "SOIL_LAYER": parameters["SOIL_LAYER"],
-            "LAND_COVER_LAYER": parameters["LAND_COVER_LAYER"],
+            return None
+
+        # Full basin of every point: its own label plus those of the points upstream
+        increments = {}
+        for f in QgsProcessingUtils.mapLayerFromString(
+            outputs["Dissolve"]["OUTPUT"], context
+        ).getFeatures():
+            if f["DN"] >= 0:
+                increments[f["DN"]] = f.geometry()
+
+        geometries = []
+        for basin in members:
+            parts = [increments[m] for m in basin if m in increments]
+            geometry = QgsGeometry.unaryUnion(parts) if parts else None
+            if geometry is not None:
+                geometry.convertToMultiType()
+            geometries.append(geometry)
+        return geometries
+
+    def trace_basins(self, labels, members, shape, geotransform):
+        """
+        Basin polygons of a batch traced from the label grid, one basin at a time on the
+        window of its cells.
+        """
+        rows, cols = shape
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(len(members) + 1))
+        geometries = []
+        for basin in members:
+            cells = np.concatenate([order[bounds[m] : bounds[m + 1]] for m in basin])
+            if not cells.size:
+                geometries.append(None)
+                continue
+            r, c = cells // cols, cells % cols
+            row0, col0 = int(r.min()), int(c.min())
+            mask = np.zeros((int(r.max()) - row0 + 1, int(c.max()) - col0 + 1), bool)
+            mask[r - row0, c - col0] = True
+            geometries.append(mask_geometry(mask, geotransform, row0, col0))
+        return geometries
+
+    def basin_inputs(self, parameters, context, pipeline, cache=None):
+        """
+        Inputs of the per-basin stages, resolved once in the main thread. The stages get
+        their own instances of the layers (see TaskGraph.add).
+        """
+        return {
+            "filled_dem": self.parameterAsRasterLayer(
+                parameters, "filled_dem", context
+            ),
+            "channel_network": self.parameterAsVectorLayer(
+                parameters, "channel_network", context
+            ),
+            "SOIL_LAYER": self.parameterAsVectorLayer(
+                parameters, "SOIL_LAYER", context
+            ),
+            "LAND_COVER_LAYER": self.parameterAsVectorLayer(
+                parameters, "LAND_COVER_LAYER", context
+            ),
+            "cn_overlay": self.parameterAsEnum(parameters, "cn_overlay", context),
+            "contour_intervals": self.parameterAsInt(
+                parameters, "contour_intervals", context
+            ),
+            "contour_interval": self.parameterAsDouble(
+                parameters, "contour_interval", context
+            ),
+            "cache": cache,
+            "pipeline": pipeline,
         }
-        outputs["GeomeletitikiCnCalculator"] = processing.run(
-            "gwat:watershed_cn",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+
+    def add_basin_stages(
+        self, graph, prefix, inputs, basin, area, perimeter, name, destinations
+    ):
+        """
+        Add the stages of one basin to a task graph: DEM clip, then contours and statistics
+        of the clipped DEM; channel network clip and CN only need the basin polygon.
+        Task names are ``prefix`` followed by the output they produce.
+        """
+
+        # Basin outline in the CRS of the DEM, for the in-process clip
+        dem = inputs["filled_dem"]
+        outline = QgsGeometry.unaryUnion([f.geometry() for f in basin.getFeatures()])
+        if basin.crs() != dem.crs():
+            outline.transform(
+                QgsCoordinateTransform(basin.crs(), dem.crs(), QgsProject.instance())
+            )
+        box = outline.boundingBox()
+        outline_wkb = bytes(outline.asWkb())
+        outline_extent = (
+            box.xMinimum(),
+            box.yMinimum(),
+            box.xMaximum(),
+            box.yMaximum(),
         )
-        results["Basincn"] = outputs["GeomeletitikiCnCalculator"]["Watershed_CN"]
-        # results["Basincorine"] = outputs["GeomeletitikiCnCalculator"]["W_Corine"]
-        # results["Basinscs"] = outputs["GeomeletitikiCnCalculator"]["W_LandUseSCS"]
 
-        return results
+        def clip_dem(context, feedback, results, layers):
+            # Clip the DEM to the watershed, by cell centre, on the DEM's own grid
+            return clip_to_polygon(
+                dem.source(), outline_wkb, outline_extent, destinations["BasinDEM"]
+            )
+
+        def contours(context, feedback, results, layers):
+            # Contour lines, at levels spanning the basin's own elevations
+            alg_params = {
+                "INPUT": raster_input(results[prefix + "BasinDEM"], "BasinDEM"),
+                "INTERVALS": inputs["contour_intervals"],
+                "INTERVAL": inputs["contour_interval"],
+                "OUTPUT": destinations["BasinContours"],
+            }
+            return run_cached(
+                inputs["cache"],
+                "gwat:basin_contours",
+                alg_params,
+                context,
+                feedback,
+            )["OUTPUT"]
+
+        def clip_channels(context, feedback, results, layers):
+            # Clip
+            alg_params = {
+                "INPUT": layers["channel_network"],
+                "OVERLAY": layers["basin"],
+                "OUTPUT": destinations["BasinChannelNetwork"],
+            }
+            return run_cached(
+                inputs["cache"],
+                "native:clip",
+                alg_params,
+                context,
+                feedback,
+            )["OUTPUT"]
+
+        def statistics(context, feedback, results, layers):
+            # Geomeletitiki Watershed Stats, not cached: the report is written every run
+            alg_params = {
+                "Area": area,
+                "Clipped_DEM": raster_input(results[prefix + "BasinDEM"], "BasinDEM"),
+                "Perimeter": perimeter,
+                "Pour_Point_Name": name,
+            }
+            return run_child(
+                "gwat:watershed_statistics", alg_params, context, feedback
+            )["Watershed_Stats"]
+
+        def curve_numbers(context, feedback, results, layers):
+            # Watershed Curve Numbers, not cached: the CN report is written every run
+            alg_params = {
+                "Conditions": 1,  # Mean
+                "Overlay": inputs["cn_overlay"],
+                "Pour_Point_Name": name,
+                "Watershed": layers["basin"],
+                "W_Corine": destinations["Basincorine"],
+                "W_LandUseSCS": destinations["Basinscs"],
+                "Watershed_CN": destinations["Basincn"],
+                "SOIL_LAYER": layers["SOIL_LAYER"],
+                "LAND_COVER_LAYER": layers["LAND_COVER_LAYER"],
+            }
+            return run_child("gwat:watershed_cn", alg_params, context, feedback)
+
+        graph.add(prefix + "BasinDEM", clip_dem)
+        graph.add(prefix + "BasinContours", contours, [prefix + "BasinDEM"])
+        graph.add(
+            prefix + "BasinChannelNetwork",
+            clip_channels,
+            layers={"channel_network": inputs["channel_network"], "basin": basin},
+        )
+        graph.add(prefix + "Stats", statistics, [prefix + "BasinDEM"])
+        graph.add(
+            prefix + "Basincn",
+            curve_numbers,
+            layers={
+                "basin": basin,
+                "SOIL_LAYER": inputs["SOIL_LAYER"],
+                "LAND_COVER_LAYER": inputs["LAND_COVER_LAYER"],
+            },
+        )
 
     def name(self):
         return "step_2"
@@ -0,0 +1,113 @@
+from osgeo import gdal
+
+from qgis.core import QgsProcessing
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingParameterRasterLayer
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterFeatureSink
+from qgis.core import QgsFeature, QgsFeatureSink, QgsField, QgsFields
+from qgis.core import QgsGeometry, QgsPointXY, QgsWkbTypes
+from qgis.PyQt.QtCore import QVariant
+
+from gwat.utils.contours import contour_levels, contour_lines
+from gwat.utils.parallel import worker_count
+
+
+class BasinContours(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterRasterLayer("INPUT", "DEM", defaultValue=None)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                "INTERVALS",
+                "Number of intervals between the DEM minimum and maximum",
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=10,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                "INTERVAL",
+                "Contour interval (m, 0: from the number of intervals)",
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                defaultValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                "OUTPUT",
+                "Contours",
+                type=QgsProcessing.TypeVectorLine,
+                createByDefault=True,
+                defaultValue=None,
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        dem = self.parameterAsRasterLayer(parameters, "INPUT", context)
+        path = dem.source()
+
+        # Levels from the DEM's own range
+        ds = gdal.Open(path, gdal.GA_ReadOnly)
+        z_min, z_max = ds.GetRasterBand(1).ComputeRasterMinMax(False)
+        ds = None
+        levels = contour_levels(
+            z_min,
+            z_max,
+            self.parameterAsInt(parameters, "INTERVALS", context),
+            self.parameterAsDouble(parameters, "INTERVAL", context),
+        )
+        feedback.pushInfo(
+            f"{len(levels)} levels from {levels[0] if levels else '-'} "
+            f"to {levels[-1] if levels else '-'}"
+        )
+
+        fields = QgsFields()
+        fields.append(QgsField("ID", QVariant.Int))
+        fields.append(QgsField("Z", QVariant.Double))
+        sink, dest_id = self.parameterAsSink(
+            parameters,
+            "OUTPUT",
+            context,
+            fields,
+            QgsWkbTypes.LineString,
+            dem.crs(),
+        )
+
+        for n, (level, coords) in enumerate(
+            contour_lines(path, levels, workers=worker_count(), feedback=feedback)
+        ):
+            feature = QgsFeature(fields)
+            feature.setGeometry(
+                QgsGeometry.fromPolylineXY(
+                    [QgsPointXY(x, y) for x, y in coords.tolist()]
+                )
+            )
+            feature.setAttributes([n + 1, float(level)])
+            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+        if feedback.isCanceled():
+            return {}
+
+        return {"OUTPUT": dest_id}
+
+    def name(self):
+        return "basin_contours"
+
+    def displayName(self):
+        return "Basin Contours"
+
+    def group(self):
+        return "submodules"
+
+    def groupId(self):
+        return "submodules"
+
+    def shortHelpString(self):
+        return "Contour lines of a (clipped) DEM, at round levels spanning its own elevation range: either a fixed interval or about the requested number of intervals between the DEM minimum and maximum.\n\nThe lines are traced by marching squares in parallel bands of rows; nodata cells are left out, so the lines stop at the basin boundary."
+
+    def createInstance(self):
+        return BasinContours()
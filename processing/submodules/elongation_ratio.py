@@ -48,17 +48,18 @@ class ElongationRatio(QgsProcessingAlgorithm):
         )
 
     def processAlgorithm(self, parameters, context, model_feedback):
-        # Create the output fields form
-        outFields = QgsFields()
+        basin = self.parameterAsVectorLayer(parameters, "BASIN", context)
+        channels = self.parameterAsVectorLayer(parameters, "CHANNELS", context)
+
+        # Create the output fields form: the fields of the channels (e.g. the path cost)
+        # followed by the length and Re
+        outFields = QgsFields(channels.fields())
         outFields.append(
             QgsField("Stream Length (Km)", QVariant.Double, len=20, prec=5)
         )
         outFields.append(
             QgsField("Elongation Ratio (Re)", QVariant.Double, len=20, prec=5)
         )
-
-        basin = self.parameterAsVectorLayer(parameters, "BASIN", context)
-        channels = self.parameterAsVectorLayer(parameters, "CHANNELS", context)
         (sink, dest_id) = self.parameterAsSink(
             parameters,
             "OUTPUT",
@@ -73,6 +74,7 @@ class ElongationRatio(QgsProcessingAlgorithm):
 
             out_feat = QgsFeature(outFields)
             out_feat.setGeometry(feature.geometry())
+            out_feat.setAttributes(feature.attributes() + [None, None])
 
             # Calculate Re:                                          # Re=2/Length*sqrt(Area/pi)
             b = basin.getFeature(0)
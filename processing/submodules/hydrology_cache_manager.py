@@ -0,0 +1,92 @@
+import time
+
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingOutputNumber
+from qgis.core import QgsProcessingOutputString
+
+from gwat.utils.artifact_cache import ArtifactCache
+from gwat.utils.hydrology_cache import HydrologyCache
+
+
+ACTIONS = ["Inspect", "Evict down to the size limit", "Purge everything"]
+ACTION_INSPECT = 0
+ACTION_EVICT = 1
+ACTION_PURGE = 2
+
+CACHES = ["Hydrology (Step 1 grids)", "Artifacts (Step 2 child outputs)"]
+CACHE_HYDROLOGY = 0
+CACHE_ARTIFACTS = 1
+
+
+class HydrologyCacheManager(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                "cache", "Cache", options=CACHES, defaultValue=CACHE_HYDROLOGY
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                "action", "Action", options=ACTIONS, defaultValue=ACTION_INSPECT
+            )
+        )
+        self.addOutput(QgsProcessingOutputString("summary", "Summary"))
+        self.addOutput(QgsProcessingOutputNumber("entries", "Entries"))
+        self.addOutput(QgsProcessingOutputNumber("size_mb", "Size (MB)"))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        action = self.parameterAsEnum(parameters, "action", context)
+        cache = (
+            ArtifactCache()
+            if self.parameterAsEnum(parameters, "cache", context) == CACHE_ARTIFACTS
+            else HydrologyCache()
+        )
+
+        if action == ACTION_PURGE:
+            cache.purge()
+            feedback.pushInfo(f"Purged {cache.root}")
+        elif action == ACTION_EVICT:
+            evicted = cache.evict()
+            feedback.pushInfo(f"Evicted {len(evicted)} entries")
+
+        entries = cache.entries()
+        size_mb = sum(meta["size"] for meta in entries) / 2**20
+        lines = [
+            f"{cache.root}: {len(entries)} entries, {size_mb:.1f} of {cache.max_bytes / 2**20:.0f} MB"
+        ]
+        for meta in entries:
+            lines.append(
+                "{key}  {engine:<6}  {size:>9.1f} MB  hits: {hits:<4}  last used: {last_used}  {dem}".format(
+                    key=meta["key"],
+                    engine=meta.get("engine", meta.get("algorithm", "")),
+                    size=meta["size"] / 2**20,
+                    hits=meta.get("hits", 0),
+                    last_used=time.strftime(
+                        "%Y-%m-%d %H:%M", time.localtime(meta["last_used"])
+                    ),
+                    dem=meta.get("dem", ""),
+                )
+            )
+        summary = "\n".join(lines)
+        feedback.pushInfo(summary)
+        return {"summary": summary, "entries": len(entries), "size_mb": size_mb}
+
+    def name(self):
+        return "hydrology_cache"
+
+    def displayName(self):
+        return "Hydrology Cache"
+
+    def group(self):
+        return "submodules"
+
+    def groupId(self):
+        return "submodules"
+
+    def shortHelpString(self):
+        return "Inspect, trim or purge the cache of filled DEMs, flow directions and catchment areas reused by Step 1 across runs on the same DEM, or of the child algorithm outputs reused by Step 2 across runs with unchanged inputs.\n\nThe caches live in the <i>hydrology_cache</i> and <i>artifact_cache</i> folders of the plugin output folder; their size limits are the <i>hydrology_cache_max_mb</i> and <i>artifact_cache_max_mb</i> settings."
+
+    def createInstance(self):
+        return HydrologyCacheManager()
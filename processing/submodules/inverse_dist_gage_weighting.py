@@ -6,9 +6,6 @@ from qgis.core import (
     QgsFeatureSink,
     QgsField,
     QgsFields,
-    QgsExpressionContext,
-    QgsExpressionContextUtils,
-    QgsExpression,
     QgsProcessingParameterNumber,
     QgsFeature,
 )
@@ -20,6 +17,8 @@ try:
 except:
     from qgis import processing
 
+from gwat.utils.idf import idgw, station_arrays
+
 
 class InverseDistGageWeighting(QgsProcessingAlgorithm):
 
@@ -93,44 +92,16 @@ class InverseDistGageWeighting(QgsProcessingAlgorithm):
             source.wkbType(),
             source.sourceCrs(),
         )
-        features = source.getFeatures()
-
-        context = QgsExpressionContext()
-        context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source))
+        # Load the station parameters once, then compute for all stations at once
+        features = list(source.getFeatures())
+        T = self.parameterAsInt(parameters, "ReturnPeriod", context)
+        d_v = self.parameterAsDouble(parameters, "RainfallDuration", context)
+        weighting = idgw(station_arrays(features), T, d_v)
 
-        for _, feature in enumerate(features):
+        for n, feature in enumerate(features):
             out_feat = QgsFeature(outFields)
             out_feat.setGeometry(feature.geometry())
 
-            k = feature["κ"]
-            l = feature["λ΄"]
-            psi = feature["ψ΄"]
-            theta = feature["θ"]
-            eta = feature["η"]
-            D = feature["Distance"] / 1000
-
-            T = parameters["ReturnPeriod"]
-            d_v = parameters["RainfallDuration"]
-
-            a_T = l * ((T**k) - psi)
-            print(a_T)
-            reverse_d_sq = 1 / (D**2)
-
-            context.setFeature(feature)
-
-            total_distance = QgsExpression(
-                'sum(1/(("Distance"/1000)*("Distance"/1000)))'
-            ).evaluate(context)
-
-            print(total_distance)
-            weight = reverse_d_sq / total_distance
-
-            i = a_T / ((1 + (d_v / theta)) ** eta)
-
-            S_i = weight * i
-
-            ###########
-
             out_feat["ΥΔ"] = feature["ΥΔ"]
             out_feat["ΚΩΔΙΚΟΣ"] = feature["ΚΩΔΙΚΟΣ"]
             out_feat["ΟΝΟΜΑ"] = feature["ΟΝΟΜΑ"]
@@ -145,14 +116,12 @@ class InverseDistGageWeighting(QgsProcessingAlgorithm):
             out_feat["θ"] = feature["θ"]
             out_feat["η"] = feature["η"]
 
-            out_feat["α(Τ)"] = a_T
-            out_feat["Απόσταση (Km)"] = D
-            out_feat["1/d2"] = reverse_d_sq
-            out_feat["Wi"] = weight
-            out_feat["i (mm/hr)"] = i
-            out_feat["Σταθμισμένη i (mm/hr)"] = S_i
-
-            print(S_i)
+            out_feat["α(Τ)"] = float(weighting["a"][n])
+            out_feat["Απόσταση (Km)"] = float(weighting["distance"][n])
+            out_feat["1/d2"] = float(weighting["inverse_distance_sq"][n])
+            out_feat["Wi"] = float(weighting["weight"][n])
+            out_feat["i (mm/hr)"] = float(weighting["intensity"][n])
+            out_feat["Σταθμισμένη i (mm/hr)"] = float(weighting["weighted"][n])
 
             sink.addFeature(out_feat, QgsFeatureSink.FastInsert)
 
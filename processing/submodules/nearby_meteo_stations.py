@@ -1,21 +1,14 @@
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import QgsProcessing
 from qgis.core import QgsProcessingAlgorithm
-from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterVectorLayer
 from qgis.core import QgsProcessingParameterFeatureSink
-from qgis.core import QgsExpression, QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsCoordinateTransform
+from qgis.core import QgsFeature, QgsFeatureSink, QgsField, QgsFields, QgsWkbTypes
+from qgis.PyQt.QtCore import QVariant
 
-try:
-    from qgis import processing
-except:
-    import processing
-import os
-
-currentPath = os.path.dirname(__file__)
-basePath = os.path.dirname(currentPath)
-
-from gwat.utils.settings import meteo_stations_path
+from gwat.utils.meteo_stations import StationIndex
 
 
 class NearbyMeteoStations(QgsProcessingAlgorithm):
@@ -78,109 +71,44 @@ class NearbyMeteoStations(QgsProcessingAlgorithm):
         )
 
     def processAlgorithm(self, parameters, context, model_feedback):
-        meteo_path = meteo_stations_path()
-
-        feedback = QgsProcessingMultiStepFeedback(4, model_feedback)
-        results = {}
-        outputs = {}
-
-        # Centroids
-        alg_params = {
-            "ALL_PARTS": False,
-            "INPUT": parameters["Basin"],
-            "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT,
-        }
-        outputs["Centroids"] = processing.run(
-            "native:centroids",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-
-        feedback.setCurrentStep(1)
-        if feedback.isCanceled():
-            return {}
-
-        # Add Index to the Basin
-        alg_params = {
-            "FIELD_NAME": "Fid",
-            "GROUP_FIELDS": [""],
-            "INPUT": outputs["Centroids"]["OUTPUT"],
-            "SORT_ASCENDING": True,
-            "SORT_EXPRESSION": "",
-            "SORT_NULLS_FIRST": False,
-            "START": 0,
-            "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT,
-        }
-        outputs["AddAutoincrementalField"] = processing.run(
-            "native:addautoincrementalfield",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-
-        # Distance matrix
-        alg_params = {
-            "INPUT": outputs["AddAutoincrementalField"]["OUTPUT"],
-            "INPUT_FIELD": QgsExpression("'Fid'").evaluate(),
-            "MATRIX_TYPE": 0,
-            "NEAREST_POINTS": parameters["Number_of_Stations"],
-            "TARGET": meteo_path,
-            "TARGET_FIELD": QgsExpression("'fid'").evaluate(),
-            "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT,
-        }
-        outputs["DistanceMatrix"] = processing.run(
-            "qgis:distancematrix",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-
-        feedback.setCurrentStep(2)
-        if feedback.isCanceled():
-            return {}
-
-        # Extract by location
-        alg_params = {
-            "INPUT": meteo_path,
-            "INTERSECT": outputs["DistanceMatrix"]["OUTPUT"],
-            "PREDICATE": [0],
-            "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT,
-        }
-        outputs["ExtractByLocation"] = processing.run(
-            "native:extractbylocation",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        stations = StationIndex.load()
+        basin = self.parameterAsVectorLayer(parameters, "Basin", context)
+        n = self.parameterAsInt(parameters, "Number_of_Stations", context)
+
+        # Same fields as the stations joined to their distance matrix entry
+        fields = QgsFields(stations.fields)
+        fields.append(QgsField("InputID", QVariant.Int))
+        fields.append(QgsField("TargetID", QVariant.Int))
+        fields.append(QgsField("Distance", QVariant.Double))
+        (sink, dest_id) = self.parameterAsSink(
+            parameters,
+            "NearestStations",
+            context,
+            fields,
+            QgsWkbTypes.Point,
+            stations.crs,
         )
 
-        feedback.setCurrentStep(3)
-        if feedback.isCanceled():
-            return {}
-
-        # Join attributes by location
-        alg_params = {
-            "DISCARD_NONMATCHING": False,
-            "INPUT": outputs["ExtractByLocation"]["OUTPUT"],
-            "JOIN": outputs["DistanceMatrix"]["OUTPUT"],
-            "JOIN_FIELDS": [""],
-            "METHOD": 1,
-            "PREDICATE": [0],
-            "PREFIX": "",
-            "OUTPUT": parameters["NearestStations"],
-        }
-
-        outputs["JoinAttributesByLocation"] = processing.run(
-            "native:joinattributesbylocation",
-            alg_params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        transform = QgsCoordinateTransform(
+            basin.crs(), stations.crs, context.transformContext()
         )
-        results["NearestStations"] = outputs["JoinAttributesByLocation"]["OUTPUT"]
 
-        return results
+        # The nearest stations of every basin centroid; a station near several basins is
+        # reported once, for the first of them
+        matches = {}
+        for basin_id, feature in enumerate(basin.getFeatures()):
+            centroid = feature.geometry().centroid()
+            centroid.transform(transform)
+            ids, distances = stations.nearest(centroid.asPoint(), n)
+            for fid, distance in zip(ids, distances):
+                matches.setdefault(fid, (basin_id, distance))
+
+        for fid in sorted(matches):
+            basin_id, distance = matches[fid]
+            station = stations.features[fid]
+            out_feat = QgsFeature(fields)
+            out_feat.setGeometry(station.geometry())
+            out_feat.setAttributes(station.attributes() + [basin_id, fid, distance])
+            sink.addFeature(out_feat, QgsFeatureSink.FastInsert)
+
+        return {"NearestStations": dest_id}
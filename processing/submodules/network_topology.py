@@ -0,0 +1,163 @@
+from qgis.PyQt.QtCore import QCoreApplication, QVariant
+from qgis.core import (
+    QgsFeature,
+    QgsFeatureSink,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsPointXY,
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingOutputNumber,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterVectorLayer,
+    QgsWkbTypes,
+)
+
+from gwat.utils.networks import NetworkIndex
+
+
+class NetworkTopology(QgsProcessingAlgorithm):
+    """
+    Build (or refresh) the topology index of a channel network and export its nodes
+    """
+
+    INPUT = "ChannelNetwork"
+    REBUILD = "Rebuild"
+    SPRINGS = "Springs"
+    JUNCTIONS = "Junctions"
+
+    def tr(self, string):
+        return QCoreApplication.translate("Processing", string)
+
+    def createInstance(self):
+        return NetworkTopology()
+
+    def name(self):
+        return "network_topology"
+
+    def displayName(self):
+        return self.tr("Channel Network Topology")
+
+    def group(self):
+        return self.tr("submodules")
+
+    def groupId(self):
+        return "submodules"
+
+    def shortHelpString(self):
+        return self.tr(
+            "Springs, junctions and segment adjacency of a channel network (e.g. the Channel Network vector of Step 1, digitized downstream). "
+            "The index is stored next to the network file and reused by later runs, e.g. by the Longest Flow Path, until the network changes."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.INPUT,
+                self.tr("Channel Network"),
+                types=[QgsProcessing.TypeVectorLine],
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.REBUILD, self.tr("Force rebuilding the index"), defaultValue=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.SPRINGS,
+                self.tr("Springs"),
+                QgsProcessing.TypeVectorPoint,
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.JUNCTIONS,
+                self.tr("Junctions"),
+                QgsProcessing.TypeVectorPoint,
+                optional=True,
+            )
+        )
+        self.addOutput(QgsProcessingOutputNumber("segments", self.tr("Segments")))
+        self.addOutput(QgsProcessingOutputNumber("springs", self.tr("Springs")))
+        self.addOutput(QgsProcessingOutputNumber("junctions", self.tr("Junctions")))
+        self.addOutput(QgsProcessingOutputNumber("outlets", self.tr("Outlets")))
+        self.addOutput(
+            QgsProcessingOutputNumber("total_length", self.tr("Total length (Km)"))
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        channels = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        index = NetworkIndex.for_layer(
+            channels, rebuild=self.parameterAsBool(parameters, self.REBUILD, context)
+        )
+        springs, junctions, outlets = (
+            index.springs(),
+            index.junctions(),
+            index.outlets(),
+        )
+
+        results = {
+            "segments": len(index),
+            "springs": len(springs),
+            "junctions": len(junctions),
+            "outlets": len(outlets),
+            "total_length": sum(index.lengths) / 1000,
+        }
+
+        # Springs, with the channel leaving them
+        fields = QgsFields()
+        fields.append(QgsField("SegmentID", QVariant.Int))
+        fields.append(QgsField("Downstream", QVariant.Int))
+        sink, dest_id = self.parameterAsSink(
+            parameters,
+            self.SPRINGS,
+            context,
+            fields,
+            QgsWkbTypes.Point,
+            channels.crs(),
+        )
+        if sink is not None:
+            for s in index.spring_segments():
+                downstream = index.downstream[s]
+                feat = QgsFeature(fields)
+                feat.setGeometry(
+                    QgsGeometry.fromPointXY(QgsPointXY(*index.point(index.node_a[s])))
+                )
+                feat.setAttributes(
+                    [
+                        index.segment_ids[s],
+                        index.segment_ids[downstream[0]] if downstream else None,
+                    ]
+                )
+                sink.addFeature(feat, QgsFeatureSink.FastInsert)
+            results[self.SPRINGS] = dest_id
+
+        # Junctions, with the number of tributaries
+        fields = QgsFields()
+        fields.append(QgsField("Tributaries", QVariant.Int))
+        sink, dest_id = self.parameterAsSink(
+            parameters,
+            self.JUNCTIONS,
+            context,
+            fields,
+            QgsWkbTypes.Point,
+            channels.crs(),
+        )
+        if sink is not None:
+            for n in junctions:
+                feat = QgsFeature(fields)
+                feat.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(*index.point(n))))
+                feat.setAttributes([index.in_degree[n]])
+                sink.addFeature(feat, QgsFeatureSink.FastInsert)
+            results[self.JUNCTIONS] = dest_id
+
+        feedback.pushInfo(
+            "{segments} segments, {springs} springs, {junctions} junctions, {outlets} outlets, {total_length:.3f} Km".format(
+                **results
+            )
+        )
+        return results
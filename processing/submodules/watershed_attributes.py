@@ -5,6 +5,7 @@ from qgis.core import (
     QgsFeature,
     QgsProcessingParameterPoint,
     QgsProcessingOutputString,
+    QgsProcessingOutputNumber,
     QgsFeatureSink,
     QgsFeatureRequest,
     QgsFields,
@@ -68,6 +69,8 @@ class WatershedAttributes(QgsProcessingAlgorithm):
         self.addOutput(
             QgsProcessingOutputString(self.AreaPer, self.tr("Area_Perimeter"))
         )
+        self.addOutput(QgsProcessingOutputNumber("Area", self.tr("Area (sq. Km)")))
+        self.addOutput(QgsProcessingOutputNumber("Perimeter", self.tr("Perimeter (Km)")))
 
     def processAlgorithm(self, parameters, context, feedback):
         # Define output features
@@ -93,8 +96,6 @@ class WatershedAttributes(QgsProcessingAlgorithm):
         area_per = None
         features = source.getFeatures(QgsFeatureRequest())
         for feat in features:
-            area = (feat.geometry().area()) / 1000000
-            perimeter = (feat.geometry().length()) / 1000
             out_feat = QgsFeature(outFields)
             out_feat.setGeometry(feat.geometry())
             if feat.geometry().contains(pourpoint):
@@ -107,4 +108,9 @@ class WatershedAttributes(QgsProcessingAlgorithm):
             else:
                 None
 
-        return {self.OUTPUT: dest_id, self.AreaPer: area_per}
+        return {
+            self.OUTPUT: dest_id,
+            self.AreaPer: area_per,
+            "Area": area,
+            "Perimeter": perimeter,
+        }
@@ -1,7 +1,8 @@
-from collections import defaultdict
 from datetime import datetime
+import math
 import os
-import csv
+
+import numpy as np
 
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (
@@ -18,15 +19,18 @@ from qgis.core import (
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterEnum,
+    QgsFeatureRequest,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterRasterDestination,
+    QgsProcessingUtils,
+    QgsWkbTypes,
 )
 
 from qgis.core import QgsFields, QgsField
 
-try:
-    from qgis import processing
-except:
-    import processing
 from PyQt5.QtCore import QVariant
+from osgeo import gdal
 
 from gwat.utils.files import get_plugin_output_dir, get_or_create_path
 
@@ -34,7 +38,24 @@ from gwat.utils.files import get_plugin_output_dir, get_or_create_path
 currentPath = os.path.dirname(__file__)
 basePath = os.path.dirname(currentPath)
 
-from gwat.utils.settings import cn_conditions_dir
+from gwat.utils.curve_number import (
+    CONDITIONS,
+    CORINE_CODES,
+    CORINE_DESCRIPTIONS,
+    CORINE_LAND_USE,
+    GEO_CODES,
+    GEO_GROUP,
+    HYDRO_GROUPS,
+    cn_table,
+    code_index,
+    curve_numbers,
+    overlay_grid,
+)
+from gwat.utils.rasters import rasterize, write_raster
+from gwat.utils.settings import get_setting
+from gwat.utils.tracing import run_child
+from gwat.utils.vectors import extent_subset, mask_geometry
+from gwat.utils.wfs_mirror import WfsMirror
 
 
 class WatershedCN(QgsProcessingAlgorithm):
@@ -46,6 +67,13 @@ class WatershedCN(QgsProcessingAlgorithm):
     watershed_land_cover_output = "W_Corine"
     watershed_soil_output = "W_LandUseSCS"
     Pour_Point_Name = "Pour_Point_Name"
+    OVERLAY = "Overlay"
+    OVERLAYS = ["Vector (polygon union)", "Raster"]
+    OVERLAY_VECTOR = 0
+    OVERLAY_RASTER = 1
+    CELL_SIZE = "CellSize"
+    CN_POLYGONS = "CnPolygons"
+    CN_GRID = "CN_Grid"
 
     def tr(self, string):
         return QCoreApplication.translate("Processing", string)
@@ -107,6 +135,31 @@ class WatershedCN(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OVERLAY,
+                self.tr("Overlay"),
+                options=self.OVERLAYS,
+                defaultValue=self.OVERLAY_VECTOR,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CELL_SIZE,
+                self.tr("Raster overlay cell size"),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0.01,
+                defaultValue=get_setting("cn_raster_cell_size") or 10,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.CN_POLYGONS,
+                self.tr("Raster overlay: build the CN polygons"),
+                defaultValue=True,
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr("Watershed with CN"))
         )
@@ -121,6 +174,14 @@ class WatershedCN(QgsProcessingAlgorithm):
                 self.watershed_soil_output, self.tr("Watershed with SCS Classes")
             )
         )
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                self.CN_GRID,
+                self.tr("CN grid (raster overlay)"),
+                optional=True,
+                createByDefault=False,
+            )
+        )
 
     def processAlgorithm(self, parameters, context, feedback):
 
@@ -139,64 +200,90 @@ class WatershedCN(QgsProcessingAlgorithm):
             "-------------------------------------------------------------------------\n"
         )
 
+        # Read only the features around the basin from the (national) layers, from their
+        # local mirror when they are the WFS layers and it is complete
+        watershed = self.parameterAsVectorLayer(parameters, "Watershed", context)
+        mirror = WfsMirror()
+        soil = extent_subset(
+            mirror.substitute(
+                self.parameterAsVectorLayer(parameters, "SOIL_LAYER", context)
+            ),
+            watershed.extent(),
+            watershed.crs(),
+            context,
+            feedback,
+        )
+        land_cover = extent_subset(
+            mirror.substitute(
+                self.parameterAsVectorLayer(parameters, "LAND_COVER_LAYER", context)
+            ),
+            watershed.extent(),
+            watershed.crs(),
+            context,
+            feedback,
+        )
+        if feedback.isCanceled():
+            return {}
+
         alg_params = {
             # "INPUT": "pagingEnabled='true' preferCoordinatesForWfsT11='false' restrictToRequestBBOX='1' srsname='EPSG:2100' typename='geonode:edafmap_1997_7' url='http://mapsportal.ypen.gr/geoserver/ows' version='auto'",
-            "INPUT": self.parameterAsVectorLayer(parameters, "SOIL_LAYER", context),
-            "OVERLAY": self.parameterAsVectorLayer(parameters, "Watershed", context),
+            "INPUT": soil,
+            "OVERLAY": watershed,
             "OUTPUT": parameters["W_LandUseSCS"],
         }
-        soil_layer = processing.run(
+        soil_layer = run_child(
             "native:clip",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
 
         # Clip
         alg_params = {
             # "INPUT": "pagingEnabled='true' preferCoordinatesForWfsT11='false' restrictToRequestBBOX='1' srsname='EPSG:2100' typename='geonode:gr_clc2018' url='http://mapsportal.ypen.gr/geoserver/ows' version='auto'",
-            "INPUT": self.parameterAsVectorLayer(
-                parameters, "LAND_COVER_LAYER", context
-            ),
-            "OVERLAY": self.parameterAsVectorLayer(parameters, "Watershed", context),
+            "INPUT": land_cover,
+            "OVERLAY": watershed,
             "OUTPUT": parameters["W_Corine"],
         }
-        land_cover_layer = processing.run(
+        land_cover_layer = run_child(
             "native:clip",
             alg_params,
             context=context,
             feedback=feedback,
-            is_child_algorithm=True,
         )
 
         if feedback.isCanceled():
             return {}
 
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                "Union",
-                self.tr("Watershed"),
-                types=[QgsProcessing.TypeVectorAnyGeometry],
-            )
-        )
+        # Choose conditions
+        conditions_index = self.parameterAsEnum(parameters, "Conditions", context)
+        conditions = CONDITIONS[conditions_index]
+        table = cn_table(conditions_index)
 
-        Union = processing.run(
-            "sagang:polygonunion",
-            {
-                "A": land_cover_layer["OUTPUT"],
-                "B": soil_layer["OUTPUT"],
-                "RESULT": "TEMPORARY_OUTPUT",
-                "SPLIT": True,
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback,
-        )
+        basin_area = None
+        for f in watershed.getFeatures():
+            basin_area = f.geometry().area()
 
-        # 4. Calculate CN
-        # Put intersections in a layer and add CN field
-        cn_labels = QgsVectorLayer(Union["RESULT"], "", "ogr")
+        overlay = self.parameterAsEnum(parameters, self.OVERLAY, context)
+        if overlay == self.OVERLAY_RASTER:
+            geometries, corine_codes, geo_codes, areas, cn_grid = self.raster_overlay(
+                parameters,
+                context,
+                watershed,
+                land_cover_layer["OUTPUT"],
+                soil_layer["OUTPUT"],
+                table,
+            )
+            wkb_type, crs = QgsWkbTypes.MultiPolygon, watershed.crs()
+        else:
+            geometries, corine_codes, geo_codes, areas, cn_labels = self.vector_overlay(
+                context, feedback, land_cover_layer["OUTPUT"], soil_layer["OUTPUT"]
+            )
+            wkb_type, crs = cn_labels.wkbType(), cn_labels.crs()
+            cn_grid = None
+
+        if feedback.isCanceled():
+            return {}
 
         out_fields = QgsFields()
 
@@ -214,174 +301,33 @@ class WatershedCN(QgsProcessingAlgorithm):
             self.OUTPUT,
             context,
             out_fields,
-            cn_labels.wkbType(),
-            cn_labels.crs(),
+            wkb_type,
+            crs,
         )
 
-        geo_to_abcd_dict = {
-            "Y": "A",
-            "F": "A",
-            "R": "B",
-            "C": "C",
-            "T": "D",
-            "P": "C",
-            "X": "A",
-            "Z": "B",
-            "N": "B",
-            "A": "D",
-            "K": "A",
-            "H": "A",
-            "J": "C",
-            "V": "A",
-            "W": "C",
-            "L": "C",
-            "S": "B",
-            "E": "D",
-            "B": "A",
-            "M": "B",
-        }
-
-        corine_to_1_7_dict = {
-            "111": ["Συνεχής αστικός ιστός", 6],
-            "112": ["Ασυνεχής αστικός ιστός", 6],
-            "121": ["Βιομηχανικές ή εμπορικές ζώνες", 5],
-            "122": ["Οδικά & σιδηροδρομικά δίκτυα", 7],
-            "123": ["Ζώνες λιμένων", 7],
-            "124": ["Αεροδρόμια", 7],
-            "131": ["Χώροι εξορύξεως ορυκτών", 6],
-            "132": ["Χώροι απορρίψεως απορριμμάτων", 6],
-            "133": ["Χώροι οικοδόμησης", 6],
-            "141": ["Περιοχές αστικού πρασίνου", 4],
-            "142": ["Εγκαταστάσεις αθλητισμού και αναψυχής", 4],
-            "211": ["Μη αρδευόμενη αρόσιμη γη", 1],
-            "212": ["Μόνιμα αρδευόμενη γη", 1],
-            "213": ["Ορυζώνες", 1],
-            "221": ["Αμπελώνες", 1],
-            "222": ["Οπωροφόρα δένδρα και φυτείες με σαρκώδεις καρπούς", 1],
-            "223": ["Ελαιώνες", 1],
-            "231": ["Λιβάδια", 2],
-            "241": ["Ετήσιες καλλιέργειες που συνδέονται με μόνιμες καλλιέργειες", 1],
-            "242": ["Σύνθετες Καλλιέργειες", 1],
-            "243": [
-                "Γη που χρησιμοποιείται κυρίως για γεωργία με σημαντικά τμήματα φυσικής βλάστησης",
-                1,
-            ],
-            "244": ["Γεωργο-δασικές Περιοχές", 1],
-            "311": ["Δάσος πλατυφύλλων", 3],
-            "312": ["Δάσος κωνοφόρων", 3],
-            "313": ["Μικτό δάσος", 3],
-            "321": ["Φυσικοί  βοσκότοποι", 2],
-            "322": ["Θάμνοι και χερσότοποι", 2],
-            "323": ["Σκληροφυλλική βλάστηση", 2],
-            "324": ["Μεταβατικές δασώδεις θαμνώδεις εκτάσεις", 3],
-            "331": ["Παραλίες, αμμόλοφοι, αμμουδιές", 3],
-            "332": ["Απογυμνωμένοι βράχοι", 7],
-            "333": ["Εκτάσεις με αραιή βλάστηση", 2],
-            "334": ["Αποτεφρωμένες εκτάσεις", 6],
-            "335": ["Παγετώνες και αέναο χιόνι", 7],
-            "411": ["Βάλτοι στην ενδοχώρα", 7],
-            "412": ["Τυρφώνες", 7],
-            "421": ["Παραθαλάσσιοι βάλτοι", 7],
-            "422": ["Αλυκές", 7],
-            "423": ["Ζώνες που καλύπτονται από παλιρροιακά ύδατα", 7],
-            "511": ["Υδατορρεύματα", 7],
-            "512": ["Επιφάνειες στάσιμου ύδατος", 7],
-            "521": ["Παράκτιες λιμνοθάλασσες", 7],
-            "522": ["Εκβολές ποταμών", 7],
-            "523": ["Θάλασσες και ωκεανοί", 7],
-        }
-
-        # Choose conditions
-
-        # Retrieve the value mappings
-        params_path = cn_conditions_dir()
-
-        conditions_index = self.parameterAsEnum(parameters, "Conditions", context)
-        geo_corine_to_cn_dict = {}
-
-        # Unfavorable
-        if conditions_index == 0:
-            conditions = "Δυσμενείς"
-            with open(
-                os.path.join(params_path, "unfavorable.csv"), "r", encoding="utf-8"
-            ) as cond_file:
-                reader = csv.reader(cond_file)
-                geo_corine_to_cn_dict = {rows[0]: float(rows[1]) for rows in reader}
-
-        elif conditions_index == 1:
-            conditions = "Μέσες"
-            with open(
-                os.path.join(params_path, "mean.csv"), "r", encoding="utf-8"
-            ) as cond_file:
-                reader = csv.reader(cond_file)
-                geo_corine_to_cn_dict = {rows[0]: float(rows[1]) for rows in reader}
-
-        # Favorable Conditions
-        else:
-            conditions = "Ευμενείς"
-            with open(
-                os.path.join(params_path, "favorable.csv"), "r", encoding="utf-8"
-            ) as cond_file:
-                reader = csv.reader(cond_file)
-                geo_corine_to_cn_dict = {rows[0]: float(rows[1]) for rows in reader}
-
-        basin_area = None
-        for f in self.parameterAsVectorLayer(
-            parameters, "Watershed", context
-        ).getFeatures():
-            basin_area = f.geometry().area()
+        cn = curve_numbers(corine_codes, geo_codes, areas, basin_area, table)
 
-        corine_perc = defaultdict()
-
-        cn_perc = defaultdict()
-
-        for feat in cn_labels.getFeatures():
-            try:
-                cn = None
-                geo = feat["MY_EPIKR1"]
-                cor = feat["Code_18"]
-
-                # Convert corine code to 1-7
-                cor_1_7 = corine_to_1_7_dict[cor][1]
-                corine_description = corine_to_1_7_dict[cor][0]
-
-                # Convert soil/geology code to ABCD
-                geo_abcd = geo_to_abcd_dict[geo]
-
-                # Combine them
-                geo_corine = str(cor_1_7) + geo_abcd
-
-                # Convert to CN
-                cn = geo_corine_to_cn_dict[geo_corine]
-
-                perc = (feat.geometry().area() / basin_area) * 100
-                perc = "%.3f" % round(perc, 5)
-
-                # Update the Corine and CN dicts (for logging)
-                if corine_description in corine_perc:
-                    corine_perc[corine_description] += float(perc)
-                else:
-                    corine_perc[corine_description] = float(perc)
-
-                if cn in cn_perc:
-                    cn_perc[cn] += float(perc)
-                else:
-                    cn_perc[cn] = float(perc)
-
-                out_feat = QgsFeature(out_fields)
-                out_feat.setGeometry(feat.geometry())
-                out_feat["Basin Percentage"] = perc
-                out_feat["Corine_Code"] = float(cor)
-                out_feat["CORINE Descr"] = corine_description
-                out_feat["Geo_Code"] = geo
-                out_feat["LandUse_Code(1_7)"] = cor_1_7
-                out_feat["Hydro_Code(ABCD)"] = geo_abcd
-                out_feat["CN"] = cn
-                sink.addFeature(out_feat, QgsFeatureSink.FastInsert)
-            except Exception:
+        valid = cn["valid"]
+        for i in np.flatnonzero(valid).tolist():
+            if geometries[i] is None:
+                # Raster overlay without polygons
                 continue
+            out_feat = QgsFeature(out_fields)
+            out_feat.setGeometry(geometries[i])
+            out_feat.setAttributes(
+                [
+                    float(cn["percentage"][i]),
+                    float(corine_codes[i]),
+                    CORINE_DESCRIPTIONS[cn["corine"][i]],
+                    geo_codes[i],
+                    int(cn["land_use"][i]),
+                    HYDRO_GROUPS[cn["group"][i]],
+                    float(cn["curve_number"][i]),
+                ]
+            )
+            sink.addFeature(out_feat, QgsFeatureSink.FastInsert)
 
-        for key, value in corine_perc.items():
+        for key, value in cn["corine_share"].items():
             log.write(str(key) + ": " + str(value) + "\n")
 
         # Write the CN log part
@@ -393,18 +339,12 @@ class WatershedCN(QgsProcessingAlgorithm):
             "-------------------------------------------------------------------------\n"
         )
 
-        sum_cn_numerator = 0  # Αριθμητής
-        sum_cn_denominator = 0  # Παρονομαστής
-        for key, value in cn_perc.items():
+        for key, value in cn["cn_share"].items():
             # Write a log entry for each CN and its %cover of the basin
             log.write(str(key) + ": " + str(value) + "\n")
 
-            sum_cn_numerator += key * value
-            sum_cn_denominator += value
-
         log.write("\n\n")
-        sum_cn = sum_cn_numerator / sum_cn_denominator
-        log.write("Συνισταμένη Τιμή CN (χωρικά σταθμισμένη): " + str(sum_cn))
+        log.write("Συνισταμένη Τιμή CN (χωρικά σταθμισμένη): " + str(cn["cn"]))
 
         # Calculate and log urban cover
         log.write(
@@ -413,26 +353,118 @@ class WatershedCN(QgsProcessingAlgorithm):
         log.write("Αστική Κάλυψη (κωδικοί Corine: 111-124, 141,142) \n")
         log.write("\n\n\n")
 
-        urban_total = 0.000
-        for key, value in corine_perc.items():
-            if (
-                key == "Συνεχής αστικός ιστός"
-                or key == "Ασυνεχής αστικός ιστός"
-                or key == "Βιομηχανικές ή εμπορικές ζώνες"
-                or key == "Οδικά & σιδηροδρομικά δίκτυα"
-                or key == "Ζώνες λιμένων"
-                or key == "Αεροδρόμια"
-                or key == "Περιοχές αστικού πρασίνου"
-                or key == "Εγκαταστάσεις αθλητισμού και αναψυχής"
-            ):
-                log.write(str(key) + ": " + str(value) + "\n")
-                urban_total += value
-        log.write("Αστική Κάλυψη (%): " + str(urban_total))
+        for key, value in cn["urban_share"].items():
+            log.write(str(key) + ": " + str(value) + "\n")
+        log.write("Αστική Κάλυψη (%): " + str(cn["urban"]))
         log.write("\n")
-        log.write("Αστική Κάλυψη (0-1): " + str(urban_total / 100))
+        log.write("Αστική Κάλυψη (0-1): " + str(cn["urban"] / 100))
 
         log.close()
         # Calculate Total CN value
 
         # Return the results
-        return {self.OUTPUT: dest_id}
+        results = {self.OUTPUT: dest_id}
+        if cn_grid is not None:
+            results[self.CN_GRID] = cn_grid
+        return results
+
+    def vector_overlay(self, context, feedback, land_cover, soil):
+        """
+        Overlay the clipped layers with SAGA's polygon union.
+
+        :return: geometry, Corine code, soil code and area of every union polygon, and
+            the union layer
+        """
+        Union = run_child(
+            "sagang:polygonunion",
+            {
+                "A": land_cover,
+                "B": soil,
+                "RESULT": "TEMPORARY_OUTPUT",
+                "SPLIT": True,
+            },
+            context=context,
+            feedback=feedback,
+        )
+
+        # 4. Calculate CN
+        # Put intersections in a layer and add CN field
+        cn_labels = QgsVectorLayer(Union["RESULT"], "", "ogr")
+
+        # Read the codes and areas of the union polygons once, then compute in bulk
+        request = QgsFeatureRequest().setSubsetOfAttributes(
+            ["MY_EPIKR1", "Code_18"], cn_labels.fields()
+        )
+        geometries, geo_codes, corine_codes = [], [], []
+        for feat in cn_labels.getFeatures(request):
+            geometries.append(feat.geometry())
+            geo_codes.append(str(feat["MY_EPIKR1"]))
+            corine_codes.append(str(feat["Code_18"]))
+        areas = np.array([g.area() for g in geometries])
+        return geometries, corine_codes, geo_codes, areas, cn_labels
+
+    def raster_overlay(self, parameters, context, watershed, land_cover, soil, table):
+        """
+        Overlay the clipped layers on a grid covering the watershed.
+
+        :return: geometry (None unless polygons are requested), Corine code, soil code
+            and area of every combination of codes found on the grid, and the path of
+            the CN grid (None unless requested)
+        """
+        size = self.parameterAsDouble(parameters, self.CELL_SIZE, context)
+        extent = watershed.extent()
+        x0 = math.floor(extent.xMinimum() / size) * size
+        y0 = math.ceil(extent.yMaximum() / size) * size
+        cols = max(1, math.ceil((extent.xMaximum() - x0) / size))
+        rows = max(1, math.ceil((y0 - extent.yMinimum()) / size))
+        geotransform = (x0, size, 0.0, y0, 0.0, -size)
+        projection = watershed.crs().toWkt()
+
+        def _codes(source, field, known):
+            layer = QgsProcessingUtils.mapLayerFromString(source, context)
+            request = QgsFeatureRequest().setSubsetOfAttributes([field], layer.fields())
+            wkbs, codes = [], []
+            for feat in layer.getFeatures(request):
+                wkbs.append(bytes(feat.geometry().asWkb()))
+                codes.append(str(feat[field]))
+            index = code_index(codes, known)
+            keep = np.flatnonzero(index >= 0).tolist()
+            return rasterize(
+                [wkbs[i] for i in keep],
+                index[keep],
+                geotransform,
+                cols,
+                rows,
+                projection,
+            )
+
+        corine = _codes(land_cover, "Code_18", CORINE_CODES)
+        geo = _codes(soil, "MY_EPIKR1", GEO_CODES)
+        labels, corine_codes, geo_codes, counts = overlay_grid(corine, geo)
+
+        cn_grid = None
+        if parameters.get(self.CN_GRID):
+            land_use = CORINE_LAND_USE[code_index(corine_codes, CORINE_CODES)]
+            group = GEO_GROUP[code_index(geo_codes, GEO_CODES)]
+            cn = np.append(table[land_use, group], np.nan)
+            cn_grid = write_raster(
+                self.parameterAsOutputLayer(parameters, self.CN_GRID, context),
+                cn[labels],  # label -1 picks the trailing NaN
+                geotransform,
+                projection,
+                gdal.GDT_Float32,
+                -9999,
+            )
+
+        geometries = [None] * len(counts)
+        if self.parameterAsBool(parameters, self.CN_POLYGONS, context):
+            for label in range(len(counts)):
+                r, c = np.nonzero(labels == label)
+                r0, c0 = r.min(), c.min()
+                geometries[label] = mask_geometry(
+                    labels[r0 : r.max() + 1, c0 : c.max() + 1] == label,
+                    geotransform,
+                    r0,
+                    c0,
+                )
+        return geometries, corine_codes, geo_codes, counts * size * size, cn_grid
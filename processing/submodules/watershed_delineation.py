@@ -0,0 +1,155 @@
+import numpy as np
+
+from qgis.PyQt.QtCore import QCoreApplication, QVariant
+from qgis.core import (
+    QgsFeature,
+    QgsFeatureSink,
+    QgsField,
+    QgsFields,
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingException,
+    QgsProcessingOutputNumber,
+    QgsProcessingOutputString,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterPoint,
+    QgsProcessingParameterRasterLayer,
+    QgsWkbTypes,
+)
+
+from gwat.utils import hydrology
+from gwat.utils.rasters import read_raster, cell_size, world_to_cell
+from gwat.utils.vectors import mask_geometry
+
+
+class WatershedDelineation(QgsProcessingAlgorithm):
+    """
+    Delineate the watershed of a point straight to a polygon, tracing the outline of its
+    upslope area on the grid.
+    """
+
+    INPUT = "filled_dem"
+    FLOW_DIRECTION = "flow_direction"
+    POUR_POINT = "pour_point"
+    OUTPUT = "Watershed"
+    AreaPer = "Area_Perimeter"
+
+    def tr(self, text):
+        return QCoreApplication.translate("watershed_delineation", text)
+
+    def createInstance(self):
+        return type(self)()
+
+    def name(self):
+        return "watershed_delineation"
+
+    def displayName(self):
+        return self.tr("Watershed Delineation")
+
+    def group(self):
+        return self.tr("submodules")
+
+    def groupId(self):
+        return "submodules"
+
+    def shortHelpString(self):
+        return self.tr(
+            "Upslope area of the pour point (D8 on the filled DEM, or on the given SAGA flow directions), "
+            "written as one polygon with its area (sq. Km) and perimeter (Km). "
+            "Only the outline of the basin is traced: no intermediate polygonized layer is created."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterRasterLayer(self.INPUT, self.tr("Filled DEM"))
+        )
+        self.addParameter(
+            QgsProcessingParameterRasterLayer(
+                self.FLOW_DIRECTION,
+                self.tr("Flow direction (Step 1, computed from the DEM if not set)"),
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterPoint(self.POUR_POINT, self.tr("pour_point"))
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT,
+                self.tr("Watershed"),
+                QgsProcessing.TypeVectorPolygon,
+            )
+        )
+        self.addOutput(QgsProcessingOutputNumber("Area", self.tr("Area (sq. Km)")))
+        self.addOutput(
+            QgsProcessingOutputNumber("Perimeter", self.tr("Perimeter (Km)"))
+        )
+        self.addOutput(
+            QgsProcessingOutputString(self.AreaPer, self.tr("Area_Perimeter"))
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        dem_layer = self.parameterAsRasterLayer(parameters, self.INPUT, context)
+        fdir_layer = self.parameterAsRasterLayer(
+            parameters, self.FLOW_DIRECTION, context
+        )
+        point = self.parameterAsPoint(
+            parameters, self.POUR_POINT, context, dem_layer.crs()
+        )
+
+        # D8 flow directions
+        if fdir_layer is not None:
+            fdir, valid, geotransform, _ = read_raster(fdir_layer.source())
+            fdir = np.where(valid, fdir, hydrology.NO_FLOW).astype(np.int16)
+        else:
+            dem, valid, geotransform, _ = read_raster(dem_layer.source())
+            fdir = hydrology.flow_directions(
+                np.where(valid, dem, np.nan), cell_size(geotransform)
+            )
+            del dem
+        feedback.setProgress(40)
+
+        row, col = world_to_cell(geotransform, point.x(), point.y())
+        rows, cols = fdir.shape
+        if not (0 <= row < rows and 0 <= col < cols and valid[row, col]):
+            raise QgsProcessingException(self.tr("The pour point is outside the DEM"))
+        del valid
+
+        # Upslope area, cropped to its bounding box, then its outline
+        basin = hydrology.upslope_area(fdir, row, col)
+        del fdir
+        basin_rows = np.flatnonzero(basin.any(axis=1))
+        basin_cols = np.flatnonzero(basin.any(axis=0))
+        row0, col0 = int(basin_rows[0]), int(basin_cols[0])
+        basin = basin[row0 : basin_rows[-1] + 1, col0 : basin_cols[-1] + 1]
+        feedback.setProgress(70)
+        if feedback.isCanceled():
+            return {}
+
+        geometry = mask_geometry(basin, geotransform, row0, col0)
+        area = geometry.area() / 1000000
+        perimeter = geometry.length() / 1000
+
+        fields = QgsFields()
+        fields.append(QgsField("Area (sq. Km)", QVariant.Double))
+        fields.append(QgsField("Perimeter (Km)", QVariant.Double))
+        sink, dest_id = self.parameterAsSink(
+            parameters,
+            self.OUTPUT,
+            context,
+            fields,
+            QgsWkbTypes.MultiPolygon,
+            dem_layer.crs(),
+        )
+        feat = QgsFeature(fields)
+        feat.setGeometry(geometry)
+        feat.setAttributes([area, perimeter])
+        sink.addFeature(feat, QgsFeatureSink.FastInsert)
+        feedback.setProgress(100)
+
+        return {
+            self.OUTPUT: dest_id,
+            "Area": area,
+            "Perimeter": perimeter,
+            self.AreaPer: "[{}, {}]".format(area, perimeter),
+        }
@@ -9,11 +9,11 @@ from qgis.core import (
     QgsProcessingParameterString,
     QgsProcessingParameterRasterLayer,
     QgsProcessingParameterNumber,
-    QgsRasterBandStats,
     QgsProcessingOutputString,
     QgsProcessingAlgorithm,
 )
 from gwat.utils.files import get_plugin_output_dir, get_or_create_path
+from gwat.utils.dem_stats import raster_statistics
 
 
 class WatershedStatistics(QgsProcessingAlgorithm):
@@ -110,10 +110,10 @@ class WatershedStatistics(QgsProcessingAlgorithm):
             area = self.parameterAsDouble(parameters, "Area", context)
             perimeter = self.parameterAsDouble(parameters, "Perimeter", context)
 
-            basin_provider = basin.dataProvider()
-            stats = basin_provider.bandStatistics(1, QgsRasterBandStats.All)
-            min_elev = stats.minimumValue
-            max_elev = stats.maximumValue
+            # One blockwise pass over the DEM for all the elevation statistics
+            stats = raster_statistics(basin.source(), feedback=feedback)
+            min_elev = stats.min
+            max_elev = stats.max
             mean = stats.mean
             klisi = (max_elev - min_elev) * 0.001 / math.sqrt(area)
             circularity_ratio = (4 * 3.1415 * area) / (perimeter**2)
@@ -127,6 +127,8 @@ class WatershedStatistics(QgsProcessingAlgorithm):
             output["klisi"] = klisi
             output["RC"] = circularity_ratio
             output["CC"] = compactness_coefficient
+            output["std"] = stats.std
+            output["HI"] = stats.hypsometric_integral
 
             log.write("Ελάχιστο Υψόμετρο: " + str(min_elev) + "m" + "\n")
             log.write("Μέγιστο Υψόμετρο: " + str(max_elev) + "m" + "\n")
@@ -136,8 +138,15 @@ class WatershedStatistics(QgsProcessingAlgorithm):
             log.write("Μέση Κλίση Υδρολογικής Λεκάνης: " + str(klisi) + "\n")
             log.write("Δείκτης Κυκλικότητας (Rc): " + str(circularity_ratio) + "\n")
             log.write("Δείκτης Συμπαγούς (Cc): " + str(compactness_coefficient) + "\n")
+            log.write("Τυπική Απόκλιση Υψομέτρου: " + str(stats.std) + "m" + "\n")
+            log.write(
+                "Υψομετρικό Ολοκλήρωμα (HI): " + str(stats.hypsometric_integral) + "\n"
+            )
+            log.write("\nΥψομετρική Κατανομή (m: % της λεκάνης)\n")
+            edges, counts = stats.histogram()
+            for low, high, count in zip(edges[:-1], edges[1:], counts.tolist()):
+                log.write(f"{low:g}-{high:g}: {100 * count / stats.count:.3f}\n")
 
-            del basin_provider
             del basin
 
         # Return the results
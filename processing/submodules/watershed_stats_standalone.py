@@ -8,11 +8,12 @@ from qgis.core import (
     QgsProcessingParameterString,
     QgsProcessingParameterRasterLayer,
     QgsProcessingParameterVectorLayer,
-    QgsRasterBandStats,
     QgsProcessingOutputString,
     QgsProcessingAlgorithm,
 )
-from qgis.core import QgsProject
+from qgis.core import QgsProject, QgsGeometry, QgsCoordinateTransform
+
+from gwat.utils.dem_stats import masked_statistics
 
 try:
     from qgis import processing
@@ -98,47 +99,26 @@ class WatershedStatisticsStandalone(QgsProcessingAlgorithm):
         area = (f.geometry().area()) / 1000000
         perimeter = (f.geometry().length()) / 1000
 
-        # 1. Clip DEM
-
-        Clipped_DEM = processing.run(
-            "gdal:cliprasterbymasklayer",
-            {
-                "ALPHA_BAND": False,
-                "CROP_TO_CUTLINE": True,
-                "DATA_TYPE": 0,
-                "EXTRA": "",
-                "INPUT": Filled_DEM,
-                "KEEP_RESOLUTION": False,
-                "MASK": Watershed_Basin,
-                "MULTITHREADING": False,
-                "NODATA": None,
-                "OPTIONS": "",
-                "OUTPUT": "TEMPORARY_OUTPUT",
-                "SET_RESOLUTION": False,
-                "SOURCE_CRS": None,
-                "TARGET_CRS": None,
-                "X_RESOLUTION": None,
-                "Y_RESOLUTION": None,
-            },
-            is_child_algorithm=True,
-            context=context,
+        # 2. Statistics of the DEM cells inside the basin, read through an in-memory
+        # mask of the basin polygon over its bounding box window
+        geometry = QgsGeometry(WB.geometry())
+        geometry.transform(
+            QgsCoordinateTransform(
+                Watershed_Basin.crs(), Filled_DEM.crs(), context.transformContext()
+            )
+        )
+        box = geometry.boundingBox()
+        stats = masked_statistics(
+            Filled_DEM.source(),
+            bytes(geometry.asWkb()),
+            (box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum()),
             feedback=feedback,
-        )["OUTPUT"]
+        )
         if feedback.isCanceled():
             return {}
 
-        self.addParameter(
-            QgsProcessingParameterRasterLayer(
-                self.Clipped_DEM, self.tr("Clipped DEM"), defaultValue=Clipped_DEM
-            )
-        )
-
-        Clipped = self.parameterAsRasterLayer(parameters, "Clipped_DEM", context)
-
-        basin_provider = Clipped.dataProvider()
-        stats = basin_provider.bandStatistics(1, QgsRasterBandStats.All)
-        min = stats.minimumValue
-        max = stats.maximumValue
+        min = stats.min
+        max = stats.max
         mean = stats.mean
         klisi = (max - min) * 0.001 / math.sqrt(area)
         RC = (4 * 3.1415 * area) / (perimeter**2)
@@ -152,6 +132,8 @@ class WatershedStatisticsStandalone(QgsProcessingAlgorithm):
         output["klisi"] = klisi
         output["RC"] = RC
         output["CC"] = CC
+        output["std"] = stats.std
+        output["HI"] = stats.hypsometric_integral
 
         log.write("Ελάχιστο Υψόμετρο: " + str(min) + "m" + "\n")
         log.write("Μέγιστο Υψόμετρο: " + str(max) + "m" + "\n")
@@ -161,9 +143,14 @@ class WatershedStatisticsStandalone(QgsProcessingAlgorithm):
         log.write("Μέση Κλίση Υδρολογικής Λεκάνης: " + str(klisi) + "\n")
         log.write("Δείκτης Κυκλικότητας (Rc): " + str(RC) + "\n")
         log.write("Δείκτης Συμπαγούς (Cc): " + str(CC) + "\n")
-
-        del basin_provider
-        del Clipped_DEM
+        log.write("Τυπική Απόκλιση Υψομέτρου: " + str(stats.std) + "m" + "\n")
+        log.write(
+            "Υψομετρικό Ολοκλήρωμα (HI): " + str(stats.hypsometric_integral) + "\n"
+        )
+        log.write("\nΥψομετρική Κατανομή (m: % της λεκάνης)\n")
+        edges, counts = stats.histogram()
+        for low, high, count in zip(edges[:-1], edges[1:], counts.tolist()):
+            log.write(f"{low:g}-{high:g}: {100 * count / stats.count:.3f}\n")
 
         # Return the results
         return {self.OUTPUT: "{" + str(output).split("{")[1].split("}")[0]}
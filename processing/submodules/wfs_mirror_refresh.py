@@ -0,0 +1,92 @@
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingMultiStepFeedback
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterExtent
+from qgis.core import QgsProcessingParameterString
+from qgis.core import QgsProcessingOutputNumber
+from qgis.core import QgsProcessingOutputString
+from qgis.core import QgsCoordinateReferenceSystem
+
+from gwat.utils.wfs_mirror import WFS_LAYERS, WFS_URL, WfsMirror
+
+LAYERS = list(WFS_LAYERS)
+
+
+class WfsMirrorRefresh(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                "layers",
+                "Layers",
+                options=[WFS_LAYERS[name][0] for name in LAYERS],
+                allowMultiple=True,
+                defaultValue=list(range(len(LAYERS))),
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString("url", "WFS server URL", defaultValue=WFS_URL)
+        )
+        self.addParameter(
+            QgsProcessingParameterExtent(
+                "extent", "Only refresh the tiles in this extent", optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                "rebuild", "Download everything again", defaultValue=False
+            )
+        )
+        self.addOutput(QgsProcessingOutputString("mirror", "Mirror GeoPackage"))
+        self.addOutput(QgsProcessingOutputNumber("changed", "Tiles rewritten"))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        layers = [
+            LAYERS[i] for i in self.parameterAsEnums(parameters, "layers", context)
+        ]
+        url = self.parameterAsString(parameters, "url", context)
+        rebuild = self.parameterAsBool(parameters, "rebuild", context)
+        extent = None
+        if parameters.get("extent"):
+            # The layers are served in EPSG:2100
+            extent = self.parameterAsExtent(
+                parameters,
+                "extent",
+                context,
+                QgsCoordinateReferenceSystem("EPSG:2100"),
+            )
+
+        mirror = WfsMirror()
+        steps = QgsProcessingMultiStepFeedback(len(layers), feedback)
+        total_changed = 0
+        for step, name in enumerate(layers):
+            steps.setCurrentStep(step)
+            checked, changed = mirror.sync(name, url, extent, rebuild, steps)
+            if feedback.isCanceled():
+                return {}
+            feedback.pushInfo(
+                f"{WFS_LAYERS[name][0]}: {changed} of {checked} tiles rewritten, "
+                f"version {mirror.metadata['layers'][name]['version']}"
+            )
+            total_changed += changed
+
+        return {"mirror": mirror.path, "changed": total_changed}
+
+    def name(self):
+        return "wfs_mirror"
+
+    def displayName(self):
+        return "Refresh WFS Mirror"
+
+    def group(self):
+        return "submodules"
+
+    def groupId(self):
+        return "submodules"
+
+    def shortHelpString(self):
+        return "Download the Corine Land Cover and soil map WFS layers into a local GeoPackage, or bring that copy up to date.\n\nThe layers are fetched in square tiles (<i>wfs_mirror_tile_size</i> setting, in metres) and only the tiles whose content changed on the server are rewritten. Once mirrored, the layers added to the project and the Curve Number computation read the local copy instead of the WFS server. Only a mirror of the whole layers stands in for the WFS layers: syncing an extent refreshes that part of a complete mirror."
+
+    def createInstance(self):
+        return WfsMirrorRefresh()
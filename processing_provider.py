@@ -41,13 +41,19 @@ from idf_curves import IdfCurves
 from watershed_cn import WatershedCN
 from watershed_statistics import WatershedStatistics
 from watershed_attributes import WatershedAttributes
+from watershed_delineation import WatershedDelineation
+from basin_contours import BasinContours
 from watershed_stats_standalone import WatershedStatisticsStandalone
 
 
 from elongation_ratio import ElongationRatio
+from network_topology import NetworkTopology
 from count_feats import FeatureCounter
 from nearby_meteo_stations import NearbyMeteoStations
 from inverse_dist_gage_weighting import InverseDistGageWeighting
+from idf_intensity_grid import IdfIntensityGrid
+from hydrology_cache_manager import HydrologyCacheManager
+from wfs_mirror_refresh import WfsMirrorRefresh
 
 
 from qgis.PyQt.QtGui import QIcon
@@ -67,13 +73,19 @@ class WATProcessingProvider(QgsProcessingProvider):
         self.addAlgorithm(WatershedCN())
         self.addAlgorithm(WatershedStatistics())
         self.addAlgorithm(WatershedAttributes())
+        self.addAlgorithm(WatershedDelineation())
+        self.addAlgorithm(BasinContours())
         self.addAlgorithm(WatershedStatisticsStandalone())
         self.addAlgorithm(LongestFlowPath())
         self.addAlgorithm(ElongationRatio())
+        self.addAlgorithm(NetworkTopology())
         self.addAlgorithm(FeatureCounter())
         self.addAlgorithm(NearbyMeteoStations())
         self.addAlgorithm(InverseDistGageWeighting())
+        self.addAlgorithm(IdfIntensityGrid())
         self.addAlgorithm(IdfCurves())
+        self.addAlgorithm(HydrologyCacheManager())
+        self.addAlgorithm(WfsMirrorRefresh())
 
     def id(self):
         return "gwat"
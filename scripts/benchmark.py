@@ -0,0 +1,766 @@
+# Benchmark the GWAT pipeline on synthetic data
+#
+# For every DEM size a fractal DEM is generated, with matching soil and Corine polygons,
+# meteo stations and discharge points, and Step 1, Step 2 (single and batch), the Longest
+# Flow Path and the IDF Curves are run on it headlessly, each run in a fresh QGIS process.
+# Every run records its wall time, CPU time (SAGA / GDAL subprocesses included) and peak
+# resident memory. The results are written to a JSON file and, given the results file of
+# an earlier benchmark, compared with it.
+#
+# Needs Linux and a QGIS install whose python runs this script; only local data is used.
+# The default backends are the in-process ones, --saga runs the SAGA reference backends
+# (the SAGA NextGen provider plugin must be installed).
+#
+#   python scripts/benchmark.py --sizes 512,1024,2048 --repeat 3
+#   python scripts/benchmark.py --baseline /tmp/gwat_benchmark/results_<time>.json
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+PLUGIN_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SAGA_PLUGIN = "processing_saga_nextgen"
+DEFAULT_PLUGINS_DIR = "~/.local/share/QGIS/QGIS3/profiles/default/python/plugins"
+
+# Greek Grid, around central Greece
+EPSG = 2100
+ORIGIN = (400000.0, 4400000.0)
+NODATA = -9999.0
+
+# Soil and Corine polygons are traced on a grid this many times coarser than the DEM
+POLYGON_CELLS = 4
+# Mean size of the soil and Corine patches (m)
+SOIL_PATCH = 1500.0
+CORINE_PATCH = 800.0
+# Meteo station parameters: uniform ranges of the bundled stations' values
+STATION_RANGES = {
+    "Ζ": (0.0, 1400.0),
+    "κ": (0.04, 0.2),
+    "λ΄": (100.0, 1200.0),
+    "ψ΄": (0.3, 0.9),
+    "θ": (0.05, 0.3),
+    "η": (0.62, 0.74),
+}
+
+CASES = ["step_1", "step_2", "step_2_batch", "longest_flow_path", "idf_curves"]
+# Case whose outputs (of its first run) a case reads
+UPSTREAM = {
+    "step_2": "step_1",
+    "step_2_batch": "step_1",
+    "longest_flow_path": "step_2",
+    "idf_curves": "step_2",
+}
+
+
+def folder(*parts):
+    path = os.path.join(*parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def import_plugin():
+    """
+    Make the plugin importable as the ``gwat`` package, whatever its folder is called.
+    """
+    if "gwat" in sys.modules:
+        return
+    spec = importlib.util.spec_from_file_location(
+        "gwat",
+        os.path.join(PLUGIN_DIR, "__init__.py"),
+        submodule_search_locations=[PLUGIN_DIR],
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["gwat"] = module
+    spec.loader.exec_module(module)
+
+
+# Synthetic data
+
+
+def fractal_dem(size, seed, hurst=0.8, relief=1200.0):
+    """
+    Fractional Brownian surface by spectral synthesis (amplitudes ~ 1 / f^(H + 1)), tilted
+    towards the south so that the main valleys drain out of one edge.
+    """
+    rng = np.random.default_rng(seed)
+    fy = np.fft.fftfreq(size)[:, None]
+    fx = np.fft.rfftfreq(size)[None, :]
+    frequency = np.hypot(fx, fy)
+    frequency[0, 0] = np.inf
+    spectrum = np.fft.rfft2(rng.standard_normal((size, size)))
+    z = np.fft.irfft2(spectrum * frequency ** -(hurst + 1), s=(size, size))
+    z = (z - z.min()) / (z.max() - z.min())
+    tilt = np.linspace(0.5, 0.0, size)[:, None]
+    return (100.0 + relief * (z + tilt) / 1.5).astype(np.float32)
+
+
+def voronoi_labels(rows, cols, patch, rng):
+    """
+    Label every cell with its nearest seed, one seed jittered inside every patch x patch
+    block: only the seeds of the 3 x 3 blocks around a cell are compared.
+
+    :return: (labels, number of seeds)
+    """
+    block_rows, block_cols = -(-rows // patch) + 2, -(-cols // patch) + 2
+    seed_r = (
+        np.arange(block_rows)[:, None] - 1 + rng.random((block_rows, block_cols))
+    ) * patch
+    seed_c = (
+        np.arange(block_cols)[None, :] - 1 + rng.random((block_rows, block_cols))
+    ) * patch
+    r = np.arange(rows)[:, None] + 0.5
+    c = np.arange(cols)[None, :] + 0.5
+    block_r = (r // patch).astype(np.int64) + 1
+    block_c = (c // patch).astype(np.int64) + 1
+
+    best = np.full((rows, cols), np.inf)
+    labels = np.zeros((rows, cols), dtype=np.int32)
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            i, j = block_r + dr, block_c + dc
+            distance = (seed_r[i, j] - r) ** 2 + (seed_c[i, j] - c) ** 2
+            closer = distance < best
+            best[closer] = distance[closer]
+            labels[closer] = (i * block_cols + j)[closer]
+    return labels, block_rows * block_cols
+
+
+def spatial_reference():
+    from osgeo import osr
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def create_layer(path, name, geometry_type, fields):
+    """
+    New GeoPackage holding one empty layer.
+
+    :param fields: list of (name, OGR field type)
+    """
+    from osgeo import ogr
+
+    driver = ogr.GetDriverByName("GPKG")
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    ds = driver.CreateDataSource(path)
+    layer = ds.CreateLayer(name, spatial_reference(), geometry_type)
+    for field, field_type in fields:
+        layer.CreateField(ogr.FieldDefn(field, field_type))
+    return ds, layer
+
+
+def class_polygons(path, field, codes, size, cell, patch, rng):
+    """
+    Polygons covering the DEM, each holding a code drawn from ``codes`` in ``field``.
+    """
+    from osgeo import gdal, ogr
+
+    grid = -(-size // POLYGON_CELLS)
+    labels, count = voronoi_labels(
+        grid, grid, max(1, round(patch / (cell * POLYGON_CELLS))), rng
+    )
+    raster = gdal.GetDriverByName("MEM").Create("", grid, grid, 1, gdal.GDT_Int32)
+    raster.SetGeoTransform(
+        (ORIGIN[0], cell * POLYGON_CELLS, 0.0, ORIGIN[1], 0.0, -cell * POLYGON_CELLS)
+    )
+    raster.SetProjection(spatial_reference().ExportToWkt())
+    raster.GetRasterBand(1).WriteArray(labels)
+
+    ds, layer = create_layer(
+        path,
+        os.path.splitext(os.path.basename(path))[0],
+        ogr.wkbPolygon,
+        [("seed", ogr.OFTInteger), (field, ogr.OFTString)],
+    )
+    gdal.Polygonize(raster.GetRasterBand(1), None, layer, 0)
+    raster = None
+
+    drawn = rng.choice(np.asarray(codes), size=count)
+    seeds = [(feature.GetFID(), feature.GetField("seed")) for feature in layer]
+    layer.StartTransaction()
+    for fid, seed in seeds:
+        feature = layer.GetFeature(fid)
+        feature.SetField(field, str(drawn[seed]))
+        layer.SetFeature(feature)
+    layer.CommitTransaction()
+    ds = None
+    return path
+
+
+def meteo_stations(path, count, extent, rng):
+    """
+    Stations with the fields of the bundled ones, scattered over the DEM and around it.
+    """
+    from osgeo import ogr
+
+    bundled = ogr.Open(os.path.join(PLUGIN_DIR, "assets", "meteo_stations.gpkg"))
+    definition = bundled.GetLayer(0).GetLayerDefn()
+    fields = [
+        (definition.GetFieldDefn(i).GetName(), definition.GetFieldDefn(i).GetType())
+        for i in range(definition.GetFieldCount())
+    ]
+    bundled = None
+
+    xmin, ymin, xmax, ymax = extent
+    margin = (xmax - xmin) / 2
+    ds, layer = create_layer(path, "meteo", ogr.wkbPoint, fields)
+    layer.StartTransaction()
+    for n in range(count):
+        x = rng.uniform(xmin - margin, xmax + margin)
+        y = rng.uniform(ymin - margin, ymax + margin)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        values = {
+            "ΥΔ": "GR00",
+            "ΚΩΔΙΚΟΣ": n + 1,
+            "ΟΝΟΜΑ": f"STATION {n + 1}",
+            "Χ": x,
+            "Υ": y,
+        }
+        for name, (low, high) in STATION_RANGES.items():
+            values[name] = round(rng.uniform(low, high), 3)
+        for name, value in values.items():
+            if layer.GetLayerDefn().GetFieldIndex(name) >= 0:
+                feature.SetField(name, value)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(f"POINT ({x} {y})"))
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    ds = None
+    return path
+
+
+def point_layer(path, points):
+    """
+    Discharge points, with their ``point_id``.
+    """
+    from osgeo import ogr
+
+    ds, layer = create_layer(
+        path,
+        os.path.splitext(os.path.basename(path))[0],
+        ogr.wkbPoint,
+        [("point_id", ogr.OFTInteger)],
+    )
+    for point_id, (x, y) in enumerate(points, start=1):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField("point_id", point_id)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(f"POINT ({x} {y})"))
+        layer.CreateFeature(feature)
+    ds = None
+    return path
+
+
+def generate(folder, size, cell, seed, stations):
+    """
+    Synthetic DEM, soil and Corine polygons and meteo stations of one size.
+
+    :return: paths of the datasets, by name
+    """
+    from osgeo import gdal
+
+    from gwat.utils.curve_number import CORINE_TO_1_7, GEO_TO_ABCD
+    from gwat.utils.rasters import write_raster
+
+    rng = np.random.default_rng(seed)
+    extent = (ORIGIN[0], ORIGIN[1] - size * cell, ORIGIN[0] + size * cell, ORIGIN[1])
+    data = {"size": size, "cell": cell, "extent": extent}
+    data["dem"] = write_raster(
+        os.path.join(folder, "dem.tif"),
+        fractal_dem(size, seed),
+        (ORIGIN[0], cell, 0.0, ORIGIN[1], 0.0, -cell),
+        spatial_reference().ExportToWkt(),
+        gdal.GDT_Float32,
+        NODATA,
+    )
+    data["soil"] = class_polygons(
+        os.path.join(folder, "soil.gpkg"),
+        "MY_EPIKR1",
+        sorted(GEO_TO_ABCD),
+        size,
+        cell,
+        SOIL_PATCH,
+        rng,
+    )
+    # Land cover of a hilly basin: no water bodies or wetlands
+    data["corine"] = class_polygons(
+        os.path.join(folder, "corine.gpkg"),
+        "Code_18",
+        sorted(code for code in CORINE_TO_1_7 if code[0] in "123"),
+        size,
+        cell,
+        CORINE_PATCH,
+        rng,
+    )
+    data["stations"] = meteo_stations(
+        os.path.join(folder, "meteo_stations.gpkg"), stations, extent, rng
+    )
+    return data
+
+
+def discharge_points(folder, flow_directions, count, threshold):
+    """
+    Discharge points on the channels of the Step 1 flow directions, away from the DEM
+    edges: the cell draining the most, then cells draining about 1/4, 1/16, ... of it.
+
+    :return: paths of the layer of all the points and of the layer of the first one
+    """
+    from gwat.utils.hydrology import NO_FLOW, flow_accumulation
+    from gwat.utils.rasters import read_raster
+
+    data, valid, geotransform, _ = read_raster(flow_directions)
+    fdir = np.where(valid, data, NO_FLOW).astype(np.int16)
+    del data
+    acc = flow_accumulation(fdir)
+    margin = max(2, min(acc.shape) // 20)
+    inner = np.zeros(acc.shape, dtype=bool)
+    inner[margin:-margin, margin:-margin] = True
+    acc = np.where(inner & (acc >= threshold), acc, 0).ravel()
+
+    cells = []
+    for k in range(count):
+        target = acc.max() / 4**k
+        if target < max(threshold, 1):
+            break
+        with np.errstate(divide="ignore"):
+            miss = np.abs(np.log(acc / target))
+        miss[cells] = np.inf
+        cells.append(int(np.argmin(miss)))
+    cols = fdir.shape[1]
+    points = [
+        (
+            geotransform[0] + (cell % cols + 0.5) * geotransform[1],
+            geotransform[3] + (cell // cols + 0.5) * geotransform[5],
+        )
+        for cell in cells
+    ]
+    return (
+        point_layer(os.path.join(folder, "discharge_points.gpkg"), points),
+        point_layer(os.path.join(folder, "discharge_point.gpkg"), points[:1]),
+    )
+
+
+# Runs
+
+
+def case_parameters(case, data, out, upstream, args):
+    """
+    Algorithm and parameters of a case, writing its outputs to ``out``.
+    """
+    saga = args.saga
+    if case == "step_1":
+        return "gwat:step_1", {
+            "dem": data["dem"],
+            "channel_initiation_threshold": data["threshold"],
+            "backend": 0 if saga else 1,  # SAGA NextGen / Native
+            "tile_memory_mb": args.tile_memory_mb,
+            "use_cache": False,
+            "Channel_network_raster": os.path.join(out, "channel_network.sdat"),
+            "Channel_network_vector": os.path.join(out, "channel_network.gpkg"),
+            "Filled_dem": os.path.join(out, "filled_dem.sdat"),
+            "Flow_direction": os.path.join(out, "flow_directions.sdat"),
+        }
+    if case in ("step_2", "step_2_batch"):
+        batch = case == "step_2_batch"
+        return "gwat:step_2", {
+            "filled_dem": os.path.join(upstream, "filled_dem.sdat"),
+            "discharge_point": data["points" if batch else "point"],
+            "channel_network": os.path.join(upstream, "channel_network.gpkg"),
+            "delineation": 0 if saga else 1,  # SAGA upslope area / boundary trace
+            "cn_overlay": 0 if saga else 1,  # Vector / raster
+            "use_cache": False,
+            "batch": batch,
+            "point_id_field": "point_id" if batch else None,
+            "workers": args.workers,
+            "BasinRaw": os.path.join(out, "basin_raw.gpkg"),
+            "UpslopeBasin": os.path.join(out, "upslope_basin.gpkg"),
+            "BasinDEM": os.path.join(out, "basin_dem.tif"),
+            "BasinContours": os.path.join(out, "basin_contours.gpkg"),
+            "BasinChannelNetwork": os.path.join(out, "basin_channel_network.gpkg"),
+            "Basincn": os.path.join(out, "basin_cn.gpkg"),
+            "Basincorine": os.path.join(out, "basin_corine.gpkg"),
+            "Basinscs": os.path.join(out, "basin_scs.gpkg"),
+            "SOIL_LAYER": data["soil"],
+            "LAND_COVER_LAYER": data["corine"],
+        }
+    if case == "longest_flow_path":
+        return "gwat:longest_flow_path", {
+            "ChannelNetwork": os.path.join(upstream, "basin_channel_network.gpkg"),
+            "PourPoint": data["point"],
+            "WatershedBasin": os.path.join(upstream, "upslope_basin.gpkg"),
+            "Method": 3,  # Exact (network graph)
+            "Longest_Stream": os.path.join(out, "longest_flow_path.gpkg"),
+        }
+    if case == "idf_curves":
+        return "gwat:idf_curves", {
+            "Basin": os.path.join(upstream, "upslope_basin.gpkg"),
+            "NumberofStations": 4,
+            "ReturnPeriodTinyears": 50,
+            "RainfallDurationdinhours": 1,
+            "ReturnPeriods": "2,5,10,20,50,100",
+            "RainfallDurations": "0.5,1,2,3,6,12,24",
+            "FitCurve": True,
+            "NearestStationsWithIdgw": os.path.join(out, "nearest_stations.gpkg"),
+            "IdfTable": os.path.join(out, "idf_table.gpkg"),
+        }
+    raise ValueError(f"Unknown case {case}")
+
+
+def run_worker(algorithm, parameters, out, args, settings):
+    """
+    Run an algorithm in a new QGIS process, from the ``out`` folder (the plugin writes its
+    reports next to the project, here the working folder). ``settings`` override the
+    plugin settings of that process only.
+
+    :return: the report of the worker: wall_s, cpu_s, peak_rss_mb, init_rss_mb, or error
+    """
+    spec = os.path.join(out, "run.json")
+    report = os.path.join(out, "report.json")
+    if os.path.exists(report):
+        os.remove(report)
+    with open(spec, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "algorithm": algorithm,
+                "parameters": parameters,
+                "saga": args.saga,
+                "plugins_dir": os.path.expanduser(args.plugins_dir),
+                "report": report,
+            },
+            f,
+            indent=2,
+            ensure_ascii=False,
+        )
+    from gwat.utils.settings import SETTINGS_ENV
+
+    env = dict(
+        os.environ,
+        QT_QPA_PLATFORM="offscreen",
+        **{SETTINGS_ENV: json.dumps(settings, ensure_ascii=False)},
+    )
+    with open(os.path.join(out, "worker.log"), "w", encoding="utf-8") as log:
+        try:
+            process = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", spec],
+                cwd=out,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                timeout=args.timeout or None,
+            )
+        except subprocess.TimeoutExpired:
+            return {"error": f"timed out after {args.timeout} s"}
+    if not os.path.exists(report):
+        return {"error": f"worker exited with {process.returncode}, see {log.name}"}
+    with open(report, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def worker(spec_path):
+    """
+    Run one algorithm headlessly and write its measures to the report of the spec.
+    """
+    with open(spec_path, "r", encoding="utf-8") as f:
+        spec = json.load(f)
+
+    from qgis.core import Qgis, QgsApplication, QgsProcessingFeedback
+
+    QgsApplication.setPrefixPath(os.environ.get("QGIS_PREFIX_PATH", "/usr"), True)
+    app = QgsApplication([], False)
+    app.initQgis()
+    sys.path.append(os.path.join(QgsApplication.pkgDataPath(), "python", "plugins"))
+    import processing
+    from processing.core.Processing import Processing
+
+    Processing.initialize()
+    if spec["saga"]:
+        import qgis.utils
+
+        sys.path.append(spec["plugins_dir"])
+        if not (
+            qgis.utils.loadPlugin(SAGA_PLUGIN)
+            and qgis.utils.startProcessingPlugin(SAGA_PLUGIN)
+        ):
+            raise RuntimeError(f"Could not load the {SAGA_PLUGIN} plugin")
+    import_plugin()
+    from gwat.processing_provider import WATProcessingProvider
+
+    QgsApplication.processingRegistry().addProvider(WATProcessingProvider())
+
+    report = {
+        "qgis": Qgis.version(),
+        "init_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = time.process_time()
+    start = time.perf_counter()
+    try:
+        results = processing.run(
+            spec["algorithm"], spec["parameters"], feedback=QgsProcessingFeedback()
+        )
+        report["outputs"] = {
+            name: value
+            for name, value in results.items()
+            if isinstance(value, (int, float, str))
+        }
+    except Exception as e:  # pylint: disable=broad-except
+        report["error"] = f"{type(e).__name__}: {e}"
+    report["wall_s"] = time.perf_counter() - start
+    # In-process CPU time, plus the SAGA / GDAL processes the run waited for
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    report["cpu_s"] = (
+        time.process_time()
+        - cpu
+        + (after.ru_utime + after.ru_stime)
+        - (children.ru_utime + children.ru_stime)
+    )
+    report["peak_rss_mb"] = (
+        max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, after.ru_maxrss) / 1024
+    )
+    with open(spec["report"], "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    app.exitQgis()
+    return 1 if "error" in report else 0
+
+
+def summarize(entry):
+    """
+    Median wall and CPU time and largest peak memory of the runs of a case.
+    """
+    runs = [run for run in entry["runs"] if "error" not in run]
+    failed = [run for run in entry["runs"] if "error" in run]
+    if failed or not runs:
+        entry["status"] = "failed"
+        entry["error"] = failed[0]["error"] if failed else "no run"
+        return entry
+    entry["status"] = "ok"
+    entry["wall_s"] = statistics.median(run["wall_s"] for run in runs)
+    entry["cpu_s"] = statistics.median(run["cpu_s"] for run in runs)
+    entry["peak_rss_mb"] = max(run["peak_rss_mb"] for run in runs)
+    entry["init_rss_mb"] = statistics.median(run["init_rss_mb"] for run in runs)
+    return entry
+
+
+def compare(results, baseline, threshold):
+    """
+    Ratios of the wall time and peak memory of every case to the baseline's; a case
+    regresses when either grows by more than ``threshold``.
+
+    :return: number of regressions
+    """
+    base = {
+        (entry["size"], entry["case"]): entry
+        for entry in baseline["results"]
+        if entry["status"] == "ok"
+    }
+    regressions = 0
+    print()
+    print(
+        f"Compared with {baseline.get('created', '?')} ({baseline.get('commit', '?')})"
+    )
+    print(f"{'Size':>6} {'Case':<18} {'Wall':>14} {'Peak RSS':>16}")
+    for entry in results:
+        reference = base.get((entry["size"], entry["case"]))
+        if reference is None or entry["status"] != "ok":
+            continue
+        wall = entry["wall_s"] / max(reference["wall_s"], 1e-9)
+        rss = entry["peak_rss_mb"] / max(reference["peak_rss_mb"], 1e-9)
+        regression = wall > 1 + threshold or rss > 1 + threshold
+        regressions += regression
+        entry["baseline"] = {
+            "wall_s": reference["wall_s"],
+            "peak_rss_mb": reference["peak_rss_mb"],
+            "wall_ratio": wall,
+            "rss_ratio": rss,
+            "regression": regression,
+        }
+        print(
+            f"{entry['size']:>6} {entry['case']:<18} "
+            f"{reference['wall_s']:>6.1f}s x{wall:<5.2f} "
+            f"{reference['peak_rss_mb']:>6.0f}MB x{rss:<5.2f}"
+            f"{'  REGRESSION' if regression else ''}"
+        )
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PLUGIN_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args):
+    import_plugin()
+    from osgeo import gdal
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    workdir = folder(os.path.abspath(args.workdir))
+    output = args.output or os.path.join(
+        workdir, f"results_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    run = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "gdal": gdal.__version__,
+        },
+        "config": {
+            "sizes": sizes,
+            "cell_size": args.cell_size,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "saga": args.saga,
+            "workers": args.workers,
+            "tile_memory_mb": args.tile_memory_mb,
+        },
+        "results": [],
+    }
+
+    print(f"{'Size':>6} {'Case':<18} {'Wall s':>9} {'CPU s':>9} {'Peak MB':>9}")
+    for size in sizes:
+        root = folder(workdir, str(size))
+        data = generate(
+            folder(root, "data"),
+            size,
+            args.cell_size,
+            args.seed,
+            args.stations,
+        )
+        data["threshold"] = args.channel_threshold or max(size * size // 1000, 10)
+
+        first_runs = {}
+        # Settings of the worker processes, the settings file is left as it is
+        settings = {"meteo_stations": data["stations"], "trace_runs": args.trace}
+        for case in CASES:
+            entry = {"size": size, "case": case, "runs": []}
+            upstream = UPSTREAM.get(case)
+            if upstream is not None and upstream not in first_runs:
+                entry.update(status="skipped", error=f"{upstream} failed")
+            else:
+                for repeat in range(args.repeat):
+                    out = folder(root, "runs", case, str(repeat))
+                    algorithm, parameters = case_parameters(
+                        case, data, out, first_runs.get(upstream), args
+                    )
+                    report = run_worker(algorithm, parameters, out, args, settings)
+                    run["environment"].setdefault("qgis", report.get("qgis"))
+                    entry["runs"].append(report)
+                    if "error" in report:
+                        break
+                    first_runs.setdefault(case, out)
+                summarize(entry)
+            run["results"].append(entry)
+
+            if entry["status"] == "ok":
+                print(
+                    f"{size:>6} {case:<18} {entry['wall_s']:>9.2f} "
+                    f"{entry['cpu_s']:>9.2f} {entry['peak_rss_mb']:>9.0f}"
+                )
+            else:
+                print(f"{size:>6} {case:<18} {entry['status']}: {entry['error']}")
+
+            if case == "step_1" and entry["status"] == "ok":
+                data["points"], data["point"] = discharge_points(
+                    os.path.join(root, "data"),
+                    os.path.join(first_runs[case], "flow_directions.sdat"),
+                    args.points,
+                    data["threshold"],
+                )
+
+    regressions = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(run["results"], json.load(f), args.tolerance)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(run, f, indent=2, ensure_ascii=False)
+    print(f"\nResults written to {output}")
+
+    failed = any(entry["status"] != "ok" for entry in run["results"])
+    return 1 if failed or regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the GWAT pipeline on synthetic data"
+    )
+    parser.add_argument(
+        "--sizes", default="512,1024,2048", help="DEM sizes (cells per side)"
+    )
+    parser.add_argument(
+        "--cell-size", type=float, default=10.0, help="DEM cell size (m)"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1, help="Seed of the synthetic data"
+    )
+    parser.add_argument("--stations", type=int, default=40, help="Meteo stations")
+    parser.add_argument(
+        "--points", type=int, default=4, help="Discharge points of the batch run"
+    )
+    parser.add_argument(
+        "--channel-threshold",
+        type=int,
+        default=0,
+        help="Channel initiation threshold (cells, 0: a thousandth of the DEM)",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of every case")
+    parser.add_argument(
+        "--workers", type=int, default=0, help="Step 2 parallel workers"
+    )
+    parser.add_argument(
+        "--tile-memory-mb", type=int, default=0, help="Step 1 tile memory budget"
+    )
+    parser.add_argument("--saga", action="store_true", help="Run the SAGA backends")
+    parser.add_argument(
+        "--plugins-dir",
+        default=DEFAULT_PLUGINS_DIR,
+        help="QGIS plugins folder, holding the SAGA NextGen provider",
+    )
+    parser.add_argument(
+        "--trace", action="store_true", help="Trace the runs (trace_runs setting)"
+    )
+    parser.add_argument("--timeout", type=float, default=0, help="Timeout of a run (s)")
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(tempfile.gettempdir(), "gwat_benchmark"),
+        help="Folder of the synthetic data and of the outputs",
+    )
+    parser.add_argument("--output", help="Results file (JSON)")
+    parser.add_argument("--baseline", help="Results file of a previous benchmark")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative growth of wall time or peak memory counted as a regression",
+    )
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return worker(args.worker)
+    return benchmark(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def pytest_configure(config):
+    """
+    Make the plugin importable as the ``gwat`` package, whatever its folder is called.
+    """
+    if "gwat" in sys.modules:
+        return
+    spec = importlib.util.spec_from_file_location(
+        "gwat",
+        os.path.join(PLUGIN_DIR, "__init__.py"),
+        submodule_search_locations=[PLUGIN_DIR],
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["gwat"] = module
+    spec.loader.exec_module(module)
+
+
+@pytest.fixture(scope="session")
+def qgis_app():
+    """
+    A QGIS application without GUI, for the tests that need providers and tasks.
+    """
+    core = pytest.importorskip("qgis.core")
+    core.QgsApplication.setPrefixPath(os.environ.get("QGIS_PREFIX_PATH", "/usr"), True)
+    app = core.QgsApplication([], False)
+    app.initQgis()
+    yield app
+    app.exitQgis()
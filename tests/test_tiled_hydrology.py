@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip("osgeo.gdal")
+
+from gwat.utils import hydrology  # noqa: E402
+from gwat.utils.rasters import cell_size, read_raster, write_raster  # noqa: E402
+from gwat.utils.tiled_hydrology import (  # noqa: E402
+    TiledHydrology,
+    tile_size_for_budget,
+)
+
+GEOTRANSFORM = (300000.0, 5.0, 0.0, 4200000.0, 0.0, -5.0)
+MINSLOPE = 0.01
+
+
+def random_dem(path, rows, cols, seed):
+    """
+    Rough random relief with depressions everywhere and a few nodata holes, one of them
+    on the edge.
+    """
+    rng = np.random.default_rng(seed)
+    dem = rng.random((rows, cols)) * 50 + np.linspace(0, 200, cols)
+    dem[40:55, 70:90] = np.nan
+    dem[:10, :12] = np.nan
+    write_raster(path, dem, GEOTRANSFORM, "", gdal.GDT_Float32, -9999)
+
+
+def test_tiled_matches_single_pass(tmp_path):
+    dem_path = str(tmp_path / "dem.tif")
+    random_dem(dem_path, 150, 130, seed=3)
+
+    # Single pass, as in the native engine of step 1
+    dem, valid, geotransform, _ = read_raster(dem_path)
+    cells = cell_size(geotransform)
+    filled = hydrology.fill_sinks(dem, valid, cells, MINSLOPE)
+    fdir = hydrology.flow_directions(filled, cells)
+    acc = hydrology.flow_accumulation(fdir, valid)
+
+    # Tiled, with the smallest tiles: 3 x 3 tiles, the last row and column partial
+    tile_size = tile_size_for_budget(0.01)
+    tiled = TiledHydrology(dem_path, tile_size, str(tmp_path))
+    assert tiled.tile_rows == 3 and tiled.tile_cols == 3
+    assert tiled.fill(MINSLOPE)
+    fdir_path = str(tmp_path / "flow_directions_out.tif")
+    assert tiled.flow_directions(fdir_path)
+    assert tiled.accumulate()
+
+    tiled_filled, tiled_valid, _, _ = read_raster(tiled.filled_path)
+    np.testing.assert_array_equal(tiled_valid, valid)
+    np.testing.assert_array_equal(tiled_filled[valid], filled[valid])
+
+    tiled_fdir = read_raster(fdir_path)[0].astype(np.int16)
+    np.testing.assert_array_equal(tiled_fdir, fdir)
+
+    tiled_acc = read_raster(tiled.accumulation_path)[0]
+    np.testing.assert_array_equal(tiled_acc[valid], acc[valid])
@@ -0,0 +1,115 @@
+import pytest
+
+pytest.importorskip("qgis.core")
+
+from qgis.core import QgsRectangle, QgsVectorLayer  # noqa: E402
+from wfs_server import WfsServer  # noqa: E402
+
+from gwat.utils.wfs_mirror import WFS_LAYERS, WfsMirror, wfs_uri  # noqa: E402
+
+TYPENAME = WFS_LAYERS["corine"][1]
+TILE_SIZE = 20000
+
+
+def corine():
+    """
+    Two features in the tile 25_210 (one crossing into 26_210), one in 26_210.
+    """
+    return {
+        TYPENAME: {
+            1: ((501000, 4201000, 503000, 4203000), "211"),
+            2: ((505000, 4205000, 521000, 4207000), "311"),
+            3: ((522000, 4201000, 524000, 4203000), "112"),
+        }
+    }
+
+
+def codes(layer):
+    return sorted(f["code"] for f in layer.getFeatures())
+
+
+@pytest.fixture
+def server(qgis_app):
+    with WfsServer(corine()) as server:
+        yield server
+
+
+def test_resync_rewrites_changed_tiles(server, tmp_path):
+    mirror = WfsMirror(str(tmp_path), TILE_SIZE)
+
+    checked, changed = mirror.sync("corine", server.url)
+    assert changed == 2
+    meta = mirror.metadata["layers"]["corine"]
+    assert set(meta["tiles"]) == {"25_210", "26_210"}
+    assert meta["complete"] and mirror.covers("corine")
+    assert codes(mirror.layer("corine")) == ["112", "211", "311"]
+
+    # Nothing changed on the server
+    assert mirror.sync("corine", server.url) == (checked, 0)
+
+    # One feature changed: only its tile is rewritten
+    box, _ = server.layers[TYPENAME][3]
+    server.layers[TYPENAME][3] = (box, "121")
+    assert mirror.sync("corine", server.url) == (checked, 1)
+    tiles = mirror.metadata["layers"]["corine"]["tiles"]
+    assert tiles["25_210"]["version"] == 1
+    assert tiles["26_210"]["version"] == 2
+    assert codes(WfsMirror(str(tmp_path), TILE_SIZE).layer("corine")) == [
+        "121",
+        "211",
+        "311",
+    ]
+
+
+def test_partial_mirror_does_not_substitute(server, tmp_path):
+    mirror = WfsMirror(str(tmp_path), TILE_SIZE)
+    remote = QgsVectorLayer(wfs_uri(TYPENAME, server.url), "corine", "WFS")
+    assert remote.isValid()
+
+    # The tile 25_210 alone: feature 2, crossing into 26_210, is there but a feature
+    # of 26_210 reaching into the extent would not be
+    _, changed = mirror.sync(
+        "corine", server.url, extent=QgsRectangle(502000, 4202000, 503000, 4203000)
+    )
+    assert changed == 1
+    assert not mirror.covers("corine")
+    assert not mirror.has_layer("corine")
+    assert mirror.layer("corine") is None
+    assert mirror.substitute(remote) is remote
+
+    mirror.sync("corine", server.url)
+    assert mirror.covers("corine")
+    substitute = mirror.substitute(remote)
+    assert substitute.providerType() == "ogr"
+    assert codes(substitute) == ["112", "211", "311"]
+    # The mirror layer itself is kept
+    assert mirror.substitute(substitute).source() == substitute.source()
+
+
+def test_zero_width_extent_has_a_tile(tmp_path):
+    mirror = WfsMirror(str(tmp_path), TILE_SIZE)
+    point = QgsRectangle(500000, 4200000, 500000, 4200000)
+    assert [tile for tile, _ in mirror.tiles(point)] == ["25_210"]
+
+
+def test_rebuild(server, tmp_path):
+    mirror = WfsMirror(str(tmp_path), TILE_SIZE)
+    mirror.sync("corine", server.url)
+    box, _ = server.layers[TYPENAME][3]
+    server.layers[TYPENAME][3] = (box, "121")
+    mirror.sync("corine", server.url)
+
+    _, changed = mirror.sync("corine", server.url, rebuild=True)
+    assert changed == 2
+    meta = mirror.metadata["layers"]["corine"]
+    assert meta["complete"]
+    assert {tile["version"] for tile in meta["tiles"].values()} == {1}
+    assert codes(mirror.layer("corine")) == ["121", "211", "311"]
+
+    # A new tile size rebuilds the mirror as well
+    mirror = WfsMirror(str(tmp_path), 2 * TILE_SIZE)
+    _, changed = mirror.sync("corine", server.url)
+    meta = mirror.metadata["layers"]["corine"]
+    assert meta["tile_size"] == 2 * TILE_SIZE
+    assert set(meta["tiles"]) == {"12_105", "13_105"}
+    assert codes(mirror.layer("corine")) == ["121", "211", "311"]
@@ -0,0 +1,84 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("qgis.core")
+
+from qgis.PyQt.QtCore import QCoreApplication, QThreadPool  # noqa: E402
+from wfs_server import WfsServer  # noqa: E402
+
+from gwat.utils import wfs  # noqa: E402
+from gwat.utils.settings import SETTINGS_ENV  # noqa: E402
+from gwat.utils.wfs_mirror import WFS_LAYERS, wfs_uri  # noqa: E402
+
+FEATURE = {1: ((501000, 4201000, 503000, 4203000), "211")}
+
+
+@pytest.fixture
+def server(qgis_app, monkeypatch):
+    with WfsServer(
+        {typename: dict(FEATURE) for _, typename in WFS_LAYERS.values()}
+    ) as s:
+        # The layer tasks ask the stand-in server
+        monkeypatch.setattr(wfs, "wfs_uri", lambda typename: wfs_uri(typename, s.url))
+        yield s
+
+
+@pytest.fixture(autouse=True)
+def threads():
+    # Room for both layer tasks, plus the abandoned ones of a timed out start
+    pool = QThreadPool.globalInstance()
+    count = pool.maxThreadCount()
+    pool.setMaxThreadCount(max(count, 4))
+    yield
+    pool.setMaxThreadCount(count)
+
+
+def wait(prefetch, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not prefetch.done():
+        assert time.monotonic() < deadline, "the layer tasks never finished"
+        QCoreApplication.processEvents()
+        time.sleep(0.01)
+    QCoreApplication.processEvents()
+
+
+def test_layers_load_concurrently(server):
+    server.delay = 1
+    prefetch = wfs.WfsPrefetch(timeout=30)
+    done = []
+    prefetch.when_done(lambda: done.append(True))
+    prefetch.start()
+    assert len(prefetch.tasks) == len(WFS_LAYERS)
+
+    wait(prefetch)
+    assert done == [True]
+    assert prefetch.ready() and not prefetch.failed
+    assert server.max_active >= 2
+    for name, layer in prefetch.layers.items():
+        assert layer.isValid()
+        assert layer.name() == WFS_LAYERS[name][0]
+
+
+def test_timeout_abandons_the_load_and_retry_succeeds(server, monkeypatch):
+    monkeypatch.setenv(SETTINGS_ENV, json.dumps({"wfs_timeout_s": 0.5}))
+    server.delay = 3
+    prefetch = wfs.WfsPrefetch()
+    assert prefetch.timeout == 0.5
+    done = []
+    prefetch.when_done(lambda: done.append(True))
+
+    started = time.monotonic()
+    prefetch.start()
+    wait(prefetch)
+    assert time.monotonic() - started < server.delay
+    assert done == [True]
+    assert prefetch.failed == set(WFS_LAYERS)
+    assert not prefetch.ready()
+
+    # The retry of openStep2: start again, the abandoned tasks are ignored
+    server.delay = 0
+    prefetch.start()
+    wait(prefetch)
+    assert prefetch.ready() and not prefetch.failed
@@ -0,0 +1,174 @@
+"""
+Local stand-in for the WFS server: a minimal WFS 1.0.0 service of rectangle features in
+EPSG:2100, answering BBOX requests with GML 2.
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+GML_NS = 'xmlns:gml="http://www.opengis.net/gml"'
+PREFIX_NS = 'xmlns:geonode="http://www.geonode.org/"'
+# Around the features of the tests, in WGS84
+LAT_LONG_BOX = 'minx="23.8" miny="37.7" maxx="24.4" maxy="38.2"'
+
+
+def _capabilities(url, typenames):
+    operation = f'<DCPType><HTTP><Get onlineResource="{url}?"/></HTTP></DCPType>'
+    feature_types = "".join(
+        f"<FeatureType><Name>{typename}</Name><Title>{typename}</Title>"
+        f"<SRS>EPSG:2100</SRS><LatLongBoundingBox {LAT_LONG_BOX}/></FeatureType>"
+        for typename in typenames
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<WFS_Capabilities version="1.0.0" xmlns="http://www.opengis.net/wfs" '
+        f'{PREFIX_NS} xmlns:ogc="http://www.opengis.net/ogc">'
+        f"<Service><Name>WFS</Name><Title>Stand-in</Title>"
+        f"<OnlineResource>{url}</OnlineResource></Service>"
+        "<Capability><Request>"
+        f"<GetCapabilities>{operation}</GetCapabilities>"
+        "<DescribeFeatureType><SchemaDescriptionLanguage><XMLSCHEMA/>"
+        f"</SchemaDescriptionLanguage>{operation}</DescribeFeatureType>"
+        f"<GetFeature><ResultFormat><GML2/></ResultFormat>{operation}</GetFeature>"
+        "</Request></Capability>"
+        f"<FeatureTypeList><Operations><Query/></Operations>{feature_types}"
+        "</FeatureTypeList>"
+        "<ogc:Filter_Capabilities><ogc:Spatial_Capabilities><ogc:Spatial_Operators>"
+        "<ogc:BBOX/><ogc:Intersect/></ogc:Spatial_Operators></ogc:Spatial_Capabilities>"
+        "<ogc:Scalar_Capabilities><ogc:Logical_Operators/></ogc:Scalar_Capabilities>"
+        "</ogc:Filter_Capabilities></WFS_Capabilities>"
+    )
+
+
+def _schema(typename):
+    name = typename.split(":")[1]
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+        f'{GML_NS} {PREFIX_NS} elementFormDefault="qualified" '
+        'targetNamespace="http://www.geonode.org/">'
+        '<xsd:import namespace="http://www.opengis.net/gml" '
+        'schemaLocation="http://schemas.opengis.net/gml/2.1.2/feature.xsd"/>'
+        f'<xsd:complexType name="{name}Type"><xsd:complexContent>'
+        '<xsd:extension base="gml:AbstractFeatureType"><xsd:sequence>'
+        '<xsd:element maxOccurs="1" minOccurs="0" name="the_geom" nillable="true" '
+        'type="gml:MultiPolygonPropertyType"/>'
+        '<xsd:element maxOccurs="1" minOccurs="0" name="code" nillable="true" '
+        'type="xsd:string"/>'
+        "</xsd:sequence></xsd:extension></xsd:complexContent></xsd:complexType>"
+        f'<xsd:element name="{name}" substitutionGroup="gml:_Feature" '
+        f'type="geonode:{name}Type"/>'
+        "</xsd:schema>"
+    )
+
+
+def _features(typename, features):
+    name = typename.split(":")[1]
+    members = []
+    for fid, ((x0, y0, x1, y1), code) in sorted(features.items()):
+        ring = f"{x0},{y0} {x1},{y0} {x1},{y1} {x0},{y1} {x0},{y0}"
+        members.append(
+            f'<gml:featureMember><geonode:{name} fid="{name}.{fid}">'
+            '<geonode:the_geom><gml:MultiPolygon srsName="EPSG:2100">'
+            "<gml:polygonMember><gml:Polygon><gml:outerBoundaryIs><gml:LinearRing>"
+            f"<gml:coordinates>{ring}</gml:coordinates>"
+            "</gml:LinearRing></gml:outerBoundaryIs></gml:Polygon></gml:polygonMember>"
+            "</gml:MultiPolygon></geonode:the_geom>"
+            f"<geonode:code>{code}</geonode:code></geonode:{name}></gml:featureMember>"
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs" {GML_NS} '
+        f'{PREFIX_NS}>{"".join(members)}</wfs:FeatureCollection>'
+    )
+
+
+class WfsServer:
+    """
+    WFS server on a free local port, serving ``layers``: typename -> {feature id:
+    ((xmin, ymin, xmax, ymax), code)}. The layers can be edited while it runs.
+
+    Every answer waits ``delay`` seconds; ``max_active`` is the most requests handled at
+    once.
+    """
+
+    def __init__(self, layers, delay=0):
+        self.layers = layers
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/ows"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        return False
+
+    def answer(self, params):
+        request = params.get("REQUEST", "").lower()
+        typename = params.get("TYPENAME", "").split(",")[0]
+        if request == "getcapabilities":
+            return _capabilities(self.url, self.layers)
+        if request == "describefeaturetype":
+            return _schema(typename)
+        if request == "getfeature":
+            features = self.layers.get(typename, {})
+            if "BBOX" in params:
+                x0, y0, x1, y1 = (float(v) for v in params["BBOX"].split(",")[:4])
+                features = {
+                    fid: (box, code)
+                    for fid, (box, code) in features.items()
+                    if box[0] <= x1 and box[2] >= x0 and box[1] <= y1 and box[3] >= y0
+                }
+            return _features(typename, features)
+        return None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                try:
+                    time.sleep(server.delay)
+                    params = {
+                        k.upper(): v for k, v in parse_qsl(urlsplit(self.path).query)
+                    }
+                    body = server.answer(params)
+                    if body is None:
+                        self.send_error(400)
+                        return
+                    data = body.encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/xml; charset=utf-8")
+                    self.send_header("Content-Length", str(len(data)))
+                    # Every request must reach the server, not the QGIS network cache
+                    self.send_header("Cache-Control", "no-store")
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up, e.g. a cancelled task
+                    pass
+                finally:
+                    with server._lock:
+                        server.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,511 @@
+"""
+Memoized runs of child algorithms.
+
+The outputs of a child algorithm are stored under the plugin output folder, keyed by the
+algorithm id, its parameters and the content of its input datasets. A later run with the
+same key copies the stored outputs to the requested destinations instead of running the
+algorithm again, so a rerun after a parameter change only recomputes the stages that
+depend on it.
+
+Input datasets are fingerprinted by SHA-256 checksums of their files, remembered per file
+size and modification time. Outputs copied out of the cache are registered with the
+checksum of the stored copy, so the stages downstream of a hit hit as well. Intermediate
+/vsimem/ rasters and memory layers (see utils.pipeline) are fingerprinted by content; memory
+layer outputs are stored as GeoPackages and restored as memory layers.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+from osgeo import gdal
+from qgis.core import (
+    Qgis,
+    QgsApplication,
+    QgsFeatureRequest,
+    QgsMapLayer,
+    QgsProcessing,
+    QgsProcessingOutputLayerDefinition,
+    QgsProcessingUtils,
+    QgsVectorFileWriter,
+    QgsVectorLayer,
+)
+
+from gwat.utils.files import get_plugin_output_dir, get_or_create_path
+from gwat.utils.hydrology_cache import META_FILE, HydrologyCache, _dir_size
+from gwat.utils.pipeline import MEMORY_OUTPUT, is_vsimem
+from gwat.utils.rasters import copy_raster
+from gwat.utils.settings import get_setting
+from gwat.utils.tracing import output_stats, run_child, span, tracing
+
+CACHE_DIRNAME = "artifact_cache"
+CHECKSUMS_FILE = "checksums.json"
+DEFAULT_MAX_MB = 10240
+CHUNK_SIZE = 4 * 2**20
+
+# Destinations that are neither files nor memory layers: database URIs...
+_PROVIDER_URI = re.compile(r"^\w{2,}:")
+# Custom property carrying the checksum of a memory layer restored from the cache
+CHECKSUM_PROPERTY = "gwat/artifact_sha256"
+# Helpers computing the outputs of the plugin's own algorithms
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Uncacheable(Exception):
+    """
+    A parameter value the cache cannot fingerprint or restore.
+    """
+
+
+def _stat(path):
+    """
+    [size, modification time] of a file on disk or in /vsimem/, None if there is none.
+    """
+    if is_vsimem(path):
+        stat = gdal.VSIStatL(path)
+        return None if stat is None else [stat.size, stat.mtime]
+    if not os.path.isfile(path):
+        return None
+    return [os.path.getsize(path), os.stat(path).st_mtime_ns]
+
+
+def _chunks(path):
+    if is_vsimem(path):
+        stream = gdal.VSIFOpenL(path, "rb")
+        try:
+            for chunk in iter(lambda: gdal.VSIFReadL(1, CHUNK_SIZE, stream), b""):
+                yield chunk
+        finally:
+            gdal.VSIFCloseL(stream)
+        return
+    with open(path, "rb") as stream:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+            yield chunk
+
+
+def _dataset_files(path):
+    ds = gdal.OpenEx(path)
+    files = (ds.GetFileList() if ds is not None else None) or [path]
+    ds = None
+    return sorted(f for f in files if _stat(f) is not None)
+
+
+def _code_stamp(*paths):
+    """
+    [name, size, modification time] of source files, to key outputs on the code that
+    computed them.
+    """
+    return [
+        [os.path.basename(path), os.path.getsize(path), os.stat(path).st_mtime_ns]
+        for path in paths
+        if path and os.path.isfile(path)
+    ]
+
+
+def _memory_checksum(layer):
+    digest = hashlib.sha256(layer.crs().authid().encode("utf-8"))
+    for feature in layer.getFeatures():
+        digest.update(bytes(feature.geometry().asWkb()))
+        digest.update(repr(feature.attributes()).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def copy_dataset(src, dst):
+    """
+    Copy a raster or vector dataset to ``dst``: file by file when both have the same
+    extension, else converted to the format of ``dst``.
+    """
+    src_base, ext = os.path.splitext(src)
+    dst_base, dst_ext = os.path.splitext(dst)
+    if ext.lower() == dst_ext.lower() and not (is_vsimem(src) or is_vsimem(dst)):
+        for f in _dataset_files(src):
+            if f.startswith(src_base):
+                shutil.copyfile(f, dst_base + f[len(src_base) :])
+        return dst
+    ds = gdal.OpenEx(src)
+    is_raster = ds is not None and ds.RasterCount > 0
+    ds = None
+    if is_raster:
+        return copy_raster(src, dst)
+    ds = gdal.VectorTranslate(
+        dst, src, format=QgsVectorFileWriter.driverForExtension(dst_ext)
+    )
+    if ds is None:
+        raise IOError(f"Could not copy {src} to {dst}")
+    ds = None
+    return dst
+
+
+class ArtifactCache(HydrologyCache):
+    """
+    Size-bounded, least-recently-used store of child algorithm outputs.
+
+    Entries are inspected, evicted and purged like those of the hydrology cache.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = get_or_create_path(
+            root or os.path.join(get_plugin_output_dir(), CACHE_DIRNAME)
+        )
+        if max_bytes is None:
+            max_bytes = (get_setting("artifact_cache_max_mb") or DEFAULT_MAX_MB) * 2**20
+        self.max_bytes = max_bytes
+        # Stages of a task graph use the cache from worker threads: the lock guards the
+        # checksum index and the entries' metadata, entries being restored or stored are
+        # counted in _in_use and never evicted
+        self._lock = threading.RLock()
+        self._checksums = None
+        self._in_use = {}
+
+    # Fingerprints
+
+    def checksum(self, path):
+        """
+        SHA-256 of the files making up a dataset, remembered per file size and
+        modification time. Files are told apart by their suffix after the dataset's base
+        name, so a copy of a dataset has the same checksum.
+        """
+        files = _dataset_files(path)
+        stamp = [_stat(f) for f in files]
+        with self._lock:
+            known = self._index().get(os.path.abspath(path))
+        if known and known["files"] == files and known["stamp"] == stamp:
+            return known["sha256"]
+
+        base = os.path.splitext(path)[0]
+        digest = hashlib.sha256()
+        for f in files:
+            digest.update(
+                (f[len(base) :] if f.startswith(base) else os.path.basename(f)).encode(
+                    "utf-8"
+                )
+            )
+            for chunk in _chunks(f):
+                digest.update(chunk)
+        self._register(path, digest.hexdigest())
+        return digest.hexdigest()
+
+    def _register(self, path, sha256):
+        """
+        Remember the checksum of a dataset as it is on disk now. /vsimem/ rasters only
+        live for one run and are not remembered.
+        """
+        if is_vsimem(path):
+            return
+        files = _dataset_files(path)
+        with self._lock:
+            index = self._index()
+            index[os.path.abspath(path)] = {
+                "files": files,
+                "stamp": [_stat(f) for f in files],
+                "sha256": sha256,
+            }
+            self._write_json(os.path.join(self.root, CHECKSUMS_FILE), index)
+
+    def _index(self):
+        if self._checksums is None:
+            self._checksums = (
+                self._read_json(os.path.join(self.root, CHECKSUMS_FILE)) or {}
+            )
+        return self._checksums
+
+    def fingerprint(self, value, context):
+        """
+        JSON-able fingerprint of a parameter value: plain values as they are, datasets by
+        checksum, memory layers by their features.
+        """
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        if isinstance(value, (list, tuple)):
+            return [self.fingerprint(v, context) for v in value]
+        if isinstance(value, dict):
+            return {k: self.fingerprint(v, context) for k, v in value.items()}
+        if isinstance(value, str):
+            path, _, options = value.partition("|")
+            if _stat(path) is not None:
+                return {"dataset": self.checksum(path), "options": options}
+            layer = QgsProcessingUtils.mapLayerFromString(value, context, False)
+            return value if layer is None else self.fingerprint(layer, context)
+        if isinstance(value, QgsMapLayer):
+            if value.providerType() == "memory":
+                return {
+                    "memory": value.customProperty(CHECKSUM_PROPERTY)
+                    or _memory_checksum(value)
+                }
+            path, _, options = value.source().partition("|")
+            if value.providerType() in ("gdal", "ogr") and _stat(path) is not None:
+                subset = (
+                    value.subsetString()
+                    if value.type() == QgsMapLayer.VectorLayer
+                    else ""
+                )
+                return {
+                    "dataset": self.checksum(path),
+                    "options": options,
+                    "subset": subset,
+                }
+        raise Uncacheable(f"{type(value).__name__} {value}")
+
+    def key(self, algorithm_id, parameters, context):
+        """
+        Cache key of a child algorithm run; destinations are not part of it.
+
+        :raises Uncacheable: if a parameter cannot be fingerprinted
+        """
+        algorithm = QgsApplication.processingRegistry().algorithmById(algorithm_id)
+        if algorithm is None:
+            raise Uncacheable(f"Unknown algorithm {algorithm_id}")
+        destinations = {p.name() for p in algorithm.destinationParameterDefinitions()}
+        # Outputs change with the code of the plugin's own algorithms and of the helpers
+        # they compute them with
+        code = _code_stamp(
+            inspect.getsourcefile(type(algorithm)),
+            *sorted(
+                os.path.join(UTILS_DIR, name)
+                for name in os.listdir(UTILS_DIR)
+                if name.endswith(".py")
+            ),
+        )
+        payload = json.dumps(
+            {
+                "algorithm": algorithm_id,
+                "qgis": Qgis.version(),
+                "code": code,
+                "parameters": {
+                    name: self.fingerprint(value, context)
+                    for name, value in parameters.items()
+                    if name not in destinations
+                },
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    # Entries
+
+    @contextmanager
+    def _using(self, key):
+        """
+        Keep the entry ``key`` from being evicted while the block copies from or to it.
+        """
+        with self._lock:
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_use[key] -= 1
+                if not self._in_use[key]:
+                    del self._in_use[key]
+
+    def lookup(self, key):
+        """
+        Metadata of the entry ``key``, or None on a miss. Refreshes the entry's LRU stamp.
+        """
+        meta_path = os.path.join(self.entry_dir(key), META_FILE)
+        with self._lock:
+            meta = self._read_json(meta_path)
+            if meta is None:
+                return None
+            files = [o["file"] for o in meta["outputs"].values() if "file" in o]
+            entry = self.entry_dir(key)
+            if not all(os.path.exists(os.path.join(entry, f)) for f in files):
+                self.purge(key)
+                return None
+            meta["last_used"] = time.time()
+            meta["hits"] = meta.get("hits", 0) + 1
+            self._write_json(meta_path, meta)
+        return meta
+
+    def evict(self, max_bytes=None, keep=None):
+        """
+        Drop least recently used entries until the cache is below ``max_bytes``, sparing
+        the entries being restored or stored.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self._lock:
+            entries = self.entries()
+            total = sum(meta["size"] for meta in entries)
+            evicted = []
+            for meta in reversed(entries):
+                if total <= max_bytes:
+                    break
+                if meta["key"] == keep or meta["key"] in self._in_use:
+                    continue
+                self.purge(meta["key"])
+                total -= meta["size"]
+                evicted.append(meta["key"])
+        return evicted
+
+    def restore(self, key, parameters, context):
+        """
+        Copy the stored outputs of ``key`` to the destinations in ``parameters``; memory
+        layer destinations get a memory layer in the context.
+
+        :return: the results of the stored run, None on a miss
+        """
+        with self._using(key):
+            return self._restore(key, parameters, context)
+
+    def _restore(self, key, parameters, context):
+        meta = self.lookup(key)
+        if meta is None:
+            return None
+        # Every destination is checked before anything is copied
+        destinations = {
+            name: _destination_path(parameters.get(name))
+            or QgsProcessingUtils.generateTempFilename(output["file"])
+            for name, output in meta["outputs"].items()
+            if "file" in output
+        }
+        results = {}
+        for name, output in meta["outputs"].items():
+            if name not in destinations:
+                results[name] = output["value"]
+                continue
+            stored = os.path.join(self.entry_dir(key), output["file"])
+            if destinations[name].startswith(MEMORY_OUTPUT):
+                layer = QgsVectorLayer(stored, name, "ogr").materialize(
+                    QgsFeatureRequest()
+                )
+                layer.setName(name)
+                layer.setCustomProperty(CHECKSUM_PROPERTY, output["sha256"])
+                context.temporaryLayerStore().addMapLayer(layer)
+                results[name] = layer.id()
+                continue
+            results[name] = copy_dataset(stored, destinations[name])
+            self._register(destinations[name], output["sha256"])
+        return results
+
+    def store(self, key, algorithm_id, parameters, results, context, **info):
+        """
+        Store the outputs of a run: a copy of every output dataset (memory layers as
+        GeoPackages), plain values as they are. Runs with outputs the cache cannot restore
+        are not stored.
+        """
+        with self._lock:
+            if key in self._in_use:
+                # Being stored by another task
+                return
+        with self._using(key):
+            self._store(key, algorithm_id, parameters, results, context, **info)
+        self.evict(keep=key)
+
+    def _store(self, key, algorithm_id, parameters, results, context, **info):
+        algorithm = QgsApplication.processingRegistry().algorithmById(algorithm_id)
+        destinations = {p.name() for p in algorithm.destinationParameterDefinitions()}
+        datasets = {}
+        for name in destinations:
+            value = results.get(name)
+            if value is None:
+                continue
+            path = str(value).split("|")[0]
+            if _stat(path) is not None:
+                datasets[name] = path
+                continue
+            layer = QgsProcessingUtils.mapLayerFromString(str(value), context, False)
+            if layer is None or layer.providerType() != "memory":
+                return
+            datasets[name] = layer
+        try:
+            json.dumps({n: v for n, v in results.items() if n not in destinations})
+        except TypeError:
+            return
+
+        entry = get_or_create_path(self.entry_dir(key))
+        outputs = {}
+        for name, value in results.items():
+            if name not in destinations:
+                outputs[name] = {"value": value}
+            elif isinstance(datasets.get(name), QgsMapLayer):
+                layer = datasets[name]
+                stored = name + ".gpkg"
+                options = QgsVectorFileWriter.SaveVectorOptions()
+                options.driverName = "GPKG"
+                error = QgsVectorFileWriter.writeAsVectorFormatV3(
+                    layer,
+                    os.path.join(entry, stored),
+                    context.transformContext(),
+                    options,
+                )[0]
+                if error != QgsVectorFileWriter.NoError:
+                    self.purge(key)
+                    return
+                sha256 = _memory_checksum(layer)
+                layer.setCustomProperty(CHECKSUM_PROPERTY, sha256)
+                outputs[name] = {"file": stored, "sha256": sha256}
+            elif name in datasets:
+                path = datasets[name]
+                stored = name + os.path.splitext(path)[1]
+                copy_dataset(path, os.path.join(entry, stored))
+                sha256 = self.checksum(os.path.join(entry, stored))
+                self._register(path, sha256)
+                outputs[name] = {"file": stored, "sha256": sha256}
+        now = time.time()
+        with self._lock:
+            self._write_json(
+                os.path.join(entry, META_FILE),
+                {
+                    "key": key,
+                    "algorithm": algorithm_id,
+                    "created": now,
+                    "last_used": now,
+                    "hits": 0,
+                    "size": _dir_size(entry),
+                    "outputs": outputs,
+                    **info,
+                },
+            )
+
+
+def _destination_path(value):
+    """
+    File path of a destination parameter value, None for a temporary output,
+    MEMORY_OUTPUT for a memory layer.
+
+    :raises Uncacheable: for destinations that are neither files nor memory layers
+    """
+    if isinstance(value, QgsProcessingOutputLayerDefinition):
+        value = value.sink.staticValue()
+    if not value or value == QgsProcessing.TEMPORARY_OUTPUT:
+        return None
+    if str(value).startswith(MEMORY_OUTPUT):
+        return MEMORY_OUTPUT
+    if _PROVIDER_URI.match(str(value)):
+        raise Uncacheable(f"Destination {value}")
+    return str(value)
+
+
+def run_cached(cache, algorithm_id, parameters, context, feedback):
+    """
+    Run a child algorithm, through ``cache`` unless it is None: on a hit the stored
+    outputs are copied to the destinations, on a miss the outputs are stored. Cache
+    lookups and stores show in traces as spans of their own.
+    """
+    key = None
+    if cache is not None:
+        with span(algorithm_id, "cache lookup") as args:
+            try:
+                key = cache.key(algorithm_id, parameters, context)
+                results = cache.restore(key, parameters, context)
+            except Uncacheable as e:
+                feedback.pushDebugInfo(f"{algorithm_id} not cached: {e}")
+                key, results = None, None
+            args["hit"] = results is not None
+        if results is not None:
+            if tracing():
+                args.update(output_stats(results, context))
+            feedback.pushInfo(f"{algorithm_id}: outputs of a previous run reused")
+            return results
+
+    results = run_child(algorithm_id, parameters, context, feedback)
+    if key is not None and not feedback.isCanceled():
+        with span(algorithm_id, "cache store"):
+            cache.store(key, algorithm_id, parameters, results, context)
+    return results
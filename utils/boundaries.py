@@ -0,0 +1,94 @@
+"""
+Outlines of raster masks, traced along cell edges.
+
+The mask is scanned once with NumPy for its boundary edges and only those are walked, so
+no cell-by-cell polygons and no intermediate vector layer are ever created.
+"""
+
+import numpy as np
+
+# Edge directions as (row, column) steps: west, south, east, north. Walking a boundary
+# edge with the mask on the left, the next direction counter-clockwise (on the map) is +1.
+EDGE_ROW = np.array([0, 1, 0, -1], dtype=np.int64)
+EDGE_COL = np.array([-1, 0, 1, 0], dtype=np.int64)
+
+
+def _boundary_edges(mask):
+    """
+    Directed boundary edges of a mask, with the mask on their left.
+
+    :return: start rows, start columns (on the grid of cell corners) and directions
+    """
+    padded = np.pad(mask, 1, constant_values=False)
+    inner = padded[1:-1, 1:-1]
+    sides = (
+        # outside neighbour, start corner offset, direction
+        (padded[:-2, 1:-1], (0, 1), 0),  # north side, walked westwards
+        (padded[1:-1, :-2], (0, 0), 1),  # west side, walked southwards
+        (padded[2:, 1:-1], (1, 0), 2),  # south side, walked eastwards
+        (padded[1:-1, 2:], (1, 1), 3),  # east side, walked northwards
+    )
+    rows, cols, dirs = [], [], []
+    for neighbour, (dr, dc), d in sides:
+        r, c = np.nonzero(inner & ~neighbour)
+        rows.append(r + dr)
+        cols.append(c + dc)
+        dirs.append(np.full(r.size, d, dtype=np.int64))
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(dirs)
+
+
+def mask_rings(mask):
+    """
+    Trace the outlines of the 4-connected regions of a boolean mask.
+
+    :return: list of (ring, is_exterior). Each ring is an (n, 2) array of (row, column)
+        cell-corner coordinates, closed (first vertex repeated last), without collinear
+        vertices. Exterior rings run counter-clockwise on the map, holes clockwise.
+    """
+    rows, cols, dirs = _boundary_edges(np.asarray(mask, dtype=bool))
+    if not rows.size:
+        return []
+    width = mask.shape[1] + 1
+    starts = (rows * width + cols).tolist()
+    ends = ((rows + EDGE_ROW[dirs]) * width + cols + EDGE_COL[dirs]).tolist()
+    dir_list = dirs.tolist()
+
+    # Outgoing edges of every corner; corners shared by two diagonal cells have two
+    outgoing = {}
+    for e, start in enumerate(starts):
+        outgoing.setdefault(start, []).append(e)
+
+    used = np.zeros(rows.size, dtype=bool)
+    rings = []
+    for first in range(rows.size):
+        if used[first]:
+            continue
+        edges = []
+        e = first
+        while not used[e]:
+            used[e] = True
+            edges.append(e)
+            candidates = outgoing[ends[e]]
+            if len(candidates) == 1:
+                e = candidates[0]
+            else:
+                # Turn towards the mask, keeping diagonal cells apart
+                left = (dir_list[e] + 1) % 4
+                e = next((c for c in candidates if dir_list[c] == left), candidates[0])
+
+        edges = np.array(edges, dtype=np.int64)
+        turns = dirs[edges] != np.roll(dirs[edges], 1)
+        corners = edges[turns]
+        ring = np.column_stack((rows[corners], cols[corners]))
+        ring = np.vstack((ring, ring[:1]))
+        rings.append((ring, _signed_area(ring) > 0))
+    return rings
+
+
+def _signed_area(ring):
+    """
+    Signed area of a closed (row, column) ring on the map (rows grow southwards),
+    positive when counter-clockwise.
+    """
+    r, c = ring[:, 0].astype(np.float64), ring[:, 1].astype(np.float64)
+    return -0.5 * float(np.sum(c[:-1] * r[1:] - c[1:] * r[:-1]))
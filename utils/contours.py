@@ -0,0 +1,227 @@
+"""
+Contour lines of a DEM by marching squares, on NumPy arrays.
+
+The grid is processed in bands of rows, in parallel; every band reads only its own window
+(plus the first row of the next band) and traces all the levels at once. Crossing points
+are identified by the grid edge they lie on, so the pieces of a line traced in different
+bands are joined exactly, without comparing coordinates. Cells with a nodata corner are
+skipped, so lines stop at the edge of the (masked) basin.
+"""
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from osgeo import gdal
+
+from gwat.utils.rasters import read_window
+
+# Rows per band
+BAND_ROWS = 256
+
+# Cell sides: top, right, bottom, left
+TOP, RIGHT, BOTTOM, LEFT = range(4)
+
+# Segments of every marching squares case, as pairs of cell sides. Case bits are the
+# corners above the level: top-left 8, top-right 4, bottom-right 2, bottom-left 1.
+# Saddles (5, 10) are resolved with the cell centre value, see _SADDLES.
+SEGMENTS = {
+    1: [(LEFT, BOTTOM)],
+    2: [(BOTTOM, RIGHT)],
+    3: [(LEFT, RIGHT)],
+    4: [(TOP, RIGHT)],
+    6: [(TOP, BOTTOM)],
+    7: [(TOP, LEFT)],
+    8: [(TOP, LEFT)],
+    9: [(TOP, BOTTOM)],
+    11: [(TOP, RIGHT)],
+    12: [(LEFT, RIGHT)],
+    13: [(BOTTOM, RIGHT)],
+    14: [(LEFT, BOTTOM)],
+}
+# Saddle case -> (segments when the centre is above, segments when below)
+_SADDLES = {
+    5: ([(TOP, LEFT), (BOTTOM, RIGHT)], [(TOP, RIGHT), (LEFT, BOTTOM)]),
+    10: ([(TOP, RIGHT), (LEFT, BOTTOM)], [(TOP, LEFT), (BOTTOM, RIGHT)]),
+}
+
+
+def contour_levels(z_min, z_max, intervals=10, interval=0):
+    """
+    Contour levels strictly inside [z_min, z_max]: multiples of ``interval``, or of a
+    round step giving about ``intervals`` intervals.
+    """
+    if not (math.isfinite(z_min) and math.isfinite(z_max)) or z_max <= z_min:
+        return []
+    if interval <= 0:
+        raw = (z_max - z_min) / max(intervals, 1)
+        magnitude = 10 ** math.floor(math.log10(raw))
+        interval = next(
+            m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw
+        )
+    first = math.floor(z_min / interval) + 1
+    last = math.ceil(z_max / interval) - 1
+    return [k * interval for k in range(first, last + 1)]
+
+
+def _band_lines(path, band, row0, row1, levels, geotransform):
+    """
+    Trace the cells of rows row0 .. row1 - 1 for every level.
+
+    :return: {level: list of (first edge id, last edge id, (n, 2) coordinates)}
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    cols, rows = ds.RasterXSize, ds.RasterYSize
+    z = read_window(ds, 0, row0, cols, min(row1 + 1, rows) - row0, band)
+    ds = None
+
+    a, b = z[:-1, :-1], z[:-1, 1:]
+    c, d = z[1:, 1:], z[1:, :-1]
+    valid = ~(np.isnan(a) | np.isnan(b) | np.isnan(c) | np.isnan(d))
+    centre = (a + b + c + d) / 4
+    vertical_offset = rows * cols
+
+    def edge_ids(r, cc, side):
+        # Global id of the grid edge on a side of the cells (r, cc) of the band
+        r = r + row0
+        return np.select(
+            [side == TOP, side == RIGHT, side == BOTTOM],
+            [r * cols + cc, vertical_offset + r * cols + cc + 1, (r + 1) * cols + cc],
+            vertical_offset + r * cols + cc,
+        )
+
+    def edge_points(ids, level):
+        vertical = ids >= vertical_offset
+        flat = np.where(vertical, ids - vertical_offset, ids)
+        r, cc = flat // cols - row0, flat % cols
+        r2 = np.where(vertical, r + 1, r)
+        c2 = np.where(vertical, cc, cc + 1)
+        z0, z1 = z[r, cc], z[r2, c2]
+        t = (level - z0) / (z1 - z0)
+        x = cc + np.where(vertical, 0.0, t) + 0.5
+        y = r + row0 + np.where(vertical, t, 0.0) + 0.5
+        gt = geotransform
+        return np.column_stack((gt[0] + x * gt[1], gt[3] + y * gt[5]))
+
+    lines = {}
+    for level in levels:
+        case = (a >= level) * 8 + (b >= level) * 4 + (c >= level) * 2 + (d >= level) * 1
+        case[~valid] = 0
+        starts, ends = [], []
+        for k in range(1, 15):
+            r, cc = np.nonzero(case == k)
+            if not r.size:
+                continue
+            if k in _SADDLES:
+                high = centre[r, cc] >= level
+                for segments, select in zip(_SADDLES[k], (high, ~high)):
+                    for s0, s1 in segments:
+                        starts.append(edge_ids(r[select], cc[select], s0))
+                        ends.append(edge_ids(r[select], cc[select], s1))
+            else:
+                for s0, s1 in SEGMENTS[k]:
+                    starts.append(edge_ids(r, cc, s0))
+                    ends.append(edge_ids(r, cc, s1))
+        if not starts:
+            continue
+        chains = link(np.concatenate(starts).tolist(), np.concatenate(ends).tolist())
+        lines[level] = [
+            (chain[0], chain[-1], edge_points(np.array(chain), level))
+            for chain in chains
+        ]
+    return lines
+
+
+def link(starts, ends):
+    """
+    Join segments (pairs of node ids) sharing end nodes into chains of node ids. Every node
+    joins at most two segments; closed chains repeat their first node last.
+    """
+    neighbours = {}
+    for s, (n0, n1) in enumerate(zip(starts, ends)):
+        neighbours.setdefault(n0, []).append(s)
+        neighbours.setdefault(n1, []).append(s)
+    used = [False] * len(starts)
+
+    def walk(node, segment):
+        chain = [node]
+        while segment is not None and not used[segment]:
+            used[segment] = True
+            node = ends[segment] if starts[segment] == node else starts[segment]
+            chain.append(node)
+            segment = next((s for s in neighbours[node] if not used[s]), None)
+        return chain
+
+    chains = []
+    # Open chains first, from their free ends
+    for node, segments in neighbours.items():
+        if len(segments) == 1 and not used[segments[0]]:
+            chains.append(walk(node, segments[0]))
+    for s in range(len(starts)):
+        if not used[s]:
+            chains.append(walk(starts[s], s))
+    return chains
+
+
+def _merge(pieces):
+    """
+    Join the pieces of lines traced in different bands at their shared end edges.
+
+    :return: list of (n, 2) coordinate arrays
+    """
+    if len(pieces) < 2:
+        return [coords for _, _, coords in pieces]
+    # Pieces are segments between their end edge ids
+    chains = link([p[0] for p in pieces], [p[1] for p in pieces])
+    by_ends = {}
+    for i, (first, last, _) in enumerate(pieces):
+        by_ends.setdefault((first, last), []).append(i)
+        by_ends.setdefault((last, first), []).append(-1 - i)
+    used = set()
+    merged = []
+    for chain in chains:
+        parts = []
+        for n0, n1 in zip(chain[:-1], chain[1:]):
+            i = next(
+                i for i in by_ends[(n0, n1)] if (i if i >= 0 else -1 - i) not in used
+            )
+            used.add(i if i >= 0 else -1 - i)
+            coords = pieces[i][2] if i >= 0 else pieces[-1 - i][2][::-1]
+            parts.append(coords if not parts else coords[1:])
+        merged.append(np.vstack(parts))
+    return merged
+
+
+def contour_lines(path, levels, band=1, workers=1, feedback=None):
+    """
+    Contour lines of a raster band, level by level.
+
+    :return: iterator of (level, (n, 2) coordinate array)
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError(f"Could not open raster {path}")
+    rows = ds.RasterYSize
+    geotransform = ds.GetGeoTransform()
+    ds = None
+
+    bands = [(r, min(r + BAND_ROWS, rows - 1)) for r in range(0, rows - 1, BAND_ROWS)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_band_lines, path, band, r0, r1, levels, geotransform)
+            for r0, r1 in bands
+        ]
+        results = []
+        for n, future in enumerate(futures):
+            if feedback is not None:
+                if feedback.isCanceled():
+                    for f in futures:
+                        f.cancel()
+                    return
+                feedback.setProgress(100 * n / len(futures))
+            results.append(future.result())
+
+    for level in levels:
+        pieces = [piece for lines in results for piece in lines.get(level, [])]
+        for coords in _merge(pieces):
+            yield level, coords
@@ -0,0 +1,205 @@
+"""
+SCS Curve Number computation on arrays.
+
+Corine and soil (geology) codes are mapped to integer indexes once, the CN of every
+polygon is then a lookup in a 2-D (land use class x hydrologic group) table, and the
+per-class shares of the basin are bincount reductions.
+"""
+
+import csv
+import os
+
+import numpy as np
+
+from gwat.utils.settings import cn_conditions_dir
+
+# Soil / geology code to hydrologic soil group
+GEO_TO_ABCD = {
+    "Y": "A",
+    "F": "A",
+    "R": "B",
+    "C": "C",
+    "T": "D",
+    "P": "C",
+    "X": "A",
+    "Z": "B",
+    "N": "B",
+    "A": "D",
+    "K": "A",
+    "H": "A",
+    "J": "C",
+    "V": "A",
+    "W": "C",
+    "L": "C",
+    "S": "B",
+    "E": "D",
+    "B": "A",
+    "M": "B",
+}
+
+# Corine code to (description, land use class 1-7)
+CORINE_TO_1_7 = {
+    "111": ["Συνεχής αστικός ιστός", 6],
+    "112": ["Ασυνεχής αστικός ιστός", 6],
+    "121": ["Βιομηχανικές ή εμπορικές ζώνες", 5],
+    "122": ["Οδικά & σιδηροδρομικά δίκτυα", 7],
+    "123": ["Ζώνες λιμένων", 7],
+    "124": ["Αεροδρόμια", 7],
+    "131": ["Χώροι εξορύξεως ορυκτών", 6],
+    "132": ["Χώροι απορρίψεως απορριμμάτων", 6],
+    "133": ["Χώροι οικοδόμησης", 6],
+    "141": ["Περιοχές αστικού πρασίνου", 4],
+    "142": ["Εγκαταστάσεις αθλητισμού και αναψυχής", 4],
+    "211": ["Μη αρδευόμενη αρόσιμη γη", 1],
+    "212": ["Μόνιμα αρδευόμενη γη", 1],
+    "213": ["Ορυζώνες", 1],
+    "221": ["Αμπελώνες", 1],
+    "222": ["Οπωροφόρα δένδρα και φυτείες με σαρκώδεις καρπούς", 1],
+    "223": ["Ελαιώνες", 1],
+    "231": ["Λιβάδια", 2],
+    "241": ["Ετήσιες καλλιέργειες που συνδέονται με μόνιμες καλλιέργειες", 1],
+    "242": ["Σύνθετες Καλλιέργειες", 1],
+    "243": [
+        "Γη που χρησιμοποιείται κυρίως για γεωργία με σημαντικά τμήματα φυσικής βλάστησης",
+        1,
+    ],
+    "244": ["Γεωργο-δασικές Περιοχές", 1],
+    "311": ["Δάσος πλατυφύλλων", 3],
+    "312": ["Δάσος κωνοφόρων", 3],
+    "313": ["Μικτό δάσος", 3],
+    "321": ["Φυσικοί  βοσκότοποι", 2],
+    "322": ["Θάμνοι και χερσότοποι", 2],
+    "323": ["Σκληροφυλλική βλάστηση", 2],
+    "324": ["Μεταβατικές δασώδεις θαμνώδεις εκτάσεις", 3],
+    "331": ["Παραλίες, αμμόλοφοι, αμμουδιές", 3],
+    "332": ["Απογυμνωμένοι βράχοι", 7],
+    "333": ["Εκτάσεις με αραιή βλάστηση", 2],
+    "334": ["Αποτεφρωμένες εκτάσεις", 6],
+    "335": ["Παγετώνες και αέναο χιόνι", 7],
+    "411": ["Βάλτοι στην ενδοχώρα", 7],
+    "412": ["Τυρφώνες", 7],
+    "421": ["Παραθαλάσσιοι βάλτοι", 7],
+    "422": ["Αλυκές", 7],
+    "423": ["Ζώνες που καλύπτονται από παλιρροιακά ύδατα", 7],
+    "511": ["Υδατορρεύματα", 7],
+    "512": ["Επιφάνειες στάσιμου ύδατος", 7],
+    "521": ["Παράκτιες λιμνοθάλασσες", 7],
+    "522": ["Εκβολές ποταμών", 7],
+    "523": ["Θάλασσες και ωκεανοί", 7],
+}
+
+HYDRO_GROUPS = "ABCD"
+LAND_USE_CLASSES = 7
+
+# Corine codes counted as urban cover
+URBAN_CODES = ("111", "112", "121", "122", "123", "124", "141", "142")
+
+CONDITIONS = ["Δυσμενείς", "Μέσες", "Ευμενείς"]
+CONDITIONS_FILES = ["unfavorable.csv", "mean.csv", "favorable.csv"]
+
+CORINE_CODES = np.array(sorted(CORINE_TO_1_7))
+CORINE_DESCRIPTIONS = [CORINE_TO_1_7[code][0] for code in CORINE_CODES]
+CORINE_LAND_USE = np.array([CORINE_TO_1_7[code][1] for code in CORINE_CODES])
+GEO_CODES = np.array(sorted(GEO_TO_ABCD))
+GEO_GROUP = np.array([HYDRO_GROUPS.index(GEO_TO_ABCD[code]) for code in GEO_CODES])
+
+
+def cn_table(conditions_index):
+    """
+    CN lookup table for the given conditions (0: unfavorable, 1: mean, 2: favorable),
+    indexed by [land use class 1-7, hydrologic group A-D]. Missing combinations are NaN.
+    """
+    table = np.full((LAND_USE_CLASSES + 1, len(HYDRO_GROUPS)), np.nan)
+    path = os.path.join(cn_conditions_dir(), CONDITIONS_FILES[conditions_index])
+    with open(path, "r", encoding="utf-8") as cond_file:
+        for row in csv.reader(cond_file):
+            table[int(row[0][:-1]), HYDRO_GROUPS.index(row[0][-1])] = float(row[1])
+    return table
+
+
+def code_index(codes, known):
+    """
+    Position of every code in the sorted array ``known``, -1 for unknown codes.
+    """
+    codes = np.asarray(codes, dtype=str)
+    if not codes.size:
+        return np.zeros(0, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(known, codes), known.size - 1)
+    return np.where(known[pos] == codes, pos, -1)
+
+
+def curve_numbers(corine_codes, geo_codes, areas, basin_area, table):
+    """
+    CN of every polygon of a Corine / soil overlay and the per-class shares of the basin.
+
+    :param corine_codes: Corine code of every polygon
+    :param geo_codes: soil / geology code of every polygon
+    :param areas: area of every polygon
+    :param basin_area: area of the basin
+    :param table: CN table, see `cn_table`
+    :return: dict of per-polygon arrays (``valid`` polygons have known codes and CN)
+        and of aggregates: ``corine_share`` and ``cn_share`` (% of the basin per Corine
+        class / CN value), ``cn`` (area-weighted CN), ``urban_share`` and ``urban``
+        (% urban cover)
+    """
+    corine = code_index(corine_codes, CORINE_CODES)
+    geo = code_index(geo_codes, GEO_CODES)
+    land_use = np.where(corine >= 0, CORINE_LAND_USE[corine], 0)
+    group = np.where(geo >= 0, GEO_GROUP[geo], 0)
+    cn = table[land_use, group]
+    valid = (corine >= 0) & (geo >= 0) & ~np.isnan(cn)
+
+    percentage = np.round(np.asarray(areas, dtype=np.float64) / basin_area * 100, 3)
+    share = np.where(valid, percentage, 0.0)
+
+    corine_share = np.bincount(
+        corine[valid], weights=share[valid], minlength=CORINE_CODES.size
+    )
+    cn_values, cn_inverse = np.unique(cn[valid], return_inverse=True)
+    cn_share = np.bincount(cn_inverse, weights=share[valid], minlength=cn_values.size)
+    present = np.bincount(corine[valid], minlength=CORINE_CODES.size) > 0
+    urban = np.isin(CORINE_CODES, URBAN_CODES)
+
+    return {
+        "valid": valid,
+        "percentage": percentage,
+        "land_use": land_use,
+        "group": group,
+        "corine": corine,
+        "curve_number": cn,
+        "corine_share": {
+            CORINE_DESCRIPTIONS[i]: float(corine_share[i])
+            for i in np.flatnonzero(present)
+        },
+        "cn_share": dict(zip(cn_values.tolist(), cn_share.tolist())),
+        "cn": (
+            float(np.dot(cn_values, cn_share) / cn_share.sum())
+            if cn_share.sum()
+            else float("nan")
+        ),
+        "urban_share": {
+            CORINE_DESCRIPTIONS[i]: float(corine_share[i])
+            for i in np.flatnonzero(urban & present)
+        },
+        "urban": float(corine_share[urban].sum()),
+    }
+
+
+def overlay_grid(corine, geo):
+    """
+    Overlay of Corine and soil grids of code indexes (see `code_index`, -1 for no data).
+
+    :return: the label grid (-1 outside the overlay) and, for every label, the Corine
+        code, the soil code and the number of cells
+    """
+    inside = (corine >= 0) & (geo >= 0)
+    pairs = corine[inside].astype(np.int64) * GEO_CODES.size + geo[inside]
+    unique, inverse, counts = np.unique(pairs, return_inverse=True, return_counts=True)
+    labels = np.full(corine.shape, -1, dtype=np.int64)
+    labels[inside] = inverse.ravel()
+    return (
+        labels,
+        CORINE_CODES[unique // GEO_CODES.size].tolist(),
+        GEO_CODES[unique % GEO_CODES.size].tolist(),
+        counts,
+    )
@@ -0,0 +1,157 @@
+"""
+Single-pass, blockwise statistics of a DEM.
+
+The raster is streamed in strips of whole blocks, so memory is bounded by the strip size,
+and every statistic is accumulated in the same pass: count, minimum, maximum, mean and
+standard deviation (merged per strip, Chan et al.), a histogram with fixed-width elevation
+bins and the hypsometric integral.
+"""
+
+import math
+
+import numpy as np
+from osgeo import gdal
+
+from gwat.utils.rasters import rasterize, read_window, world_to_cell
+
+# Width of the elevation histogram bins (m)
+HISTOGRAM_BIN_WIDTH = 10.0
+# Cells per strip read at once
+BLOCK_CELLS = 2**22
+
+
+class DemStatistics:
+    """
+    Running statistics of elevation values.
+    """
+
+    def __init__(self, bin_width=HISTOGRAM_BIN_WIDTH):
+        self.bin_width = bin_width
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.mean = 0.0
+        self._m2 = 0.0
+        # Histogram of the bins first_bin, first_bin + 1, ...
+        self.first_bin = None
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, values):
+        """
+        Accumulate a batch of (valid) elevation values.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if not values.size:
+            return
+        n = values.size
+        mean = float(values.mean())
+        m2 = float(np.sum((values - mean) ** 2))
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self._m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        bins = np.floor(values / self.bin_width).astype(np.int64)
+        low, high = int(bins.min()), int(bins.max())
+        if self.first_bin is None:
+            self.first_bin = low
+        if low < self.first_bin:
+            self.counts = np.concatenate(
+                (np.zeros(self.first_bin - low, dtype=np.int64), self.counts)
+            )
+            self.first_bin = low
+        size = max(self.counts.size, high - self.first_bin + 1)
+        if size > self.counts.size:
+            self.counts = np.concatenate(
+                (self.counts, np.zeros(size - self.counts.size, dtype=np.int64))
+            )
+        self.counts += np.bincount(bins - self.first_bin, minlength=size)
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / self.count) if self.count else math.nan
+
+    @property
+    def hypsometric_integral(self):
+        """
+        (mean - min) / (max - min), the elevation-relief ratio.
+        """
+        if not self.count or self.max == self.min:
+            return math.nan
+        return (self.mean - self.min) / (self.max - self.min)
+
+    def histogram(self):
+        """
+        :return: (bin edges, cell counts); there is one more edge than counts
+        """
+        if self.first_bin is None:
+            return np.zeros(1), self.counts
+        edges = (
+            self.first_bin + np.arange(self.counts.size + 1, dtype=np.float64)
+        ) * self.bin_width
+        return edges, self.counts
+
+
+def raster_statistics(path, band=1, feedback=None):
+    """
+    Statistics of the valid cells of a raster band, read in strips of whole blocks.
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError(f"Could not open raster {path}")
+    cols, rows = ds.RasterXSize, ds.RasterYSize
+    block_rows = ds.GetRasterBand(band).GetBlockSize()[1]
+    strip = max(1, BLOCK_CELLS // cols // block_rows) * block_rows
+
+    stats = DemStatistics()
+    for row0 in range(0, rows, strip):
+        if feedback is not None:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(100 * row0 / rows)
+        values = read_window(ds, 0, row0, cols, min(strip, rows - row0), band)
+        stats.add(values[~np.isnan(values)])
+    ds = None
+    return stats
+
+
+def masked_statistics(path, wkb, extent, band=1, feedback=None):
+    """
+    Statistics of the cells of a raster band inside a polygon (by cell centre).
+
+    Only the window covering the polygon is read, in strips, each masked with the polygon
+    rasterized in memory: no clipped raster is written.
+
+    :param wkb: the polygon as WKB, in the CRS of the raster
+    :param extent: (xmin, ymin, xmax, ymax) of the polygon
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError(f"Could not open raster {path}")
+    gt = ds.GetGeoTransform()
+    projection = ds.GetProjection()
+    xmin, ymin, xmax, ymax = extent
+    row0, col0 = world_to_cell(gt, xmin, ymax)
+    row1, col1 = world_to_cell(gt, xmax, ymin)
+    row0, col0 = max(row0, 0), max(col0, 0)
+    row1, col1 = min(row1, ds.RasterYSize - 1), min(col1, ds.RasterXSize - 1)
+    cols = col1 - col0 + 1
+    block_rows = ds.GetRasterBand(band).GetBlockSize()[1]
+    strip = max(1, BLOCK_CELLS // max(cols, 1) // block_rows) * block_rows
+
+    stats = DemStatistics()
+    for top in range(row0, row1 + 1, strip):
+        if feedback is not None:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(100 * (top - row0) / (row1 - row0 + 1))
+        rows = min(strip, row1 + 1 - top)
+        window_gt = (gt[0] + col0 * gt[1], gt[1], 0.0, gt[3] + top * gt[5], 0.0, gt[5])
+        inside = rasterize([wkb], [1], window_gt, cols, rows, projection, 0) == 1
+        values = read_window(ds, col0, top, cols, rows, band)[inside]
+        stats.add(values[~np.isnan(values)])
+    ds = None
+    return stats
@@ -0,0 +1,431 @@
+"""
+In-process D8 hydrology engine operating on NumPy arrays.
+
+Flow directions follow the SAGA convention (0 = north, clockwise up to 7 = north-west,
+-1 = no downslope neighbour), so the rasters produced here are interchangeable with the
+outputs of the `sagang:` tools used elsewhere in the plugin.
+"""
+
+import heapq
+import math
+
+import numpy as np
+
+# D8 neighbourhood in SAGA's direction order (0 = north, clockwise)
+D8_ROW = np.array([-1, -1, 0, 1, 1, 1, 0, -1], dtype=np.int64)
+D8_COL = np.array([0, 1, 1, 1, 0, -1, -1, -1], dtype=np.int64)
+
+NO_FLOW = -1
+
+
+def d8_distances(cell_width, cell_height):
+    """
+    Ground distance to each of the 8 neighbours, in map units.
+    """
+    return np.hypot(D8_ROW * cell_height, D8_COL * cell_width)
+
+
+def min_drops(cell_size, minslope):
+    """
+    Minimum elevation drop towards each of the 8 neighbours, for a slope in degrees.
+    """
+    return math.tan(math.radians(minslope)) * d8_distances(*cell_size)
+
+
+def _flood(elev, passable, seeds, seed_values, mindiff, progress=None):
+    """
+    Priority-flood (Wang & Liu) over a padded grid.
+
+    All arrays are 2D and padded so that every passable cell has 8 in-grid neighbours.
+    Cells are relaxed Dijkstra-style, so the result is the minimal surface satisfying
+    filled >= elev and filled >= min(neighbour + mindiff) regardless of the seed order.
+    """
+    rows, cols = elev.shape
+    offsets = (D8_ROW * cols + D8_COL).tolist()
+    steps = list(zip(offsets, np.asarray(mindiff, dtype=np.float64).tolist()))
+
+    filled = np.full(elev.size, np.inf)
+    done = np.zeros(elev.size, dtype=np.uint8)
+    z_in = memoryview(np.ascontiguousarray(elev, dtype=np.float64).ravel())
+    ok = memoryview(np.ascontiguousarray(passable, dtype=np.uint8).ravel())
+    z_out = memoryview(filled)
+    closed = memoryview(done)
+
+    filled[seeds] = seed_values
+    heap = list(zip(np.asarray(seed_values, dtype=np.float64).tolist(), seeds.tolist()))
+    heapq.heapify(heap)
+
+    total = int(np.count_nonzero(passable)) or 1
+    popped = 0
+    pop, push = heapq.heappop, heapq.heappush
+    while heap:
+        z, i = pop(heap)
+        if closed[i] or z > z_out[i]:
+            continue
+        closed[i] = 1
+        popped += 1
+        if progress is not None and not popped & 0xFFFF:
+            if progress(min(popped / total, 1.0)):
+                return None
+        for off, dz in steps:
+            n = i + off
+            if not ok[n] or closed[n]:
+                continue
+            cand = z + dz
+            e = z_in[n]
+            if e > cand:
+                cand = e
+            if cand < z_out[n]:
+                z_out[n] = cand
+                push(heap, (cand, n))
+
+    return filled.reshape(rows, cols)
+
+
+def _outlets(valid_padded):
+    """
+    Valid cells touching nodata or the grid edge. These drain freely and seed the flood.
+    """
+    rows, cols = valid_padded.shape
+    outlet = np.zeros_like(valid_padded)
+    inner = valid_padded[1:-1, 1:-1]
+    for dr, dc in zip(D8_ROW.tolist(), D8_COL.tolist()):
+        neighbour = valid_padded[1 + dr : rows - 1 + dr, 1 + dc : cols - 1 + dc]
+        outlet[1:-1, 1:-1] |= inner & ~neighbour
+    return outlet
+
+
+def fill_sinks(dem, valid, cell_size, minslope=0.01, progress=None):
+    """
+    Fill the depressions of a DEM, preserving a minimum downslope gradient.
+
+    :param dem: 2D elevation array
+    :param valid: boolean mask of cells holding data
+    :param cell_size: (cell width, cell height) in map units
+    :param minslope: minimum slope to preserve, in degrees (SAGA's MINSLOPE)
+    :param progress: optional callable(fraction) returning True to abort
+    :return: the filled DEM (float64, NaN outside ``valid``) or None when aborted
+    """
+    valid_padded = np.pad(valid, 1, constant_values=False)
+    elev = np.pad(
+        np.where(valid, dem, np.nan).astype(np.float64), 1, constant_values=np.nan
+    )
+    seeds = np.flatnonzero(_outlets(valid_padded))
+    mindiff = min_drops(cell_size, minslope)
+
+    filled = _flood(elev, valid_padded, seeds, elev.ravel()[seeds], mindiff, progress)
+    if filled is None:
+        return None
+    filled = filled[1:-1, 1:-1]
+    filled[~valid] = np.nan
+    return filled
+
+
+def flow_directions(filled, cell_size):
+    """
+    Steepest-descent D8 flow directions of a (filled) DEM.
+
+    NaN cells are nodata: they get no direction and never receive flow. Ties are
+    resolved in favour of the lowest direction code.
+    """
+    rows, cols = filled.shape
+    padded = np.pad(filled.astype(np.float64), 1, constant_values=np.nan)
+    distances = d8_distances(*cell_size)
+
+    best_drop = np.zeros((rows, cols))
+    fdir = np.full((rows, cols), NO_FLOW, dtype=np.int16)
+    with np.errstate(invalid="ignore"):
+        for k in range(8):
+            dr, dc = int(D8_ROW[k]), int(D8_COL[k])
+            neighbour = padded[1 + dr : rows + 1 + dr, 1 + dc : cols + 1 + dc]
+            drop = (filled - neighbour) / distances[k]
+            steeper = drop > best_drop
+            best_drop[steeper] = drop[steeper]
+            fdir[steeper] = k
+    fdir[np.isnan(filled)] = NO_FLOW
+    return fdir
+
+
+def downstream_index(fdir, return_exits=False):
+    """
+    Flat index of the D8 receiver of every cell, -1 where the flow ends or leaves the grid.
+
+    With ``return_exits`` the cells whose flow leaves the grid are also returned, as
+    (flat source index, target row, target column) relative to the grid origin.
+    """
+    rows, cols = fdir.shape
+    flat = fdir.ravel()
+    down = np.full(flat.size, -1, dtype=np.int64)
+    src = np.flatnonzero(flat >= 0)
+    d = flat[src]
+    r = src // cols + D8_ROW[d]
+    c = src % cols + D8_COL[d]
+    inside = (r >= 0) & (r < rows) & (c >= 0) & (c < cols)
+    down[src[inside]] = r[inside] * cols + c[inside]
+    if return_exits:
+        outside = ~inside
+        return down, (src[outside], r[outside], c[outside])
+    return down
+
+
+def topological_levels(down):
+    """
+    Yield the cells of a D8 flow graph in upstream-to-downstream order, one front at a time.
+
+    Each yielded array holds cells whose whole upstream area has already been yielded.
+    """
+    has = down >= 0
+    indeg = np.bincount(down[has], minlength=down.size)
+    front = np.flatnonzero(indeg == 0)
+    while front.size:
+        yield front
+        tgt = down[front]
+        tgt = tgt[tgt >= 0]
+        if not tgt.size:
+            break
+        cells, counts = np.unique(tgt, return_counts=True)
+        indeg[cells] -= counts
+        front = cells[indeg[cells] == 0]
+
+
+def accumulate(down, weights):
+    """
+    Sum ``weights`` downstream along a flow graph given as receiver indexes.
+    """
+    acc = np.array(weights, dtype=np.float64).ravel()
+    for front in topological_levels(down):
+        tgt = down[front]
+        moving = tgt >= 0
+        if not moving.any():
+            continue
+        cells, inverse = np.unique(tgt[moving], return_inverse=True)
+        acc[cells] += np.bincount(inverse, weights=acc[front[moving]])
+    return acc
+
+
+def flow_accumulation(fdir, weights=None):
+    """
+    D8 flow accumulation (number of cells draining through each cell, itself included).
+
+    :param fdir: D8 flow directions
+    :param weights: optional per-cell contribution (defaults to 1 for every cell)
+    """
+    if weights is None:
+        weights = np.ones(fdir.size)
+    return accumulate(downstream_index(fdir), weights).reshape(fdir.shape)
+
+
+def upslope_area(fdir, row, col):
+    """
+    Boolean mask of the cells draining through cell (row, col), the cell itself included.
+
+    The basin is grown upstream one front at a time, so only the basin cells and their
+    neighbours are visited.
+    """
+    rows, cols = fdir.shape
+    width = cols + 2
+    padded = np.pad(fdir, 1, constant_values=NO_FLOW).ravel()
+    offsets = D8_ROW * width + D8_COL
+    inside = np.zeros(padded.size, dtype=bool)
+    front = np.array([(row + 1) * width + col + 1], dtype=np.int64)
+    inside[front] = True
+    while front.size:
+        found = []
+        for k in range(8):
+            # The neighbour in direction k drains into the front if it points back
+            n = front + offsets[k]
+            found.append(n[(padded[n] == (k + 4) % 8) & ~inside[n]])
+        front = np.concatenate(found)
+        inside[front] = True
+    return inside.reshape(rows + 2, width)[1:-1, 1:-1]
+
+
+def drainage_labels(down, seeds, labels):
+    """
+    Propagate ``labels`` from the ``seeds`` cells to every cell draining into them.
+
+    Cells that do not drain into any seed are labelled -1.
+    """
+    out = np.full(down.size, -1, dtype=np.int64)
+    out[seeds] = labels
+    is_seed = np.zeros(down.size, dtype=bool)
+    is_seed[seeds] = True
+    for front in reversed(list(topological_levels(down))):
+        front = front[~is_seed[front]]
+        tgt = down[front]
+        moving = tgt >= 0
+        out[front[moving]] = out[tgt[moving]]
+    return out
+
+
+def nested_basins(down, seeds):
+    """
+    Delineate the basins of several outlets in one pass.
+
+    :param down: receiver index of every cell
+    :param seeds: flat indexes of the (distinct) outlet cells
+    :return: (labels, members) - ``labels`` gives, for every cell, the position in ``seeds``
+        of the first outlet downstream of it (-1 if none); ``members[k]`` lists the
+        positions of the outlets whose incremental basins make up the full basin of outlet k
+    """
+    labels = drainage_labels(down, seeds, np.arange(seeds.size))
+    below = down[seeds]
+    parent = np.where(below >= 0, labels[np.maximum(below, 0)], -1).tolist()
+
+    members = [[k] for k in range(seeds.size)]
+    for k in range(seeds.size):
+        p = parent[k]
+        while p != -1:
+            members[p].append(k)
+            p = parent[p]
+    return labels, members
+
+
+def flow_steps(fdir, cell_size):
+    """
+    Length of the D8 step from every cell to its receiver (0 where there is no flow).
+    """
+    distances = np.append(d8_distances(*cell_size), 0.0)
+    return distances[np.where(fdir >= 0, fdir, 8)].ravel()
+
+
+def upstream_flow_length(down, steps):
+    """
+    Longest flow length from the divide down to every cell, in one sweep of the flow graph.
+
+    :param down: receiver index of every cell
+    :param steps: length of the step from every cell to its receiver
+    :return: (length, predecessor) - predecessor is the upstream cell the longest path
+        arrives from, -1 at the divide
+    """
+    length = np.zeros(down.size)
+    predecessor = np.full(down.size, -1, dtype=np.int64)
+    for front in topological_levels(down):
+        moving = front[down[front] >= 0]
+        if not moving.size:
+            continue
+        reach = length[moving] + steps[moving]
+        tgt = down[moving]
+        # Longest arrival at every receiver from this front (the lowest cell on ties),
+        # kept if longer than the arrivals from the earlier fronts
+        order = np.lexsort((-reach, tgt))
+        moving, reach, tgt = moving[order], reach[order], tgt[order]
+        best = np.r_[True, tgt[1:] != tgt[:-1]]
+        moving, reach, tgt = moving[best], reach[best], tgt[best]
+        longer = reach > length[tgt]
+        length[tgt[longer]] = reach[longer]
+        predecessor[tgt[longer]] = moving[longer]
+    return length, predecessor
+
+
+def trace_back(predecessor, cell):
+    """
+    Cells from the divide down to ``cell``, following the predecessors.
+    """
+    path = [cell]
+    while predecessor[path[-1]] >= 0:
+        path.append(int(predecessor[path[-1]]))
+    return path[::-1]
+
+
+def channel_cells(acc, down, threshold):
+    """
+    Channel cells (accumulation greater than ``threshold``) and their channel receivers.
+    """
+    cells = np.flatnonzero(acc.ravel() > threshold)
+    return cells, down[cells]
+
+
+def strahler_order(cells, receivers):
+    """
+    Strahler order of a channel graph.
+
+    :param cells: sorted flat indexes of the channel cells
+    :param receivers: flat index of the receiver of each cell, -1 at outlets
+    """
+    n = cells.size
+    to = np.full(n, -1, dtype=np.int64)
+    has = receivers >= 0
+    to[has] = np.searchsorted(cells, receivers[has])
+
+    order = np.zeros(n, dtype=np.int32)
+    max_in = np.zeros(n, dtype=np.int32)
+    n_max = np.zeros(n, dtype=np.int32)
+    for front in topological_levels(to):
+        order[front] = np.where(
+            max_in[front] == 0, 1, max_in[front] + (n_max[front] > 1)
+        )
+        src = front[to[front] >= 0]
+        if not src.size:
+            continue
+        tgt = to[src]
+        batch_max = np.zeros(n, dtype=np.int32)
+        np.maximum.at(batch_max, tgt, order[src])
+        batch_n = np.bincount(tgt[order[src] == batch_max[tgt]], minlength=n)
+
+        targets = np.unique(tgt)
+        new_max = np.maximum(max_in[targets], batch_max[targets])
+        n_max[targets] = (max_in[targets] == new_max) * n_max[targets] + (
+            batch_max[targets] == new_max
+        ) * batch_n[targets]
+        max_in[targets] = new_max
+    return order, to
+
+
+def channel_segments(cells, to, order, step_length):
+    """
+    Split a channel graph into segments running from springs/junctions down to the
+    next junction or outlet.
+
+    :param cells: sorted flat indexes of the channel cells
+    :param to: position (in ``cells``) of each cell's receiver, -1 at outlets
+    :param order: Strahler order of each cell
+    :param step_length: callable(from_cells, to_cells) giving the length of each step
+    :return: list of (cell indexes, order, node A, node B, length)
+    """
+    n_up = np.bincount(to[to >= 0], minlength=cells.size)
+    starts = np.flatnonzero(n_up != 1)
+    to_list = to.tolist()
+    n_up_list = n_up.tolist()
+
+    nodes = {}
+    segments = []
+    for start in starts.tolist():
+        path = [start]
+        cur = to_list[start]
+        while cur != -1:
+            path.append(cur)
+            if n_up_list[cur] != 1:
+                break
+            cur = to_list[cur]
+        if len(path) < 2:
+            continue
+        node_a = nodes.setdefault(path[0], len(nodes) + 1)
+        node_b = nodes.setdefault(path[-1], len(nodes) + 1)
+        path = np.array(path, dtype=np.int64)
+        length = float(step_length(cells[path[:-1]], cells[path[1:]]).sum())
+        segments.append((cells[path], int(order[path[0]]), node_a, node_b, length))
+    return segments
+
+
+def step_lengths(n_cols, cell_size):
+    """
+    Build a ``step_length`` callable for grids of ``n_cols`` columns.
+    """
+    cell_width, cell_height = cell_size
+
+    def _length(src, dst):
+        dr = dst // n_cols - src // n_cols
+        dc = dst % n_cols - src % n_cols
+        return np.hypot(dr * cell_height, dc * cell_width)
+
+    return _length
+
+
+def strahler_grid(shape, cells, order, nodata=0):
+    """
+    Rasterize the Strahler order of the channel cells.
+    """
+    grid = np.full(shape[0] * shape[1], nodata, dtype=np.int16)
+    grid[cells] = order
+    return grid.reshape(shape)
@@ -0,0 +1,202 @@
+"""
+Persistent cache of the threshold-independent Step 1 grids.
+
+The filled DEM, the flow directions and the accumulation grid only depend on the DEM and
+on the fill/routing parameters, so they are stored under the plugin output folder keyed by
+a checksum of the DEM's content plus those parameters. Later runs, e.g. with another
+channel initiation threshold, go straight to the channel network extraction.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from osgeo import gdal
+
+from gwat.utils.files import get_plugin_output_dir, get_or_create_path
+from gwat.utils.rasters import copy_raster
+from gwat.utils.settings import get_setting
+
+
+CACHE_DIRNAME = "hydrology_cache"
+CACHED_GRIDS = ("filled", "flow_directions", "accumulation")
+META_FILE = "meta.json"
+CHECKSUMS_FILE = "checksums.json"
+DEFAULT_MAX_MB = 20480
+CHUNK_SIZE = 4 * 2**20
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+class HydrologyCache:
+    """
+    Size-bounded, least-recently-used store of filled DEM / flow directions / accumulation.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = get_or_create_path(
+            root or os.path.join(get_plugin_output_dir(), CACHE_DIRNAME)
+        )
+        if max_bytes is None:
+            max_bytes = (get_setting("hydrology_cache_max_mb") or DEFAULT_MAX_MB) * 2**20
+        self.max_bytes = max_bytes
+
+    # Keys
+
+    def dem_checksum(self, dem_path):
+        """
+        SHA-256 of the files making up a raster dataset.
+
+        Checksums are remembered per file size and modification time, so an unchanged DEM
+        is only hashed once.
+        """
+        ds = gdal.Open(dem_path, gdal.GA_ReadOnly)
+        files = sorted(ds.GetFileList() or [dem_path]) if ds is not None else [dem_path]
+        ds = None
+
+        index_path = os.path.join(self.root, CHECKSUMS_FILE)
+        index = self._read_json(index_path) or {}
+        stamp = [[os.path.getsize(f), os.stat(f).st_mtime_ns] for f in files]
+        known = index.get(os.path.abspath(dem_path))
+        if known and known["files"] == files and known["stamp"] == stamp:
+            return known["sha256"]
+
+        digest = hashlib.sha256()
+        for f in files:
+            digest.update(os.path.basename(f).encode("utf-8"))
+            with open(f, "rb") as stream:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+        index[os.path.abspath(dem_path)] = {
+            "files": files,
+            "stamp": stamp,
+            "sha256": digest.hexdigest(),
+        }
+        self._write_json(index_path, index)
+        return digest.hexdigest()
+
+    def key(self, dem_path, **params):
+        """
+        Cache key of a DEM and the parameters its hydrology grids depend on.
+        """
+        payload = json.dumps(
+            {"dem": self.dem_checksum(dem_path), **params}, sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    # Entries
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def grid_path(self, key, name):
+        return os.path.join(self.entry_dir(key), f"{name}.tif")
+
+    def lookup(self, key):
+        """
+        Paths of the cached grids for ``key``, or None on a miss. Refreshes the entry's LRU stamp.
+        """
+        meta_path = os.path.join(self.entry_dir(key), META_FILE)
+        meta = self._read_json(meta_path)
+        if meta is None:
+            return None
+        paths = {name: self.grid_path(key, name) for name in CACHED_GRIDS}
+        if not all(os.path.exists(p) for p in paths.values()):
+            self.purge(key)
+            return None
+        meta["last_used"] = time.time()
+        meta["hits"] = meta.get("hits", 0) + 1
+        self._write_json(meta_path, meta)
+        return paths
+
+    def store(self, key, grids, **info):
+        """
+        Store the grids of a run. ``grids`` maps each of ``CACHED_GRIDS`` to a raster path.
+
+        The rasters are copied to GeoTIFF, then least recently used entries are evicted
+        until the cache fits its size budget again.
+        """
+        entry = get_or_create_path(self.entry_dir(key))
+        for name in CACHED_GRIDS:
+            copy_raster(grids[name], self.grid_path(key, name))
+        now = time.time()
+        self._write_json(
+            os.path.join(entry, META_FILE),
+            {
+                "key": key,
+                "created": now,
+                "last_used": now,
+                "hits": 0,
+                "size": _dir_size(entry),
+                **info,
+            },
+        )
+        self.evict(keep=key)
+        return {name: self.grid_path(key, name) for name in CACHED_GRIDS}
+
+    def entries(self):
+        """
+        Metadata of every cache entry, most recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            meta = self._read_json(os.path.join(self.root, name, META_FILE))
+            if meta is not None:
+                entries.append(meta)
+        return sorted(entries, key=lambda m: m["last_used"], reverse=True)
+
+    def size(self):
+        return sum(meta["size"] for meta in self.entries())
+
+    def evict(self, max_bytes=None, keep=None):
+        """
+        Drop least recently used entries until the cache is below ``max_bytes``.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(meta["size"] for meta in entries)
+        evicted = []
+        for meta in reversed(entries):
+            if total <= max_bytes:
+                break
+            if meta["key"] == keep:
+                continue
+            self.purge(meta["key"])
+            total -= meta["size"]
+            evicted.append(meta["key"])
+        return evicted
+
+    def purge(self, key=None):
+        """
+        Remove one entry, or the whole cache when no key is given.
+        """
+        if key is not None:
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            return
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+    @staticmethod
+    def _read_json(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_json(path, data):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4)
@@ -0,0 +1,174 @@
+"""
+Intensity-duration-frequency (IDF) relations of the meteo stations and their inverse
+distance gage weighting (IDGW), on NumPy arrays of station parameters.
+
+The IDF relation of a station is i = a(T) / (1 + d / θ)^η with a(T) = λ΄ (T^κ - ψ΄),
+for a return period T in years and a rainfall duration d in hours.
+"""
+
+import numpy as np
+
+# Station attributes: IDF parameters and distance to the basin (m)
+STATION_FIELDS = ("κ", "λ΄", "ψ΄", "θ", "η", "Distance")
+
+
+def parse_numbers(text):
+    """
+    Numbers of a comma (or semicolon) separated list.
+    """
+    try:
+        return [float(v) for v in text.replace(";", ",").split(",") if v.strip()]
+    except ValueError:
+        raise ValueError(f"Not a list of numbers: {text}")
+
+
+def station_arrays(features, fields=STATION_FIELDS):
+    """
+    Read station attributes into float arrays, one per field.
+    """
+    values = [[feature[name] for name in fields] for feature in features]
+    table = np.array(values, dtype=np.float64).reshape(len(values), len(fields))
+    return {name: table[:, n] for n, name in enumerate(fields)}
+
+
+def idf_a(kappa, lam, psi, return_period):
+    """
+    a(T) = λ΄ (T^κ - ψ΄)
+    """
+    return lam * (return_period**kappa - psi)
+
+
+def idf_intensity(a, theta, eta, duration):
+    """
+    i = a(T) / (1 + d / θ)^η, in mm/hr
+    """
+    return a / (1 + duration / theta) ** eta
+
+
+def idgw(stations, return_period, duration):
+    """
+    Inverse distance gage weighting of the station intensities.
+
+    :param stations: arrays of `station_arrays`
+    :return: dict of per-station arrays: ``a`` (a(T)), ``distance`` (km),
+        ``inverse_distance_sq`` (1/d²), ``weight``, ``intensity`` and ``weighted``
+        (weight x intensity; their sum is the intensity over the basin)
+    """
+    distance = stations["Distance"] / 1000
+    inverse_distance_sq = 1 / distance**2
+    weight = inverse_distance_sq / inverse_distance_sq.sum()
+    a = idf_a(stations["κ"], stations["λ΄"], stations["ψ΄"], return_period)
+    intensity = idf_intensity(a, stations["θ"], stations["η"], duration)
+    return {
+        "a": a,
+        "distance": distance,
+        "inverse_distance_sq": inverse_distance_sq,
+        "weight": weight,
+        "intensity": intensity,
+        "weighted": weight * intensity,
+    }
+
+
+def idf_table(stations, return_periods, durations):
+    """
+    Weighted intensity over the basin for every return period and duration, evaluated
+    on the whole return period x duration x station grid at once.
+
+    :return: (len(return_periods), len(durations)) array, in mm/hr
+    """
+    T = np.asarray(return_periods, dtype=np.float64)[:, None, None]
+    d = np.asarray(durations, dtype=np.float64)[None, :, None]
+    distance = stations["Distance"] / 1000
+    inverse_distance_sq = 1 / distance**2
+    weight = inverse_distance_sq / inverse_distance_sq.sum()
+    a = idf_a(stations["κ"], stations["λ΄"], stations["ψ΄"], T)
+    intensity = idf_intensity(a, stations["θ"], stations["η"], d)
+    return (intensity * weight).sum(axis=2)
+
+
+def _fit_theta_eta(durations, log_i, thetas):
+    """
+    Best (θ, η, log a(T)) of log i = log a(T) - η log(1 + d / θ) over candidate θ.
+    """
+    n_T, n_d = log_i.shape
+    best = None
+    for theta in thetas:
+        x = np.log1p(durations / theta)
+        # Unknowns: log a(T) for every T, then η
+        design = np.zeros((n_T * n_d, n_T + 1))
+        design[np.arange(n_T * n_d), np.repeat(np.arange(n_T), n_d)] = 1
+        design[:, -1] = -np.tile(x, n_T)
+        solution, _, _, _ = np.linalg.lstsq(design, log_i.ravel(), rcond=None)
+        error = np.sum((design @ solution - log_i.ravel()) ** 2)
+        if best is None or error < best[0]:
+            best = (error, theta, solution[-1], solution[:-1])
+    return best[1:]
+
+
+def _fit_kappa(return_periods, a, kappas):
+    """
+    Best (κ, λ΄, ψ΄) of a(T) = λ΄ (T^κ - ψ΄) over candidate κ.
+    """
+    best = None
+    for kappa in kappas:
+        design = np.column_stack((return_periods**kappa, np.ones_like(return_periods)))
+        (lam, offset), _, _, _ = np.linalg.lstsq(design, a, rcond=None)
+        error = np.sum((design @ (lam, offset) - a) ** 2)
+        if lam != 0 and (best is None or error < best[0]):
+            best = (error, kappa, lam, -offset / lam)
+    return best[1:]
+
+
+def fit_idf(return_periods, durations, intensity):
+    """
+    Fit the IDF relation of the stations to a table of intensities.
+
+    θ and κ are searched on a logarithmic grid; for each of them η, a(T), λ΄ and ψ΄
+    follow from linear least squares.
+
+    :param intensity: (len(return_periods), len(durations)) array, e.g. `idf_table`
+    :return: dict of the parameters κ, λ΄, ψ΄, θ, η
+    """
+    T = np.asarray(return_periods, dtype=np.float64)
+    d = np.asarray(durations, dtype=np.float64)
+    if T.size < 3 or d.size < 3:
+        raise ValueError("Fitting needs at least 3 return periods and 3 durations")
+    theta, eta, log_a = _fit_theta_eta(
+        d, np.log(intensity), np.geomspace(0.01, 10, 200)
+    )
+    kappa, lam, psi = _fit_kappa(T, np.exp(log_a), np.geomspace(0.01, 1, 200))
+    return {
+        "κ": float(kappa),
+        "λ΄": float(lam),
+        "ψ΄": float(psi),
+        "θ": float(theta),
+        "η": float(eta),
+    }
+
+
+def idgw_grid(station_xy, intensities, xs, ys, n_nearest):
+    """
+    Inverse distance gage weighting at grid points, each from its nearest stations: the
+    per-basin computation with the cell centre in place of the basin centroid.
+
+    :param station_xy: (stations, 2) array of station coordinates (m)
+    :param intensities: (bands, stations) array of station intensities, e.g. one band per
+        return period / duration pair
+    :param xs: x of the grid columns
+    :param ys: y of the grid rows
+    :return: (bands, len(ys), len(xs)) array of weighted intensities
+    """
+    gx, gy = np.meshgrid(np.asarray(xs, np.float64), np.asarray(ys, np.float64))
+    points = np.column_stack((gx.ravel(), gy.ravel()))
+    distance = np.hypot(
+        points[:, None, 0] - station_xy[None, :, 0],
+        points[:, None, 1] - station_xy[None, :, 1],
+    )
+    n_nearest = min(n_nearest, station_xy.shape[0])
+    nearest = np.argpartition(distance, n_nearest - 1, axis=1)[:, :n_nearest]
+    inverse_distance_sq = (
+        1 / np.maximum(np.take_along_axis(distance, nearest, axis=1) / 1000, 1e-6) ** 2
+    )
+    weight = inverse_distance_sq / inverse_distance_sq.sum(axis=1, keepdims=True)
+    weighted = np.einsum("pn,bpn->bp", weight, intensities[:, nearest])
+    return weighted.reshape(len(intensities), gy.shape[0], gy.shape[1])
@@ -0,0 +1,74 @@
+"""
+In-memory index of the meteo stations of assets/meteo_stations.gpkg.
+
+The stations and their IDF parameters are read once per session into a spatial index on
+their projected coordinates, so the nearest stations of any number of basins are found
+without running processing algorithms or writing intermediate layers.
+"""
+
+import os
+import threading
+
+import numpy as np
+from qgis.core import QgsRectangle, QgsSpatialIndex, QgsVectorLayer
+
+from gwat.utils.settings import meteo_stations_path
+
+
+class StationIndex:
+    """
+    Stations with their attributes, and a spatial index for nearest-station queries.
+    """
+
+    _loaded = None
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        layer = QgsVectorLayer(path, "meteo_stations", "ogr")
+        if not layer.isValid():
+            raise IOError(f"Could not open the meteo stations {path}")
+        self.crs = layer.crs()
+        self.fields = layer.fields()
+        self.features = {}
+        self.index = QgsSpatialIndex()
+        for feature in layer.getFeatures():
+            self.features[feature.id()] = feature
+            self.index.addFeature(feature)
+        self.ids = np.array(sorted(self.features), dtype=np.int64)
+        points = [self.features[fid].geometry().asPoint() for fid in self.ids.tolist()]
+        self.xy = np.array([(p.x(), p.y()) for p in points], dtype=np.float64)
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        The index of the stations, read once per session (again if the file changed).
+        """
+        path = path or meteo_stations_path()
+        stamp = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+        with cls._lock:
+            if cls._loaded is None or cls._loaded[0] != stamp:
+                cls._loaded = (stamp, cls(path))
+            return cls._loaded[1]
+
+    def extent(self):
+        """
+        Extent of the stations, as a QgsRectangle.
+        """
+        xmin, ymin = self.xy.min(axis=0)
+        xmax, ymax = self.xy.max(axis=0)
+        return QgsRectangle(float(xmin), float(ymin), float(xmax), float(ymax))
+
+    def __len__(self):
+        return len(self.features)
+
+    def nearest(self, point, n):
+        """
+        The ``n`` stations nearest to a point (in the CRS of the stations).
+
+        :return: (station ids, distances), nearest first
+        """
+        candidates = np.array(self.index.nearestNeighbor(point, n), dtype=np.int64)
+        rows = np.searchsorted(self.ids, candidates)
+        distance = np.hypot(self.xy[rows, 0] - point.x(), self.xy[rows, 1] - point.y())
+        order = np.argsort(distance, kind="stable")[:n]
+        return candidates[order].tolist(), distance[order].tolist()
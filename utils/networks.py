@@ -0,0 +1,354 @@
+"""
+Channel networks as graphs of polylines joined at their end points.
+"""
+
+import json
+import math
+import os
+
+from qgis.core import QgsProviderRegistry
+
+
+class ChannelGraph:
+    """
+    Directed graph of channel polylines, with nodes at their (snapped) end points.
+
+    Polylines are lists of (x, y) tuples, digitized downstream as the channel networks of
+    Step 1 are: every edge runs from its upstream node to its downstream node. End points
+    closer than ``tolerance`` share a node.
+    """
+
+    def __init__(self, tolerance=0.001):
+        self.tolerance = tolerance
+        self.nodes = {}
+        self.points = []
+        self.edges = []  # (upstream node a, downstream node b, length, polyline a to b)
+        self.upstream = []  # edges flowing into every node
+
+    def node(self, point):
+        key = (
+            round(point[0] / self.tolerance),
+            round(point[1] / self.tolerance),
+        )
+        if key not in self.nodes:
+            self.nodes[key] = len(self.nodes)
+            self.points.append(point)
+            self.upstream.append([])
+        return self.nodes[key]
+
+    def add_edge(self, polyline, length=None):
+        if len(polyline) < 2:
+            return None
+        a, b = self.node(polyline[0]), self.node(polyline[-1])
+        if length is None:
+            length = polyline_length(polyline)
+        edge = len(self.edges)
+        self.edges.append((a, b, length, polyline))
+        self.upstream[b].append(edge)
+        return edge
+
+    def nearest_edge(self, point):
+        """
+        Edge closest to ``point``, with the distance along it of the closest location.
+        """
+        best = (math.inf, None, 0.0)
+        for edge, (_, _, _, polyline) in enumerate(self.edges):
+            distance, along = locate_point(polyline, point)
+            if distance < best[0]:
+                best = (distance, edge, along)
+        return best[1], best[2]
+
+    def split_edge(self, edge, along):
+        """
+        Cut an edge at a distance along it, returning the node at the cut. Only the upstream
+        part of the edge is kept: the downstream part lies outside the basin of the node.
+        """
+        a, b, length, polyline = self.edges[edge]
+        if along <= 0:
+            return a
+        if along >= length:
+            return b
+        head, _ = cut_polyline(polyline, along)
+        node = self.node(head[-1])
+        self.edges[edge] = (a, node, along, head)
+        self.upstream[b].remove(edge)
+        self.upstream[node].append(edge)
+        return node
+
+    def longest_path(self, root):
+        """
+        The longest path flowing into ``root``, from the farthest spring upstream: one
+        post-order pass over the upstream edges, keeping at every node the longest of its
+        upstream paths.
+
+        :return: (length, polyline running from the spring down to ``root``)
+        """
+        # node -> (longest upstream length, edge it comes through)
+        longest = {}
+        stack = [(root, False)]
+        seen = {root}
+        while stack:
+            n, visited = stack.pop()
+            if visited:
+                longest[n] = max(
+                    (
+                        (self.edges[e][2] + longest[self.edges[e][0]][0], e)
+                        for e in self.upstream[n]
+                        if self.edges[e][0] in longest
+                    ),
+                    default=(0.0, None),
+                )
+                continue
+            stack.append((n, True))
+            for e in self.upstream[n]:
+                a = self.edges[e][0]
+                if a not in seen:
+                    seen.add(a)
+                    stack.append((a, False))
+
+        chain = []
+        n = root
+        while longest[n][1] is not None:
+            edge = longest[n][1]
+            chain.append(edge)
+            n = self.edges[edge][0]
+        path = [self.points[n]]
+        for edge in reversed(chain):
+            path.extend(self.edges[edge][3][1:])
+        return longest[root][0], path
+
+
+def polyline_length(polyline):
+    return sum(
+        math.hypot(x1 - x0, y1 - y0)
+        for (x0, y0), (x1, y1) in zip(polyline[:-1], polyline[1:])
+    )
+
+
+def locate_point(polyline, point):
+    """
+    Distance from ``point`` to a polyline, and distance along the polyline of the closest location.
+    """
+    px, py = point
+    best, best_along, along = math.inf, 0.0, 0.0
+    for (x0, y0), (x1, y1) in zip(polyline[:-1], polyline[1:]):
+        dx, dy = x1 - x0, y1 - y0
+        seg = math.hypot(dx, dy)
+        t = 0.0 if seg == 0 else ((px - x0) * dx + (py - y0) * dy) / (seg * seg)
+        t = min(max(t, 0.0), 1.0)
+        d = math.hypot(x0 + t * dx - px, y0 + t * dy - py)
+        if d < best:
+            best, best_along = d, along + t * seg
+        along += seg
+    return best, best_along
+
+
+def cut_polyline(polyline, along):
+    """
+    Split a polyline at a distance along it, into (head, tail) sharing the cut point.
+    """
+    walked = 0.0
+    for i, ((x0, y0), (x1, y1)) in enumerate(zip(polyline[:-1], polyline[1:])):
+        seg = math.hypot(x1 - x0, y1 - y0)
+        if walked + seg >= along or i == len(polyline) - 2:
+            t = 0.0 if seg == 0 else min(max((along - walked) / seg, 0.0), 1.0)
+            cut = (x0 + t * (x1 - x0), y0 + t * (y1 - y0))
+            return polyline[: i + 1] + [cut], [cut] + polyline[i + 1 :]
+        walked += seg
+
+
+INDEX_SUFFIX = ".topology.json"
+
+
+class NetworkIndex:
+    """
+    Topology of a channel network layer: segment end nodes, node degrees, springs and
+    junctions, and the upstream/downstream adjacency of the segments.
+
+    Segments are taken to be digitized downstream, as the channel networks of Step 1 are.
+    For file-based layers the index is stored next to the data source and rebuilt only
+    when the source changes.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        segments, nodes = data["segments"], data["nodes"]
+        self.fids = segments["fid"]
+        self.segment_ids = segments["segment_id"]
+        self.node_a = segments["node_a"]
+        self.node_b = segments["node_b"]
+        self.lengths = segments["length"]
+        self.x = nodes["x"]
+        self.y = nodes["y"]
+        self.in_degree = nodes["in_degree"]
+        self.out_degree = nodes["out_degree"]
+        self.upstream = segments["upstream"]
+        self.downstream = segments["downstream"]
+
+    @classmethod
+    def build(cls, layer, tolerance=0.001, fingerprint=None):
+        graph = ChannelGraph(tolerance)
+        has_segment_id = layer.fields().indexOf("SegmentID") >= 0
+        fids, segment_ids, node_a, node_b, lengths = [], [], [], [], []
+        for f in layer.getFeatures():
+            geometry = f.geometry()
+            if geometry.isEmpty():
+                continue
+            if geometry.isMultipart():
+                parts = geometry.asMultiPolyline()
+            else:
+                parts = [geometry.asPolyline()]
+            start, end = parts[0][0], parts[-1][-1]
+            fids.append(f.id())
+            segment_ids.append(f["SegmentID"] if has_segment_id else f.id())
+            node_a.append(graph.node((start.x(), start.y())))
+            node_b.append(graph.node((end.x(), end.y())))
+            lengths.append(geometry.length())
+
+        n = len(graph.points)
+        in_degree, out_degree = [0] * n, [0] * n
+        starting = [[] for _ in range(n)]
+        ending = [[] for _ in range(n)]
+        for s, (a, b) in enumerate(zip(node_a, node_b)):
+            out_degree[a] += 1
+            in_degree[b] += 1
+            starting[a].append(s)
+            ending[b].append(s)
+
+        return cls(
+            {
+                "fingerprint": fingerprint,
+                "tolerance": tolerance,
+                "segments": {
+                    "fid": fids,
+                    "segment_id": segment_ids,
+                    "node_a": node_a,
+                    "node_b": node_b,
+                    "length": lengths,
+                    "upstream": [ending[a] for a in node_a],
+                    "downstream": [starting[b] for b in node_b],
+                },
+                "nodes": {
+                    "x": [p[0] for p in graph.points],
+                    "y": [p[1] for p in graph.points],
+                    "in_degree": in_degree,
+                    "out_degree": out_degree,
+                },
+            }
+        )
+
+    @classmethod
+    def for_layer(cls, layer, tolerance=0.001, rebuild=False):
+        """
+        Index of a line layer, read from next to its source when still up to date.
+        """
+        path = index_path(layer)
+        fingerprint = layer_fingerprint(layer)
+        if path is not None and not rebuild:
+            data = _read_index(path)
+            if (
+                data is not None
+                and data.get("fingerprint") == fingerprint
+                and data.get("tolerance") == tolerance
+            ):
+                return cls(data)
+        index = cls.build(layer, tolerance, fingerprint)
+        if path is not None:
+            index.save(path)
+        return index
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f)
+
+    def __len__(self):
+        return len(self.fids)
+
+    # Nodes
+
+    def springs(self):
+        """
+        Nodes where channels start: no segment flows into them.
+        """
+        return [
+            n
+            for n, (i, o) in enumerate(zip(self.in_degree, self.out_degree))
+            if i == 0 and o > 0
+        ]
+
+    def junctions(self):
+        """
+        Nodes where two or more segments join.
+        """
+        return [n for n, i in enumerate(self.in_degree) if i >= 2]
+
+    def outlets(self):
+        """
+        Nodes where the network ends: no segment leaves them.
+        """
+        return [
+            n
+            for n, (i, o) in enumerate(zip(self.in_degree, self.out_degree))
+            if o == 0 and i > 0
+        ]
+
+    def point(self, node):
+        return self.x[node], self.y[node]
+
+    # Segments
+
+    def spring_segments(self):
+        """
+        Segments starting at a spring (the headwater channels).
+        """
+        springs = set(self.springs())
+        return [s for s, a in enumerate(self.node_a) if a in springs]
+
+
+def layer_fingerprint(layer):
+    """
+    Identity of the current content of a layer's data source: source, size and
+    modification time of the file, and feature count.
+    """
+    parts = QgsProviderRegistry.instance().decodeUri(
+        layer.providerType(), layer.source()
+    )
+    path = parts.get("path")
+    fingerprint = {
+        "source": layer.source(),
+        "features": layer.featureCount(),
+    }
+    if path and os.path.exists(path):
+        stat = os.stat(path)
+        fingerprint["size"] = stat.st_size
+        fingerprint["mtime"] = stat.st_mtime_ns
+        # GeoPackage edits may only touch the write-ahead log
+        wal = path + "-wal"
+        if os.path.exists(wal):
+            fingerprint["wal_mtime"] = os.stat(wal).st_mtime_ns
+    return fingerprint
+
+
+def index_path(layer):
+    """
+    Where the topology index of a layer is stored: next to its file, None if the layer is
+    not file-based.
+    """
+    parts = QgsProviderRegistry.instance().decodeUri(
+        layer.providerType(), layer.source()
+    )
+    path = parts.get("path")
+    if not path or not os.path.isfile(path):
+        return None
+    layer_name = parts.get("layerName")
+    if layer_name:
+        return f"{path}.{layer_name}{INDEX_SUFFIX}"
+    return path + INDEX_SUFFIX
+
+
+def _read_index(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
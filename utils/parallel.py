@@ -0,0 +1,217 @@
+"""
+Concurrent execution of independent processing branches.
+
+QGIS layers, contexts and feedback objects cannot be pickled, so branches run in a thread
+pool rather than a process pool. The heavy lifting of the child algorithms (GDAL, SAGA's
+external process, GEOS) happens outside the GIL, so the branches do run in parallel.
+Every task gets its own processing context, feedback and instances of the layers it reads.
+The context is pushed to the worker thread by the main thread once the worker picks the
+task up, and pushed back by the worker when done; its results are then handed to the main
+context. Messages of the tasks are relayed to the parent feedback from the main thread,
+and cancelling the parent feedback cancels every running task.
+"""
+
+import contextvars
+import os
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from qgis.PyQt.QtCore import QThread
+from qgis.core import (
+    QgsFeatureRequest,
+    QgsProcessingContext,
+    QgsProcessingFeedback,
+    QgsVectorLayer,
+)
+
+from gwat.utils.settings import get_setting
+from gwat.utils.tracing import span
+
+POLL_INTERVAL = 0.05
+
+
+def worker_count(workers=0):
+    """
+    Number of workers to use: ``workers`` if positive, else the ``parallel_workers``
+    setting, else the number of CPUs.
+    """
+    if workers and workers > 0:
+        return workers
+    return get_setting("parallel_workers") or os.cpu_count() or 1
+
+
+def task_layer(layer):
+    """
+    An instance of a layer for one task: a copy of the features of memory layers, a new
+    layer on the same data source otherwise.
+    """
+    if isinstance(layer, QgsVectorLayer) and layer.providerType() == "memory":
+        copy = layer.materialize(QgsFeatureRequest())
+        for key in layer.customPropertyKeys():
+            copy.setCustomProperty(key, layer.customProperty(key))
+        return copy
+    return layer.clone()
+
+
+class RelayFeedback(QgsProcessingFeedback):
+    """
+    Feedback of a task, queueing its messages for the main thread to push to the parent
+    feedback.
+    """
+
+    def __init__(self, name, messages):
+        super().__init__()
+        self.name = name
+        self.messages = messages
+
+    def _relay(self, method, text, *args):
+        self.messages.put((method, f"[{self.name}] {text}", args))
+
+    def pushInfo(self, info):
+        self._relay("pushInfo", info)
+
+    def pushWarning(self, warning):
+        self._relay("pushWarning", warning)
+
+    def reportError(self, error, fatalError=False):
+        self._relay("reportError", error, fatalError)
+
+    def pushCommandInfo(self, info):
+        self._relay("pushCommandInfo", info)
+
+    def pushDebugInfo(self, info):
+        self._relay("pushDebugInfo", info)
+
+    def pushConsoleInfo(self, info):
+        self._relay("pushConsoleInfo", info)
+
+
+class TaskGraph:
+    """
+    Named tasks with dependencies, run concurrently as soon as their dependencies are done.
+
+    A task is a callable ``fn(context, feedback, results, layers)``; ``results`` maps the
+    names of the finished tasks to what they returned, and ``layers`` holds the task's own
+    instances of the layers given to `add`.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, fn, depends_on=(), layers=None):
+        """
+        :param layers: dict of the layers the task reads; every task gets its own instances,
+            layer objects are not shared between threads
+        """
+        if name in self.tasks:
+            raise ValueError(f"Task {name} is already in the graph")
+        for dep in depends_on:
+            if dep not in self.tasks:
+                raise ValueError(f"Task {name} depends on unknown task {dep}")
+        self.tasks[name] = (fn, tuple(depends_on), dict(layers or {}))
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def run(self, context, feedback, workers=0):
+        """
+        Run every task, reporting the overall progress and the messages of the tasks to
+        ``feedback``.
+
+        :return: dict of task results, or None if cancelled
+        """
+        workers = worker_count(workers)
+        main_thread = QThread.currentThread()
+        pending = dict(self.tasks)
+        results = {}
+        running = {}
+        messages = queue.Queue()
+        # (task context, worker thread, event set once the context is pushed to it)
+        handoff = queue.Queue()
+        closing = threading.Event()
+
+        def _run(name, fn, task_context, task_feedback, inputs, layers):
+            # The context belongs to the main thread until it pushes it to this one
+            pushed = threading.Event()
+            handoff.put((task_context, QThread.currentThread(), pushed))
+            while not pushed.wait(POLL_INTERVAL):
+                if closing.is_set():
+                    return None
+            try:
+                with span(name, "task"):
+                    return fn(task_context, task_feedback, inputs, layers)
+            finally:
+                task_context.pushToThread(main_thread)
+
+        def _serve():
+            # Push the contexts of the tasks being started, relay the messages of the tasks
+            while True:
+                try:
+                    task_context, thread, pushed = handoff.get_nowait()
+                except queue.Empty:
+                    break
+                task_context.pushToThread(thread)
+                pushed.set()
+            while True:
+                try:
+                    method, text, args = messages.get_nowait()
+                except queue.Empty:
+                    break
+                getattr(feedback, method)(text, *args)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                while pending or running:
+                    for name, (fn, deps, layers) in list(pending.items()):
+                        if len(running) >= workers:
+                            break
+                        if all(dep in results for dep in deps):
+                            del pending[name]
+                            task_context = QgsProcessingContext()
+                            task_context.copyThreadSafeSettings(context)
+                            task_layers = {}
+                            for key, layer in layers.items():
+                                task_layers[key] = task_layer(layer)
+                                task_context.temporaryLayerStore().addMapLayer(
+                                    task_layers[key]
+                                )
+                            task_feedback = RelayFeedback(name, messages)
+                            # The task runs in the context of the run, e.g. its trace
+                            future = pool.submit(
+                                contextvars.copy_context().run,
+                                _run,
+                                name,
+                                fn,
+                                task_context,
+                                task_feedback,
+                                dict(results),
+                                task_layers,
+                            )
+                            running[future] = (name, task_context, task_feedback)
+                    if not running:
+                        raise ValueError(
+                            "Circular task dependencies: " + ", ".join(pending)
+                        )
+
+                    done, _ = wait(
+                        running, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED
+                    )
+                    _serve()
+                    for future in done:
+                        name, task_context, task_feedback = running.pop(future)
+                        results[name] = future.result()
+                        context.takeResultsFrom(task_context)
+
+                    if feedback.isCanceled():
+                        return None
+                    partial = sum(fb.progress() for _, _, fb in running.values()) / 100
+                    feedback.setProgress(100 * (len(results) + partial) / len(self))
+            finally:
+                # Stop the siblings of a failed or cancelled task
+                closing.set()
+                for _, _, task_feedback in running.values():
+                    task_feedback.cancel()
+                _serve()
+        _serve()
+        return results
@@ -0,0 +1,68 @@
+"""
+Destinations of the intermediate outputs chained between processing stages.
+
+Intermediate vectors stay memory layers in the processing context and intermediate rasters
+go to GDAL's /vsimem/ file system, so only the outputs the user asked for are written to
+disk. Rasters produced or read by another process (SAGA, the GDAL command line tools behind
+the gdal: algorithms) cannot live in /vsimem/ and still go through temporary files.
+"""
+
+import uuid
+
+from osgeo import gdal
+from qgis.core import QgsRasterLayer
+
+MEMORY_OUTPUT = "memory:"
+VSIMEM_ROOT = "/vsimem/gwat"
+
+
+def is_vsimem(path):
+    return str(path).startswith("/vsimem/")
+
+
+def raster_input(path, name=""):
+    """
+    Parameter value of an intermediate raster: a raster layer for /vsimem/ paths, since
+    QGIS only loads layers from strings naming files on disk; the path itself otherwise.
+    """
+    return QgsRasterLayer(path, name or "raster", "gdal") if is_vsimem(path) else path
+
+
+class Pipeline:
+    """
+    Hands out in-memory destinations for the intermediates of one run, and releases the
+    /vsimem/ rasters once the run is over (use as a context manager).
+    """
+
+    def __init__(self):
+        self.root = f"{VSIMEM_ROOT}/{uuid.uuid4().hex}"
+        self.rasters = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+    def vector(self, name=""):
+        """
+        Destination of an intermediate vector: a memory layer in the context.
+        """
+        return MEMORY_OUTPUT + name
+
+    def raster(self, name):
+        """
+        Destination of an intermediate GeoTIFF, written and read by GDAL in this process.
+        """
+        path = f"{self.root}/{uuid.uuid4().hex[:8]}_{name}.tif"
+        self.rasters.append(path)
+        return path
+
+    def release(self):
+        """
+        Free the /vsimem/ rasters of the run, with their side car files.
+        """
+        if self.rasters:
+            gdal.RmdirRecursive(self.root)
+        self.rasters.clear()
@@ -0,0 +1,269 @@
+import os
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+
+# GDAL drivers for the raster formats the plugin writes, by file extension
+RASTER_DRIVERS = {
+    ".sdat": "SAGA",
+    ".tif": "GTiff",
+    ".tiff": "GTiff",
+    ".img": "HFA",
+}
+
+GTIFF_OPTIONS = ["COMPRESS=LZW", "TILED=YES", "BIGTIFF=IF_SAFER"]
+
+
+def raster_driver(path):
+    """
+    Get the GDAL driver name matching the extension of a raster path (GeoTIFF by default).
+    """
+    return RASTER_DRIVERS.get(os.path.splitext(path)[1].lower(), "GTiff")
+
+
+def read_raster(path, band=1):
+    """
+    Read a single-band raster into memory.
+
+    Returns the data as a float64 array, a boolean mask of the valid (non-nodata) cells,
+    the geotransform and the projection WKT.
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError(f"Could not open raster {path}")
+    rb = ds.GetRasterBand(band)
+    data = rb.ReadAsArray().astype(np.float64)
+    valid = np.isfinite(data)
+    nodata = rb.GetNoDataValue()
+    if nodata is not None:
+        valid &= data != nodata
+    geotransform = ds.GetGeoTransform()
+    projection = ds.GetProjection()
+    ds = None
+    return data, valid, geotransform, projection
+
+
+def read_window(ds, col0, row0, ncols, nrows, band=1):
+    """
+    Read a window of an open raster as float64.
+
+    Nodata cells, and cells of the window falling beyond the raster edges, are NaN.
+    """
+    out = np.full((nrows, ncols), np.nan)
+    c0, r0 = max(col0, 0), max(row0, 0)
+    c1 = min(col0 + ncols, ds.RasterXSize)
+    r1 = min(row0 + nrows, ds.RasterYSize)
+    if c1 <= c0 or r1 <= r0:
+        return out
+    rb = ds.GetRasterBand(band)
+    data = rb.ReadAsArray(c0, r0, c1 - c0, r1 - r0).astype(np.float64)
+    nodata = rb.GetNoDataValue()
+    if nodata is not None:
+        data[data == nodata] = np.nan
+    data[~np.isfinite(data)] = np.nan
+    out[r0 - row0 : r1 - row0, c0 - col0 : c1 - col0] = data
+    return out
+
+
+def cell_size(geotransform):
+    """
+    (cell width, cell height) of a north-up geotransform, in map units.
+    """
+    return abs(geotransform[1]), abs(geotransform[5])
+
+
+def world_to_cell(geotransform, x, y):
+    """
+    (row, column) of the cell containing a map coordinate, for a north-up geotransform.
+    """
+    col = int((x - geotransform[0]) // geotransform[1])
+    row = int((y - geotransform[3]) // geotransform[5])
+    return row, col
+
+
+def create_raster(
+    path, cols, rows, geotransform, projection, data_type, nodata, bands=1
+):
+    """
+    Create an empty raster (single-band by default), ready for (windowed) writes.
+    """
+    driver_name = raster_driver(path)
+    options = GTIFF_OPTIONS if driver_name == "GTiff" else []
+    driver = gdal.GetDriverByName(driver_name)
+    if os.path.exists(path):
+        driver.Delete(path)
+    ds = driver.Create(path, cols, rows, bands, data_type, options)
+    if ds is None:
+        raise IOError(f"Could not create raster {path}")
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(projection)
+    for band in range(1, bands + 1):
+        rb = ds.GetRasterBand(band)
+        rb.SetNoDataValue(nodata)
+        rb.Fill(nodata)
+    return ds
+
+
+def write_raster(path, array, geotransform, projection, data_type, nodata):
+    """
+    Write a 2D array to a single-band raster. NaN cells are written as nodata.
+    """
+    rows, cols = array.shape
+    ds = create_raster(path, cols, rows, geotransform, projection, data_type, nodata)
+    if array.dtype.kind == "f":
+        array = np.where(np.isnan(array), nodata, array)
+    ds.GetRasterBand(1).WriteArray(array)
+    ds.FlushCache()
+    ds = None
+    return path
+
+
+def copy_raster(src, dst):
+    """
+    Copy a raster to ``dst``, converting it to the format matching the extension of ``dst``.
+    """
+    driver_name = raster_driver(dst)
+    if os.path.exists(dst):
+        gdal.GetDriverByName(driver_name).Delete(dst)
+    ds = gdal.Translate(
+        dst,
+        src,
+        format=driver_name,
+        creationOptions=GTIFF_OPTIONS if driver_name == "GTiff" else [],
+    )
+    if ds is None:
+        raise IOError(f"Could not copy raster {src} to {dst}")
+    ds = None
+    return dst
+
+
+def rasterize(geometries, values, geotransform, cols, rows, projection, nodata=-1):
+    """
+    Burn integer values of polygons onto a grid, by cell centre.
+
+    :param geometries: polygons as WKB
+    :param values: value of every polygon
+    :return: int32 array, ``nodata`` where no polygon covers a cell centre
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(projection)
+    source = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = source.CreateLayer("polygons", srs, ogr.wkbUnknown)
+    layer.CreateField(ogr.FieldDefn("value", ogr.OFTInteger))
+    definition = layer.GetLayerDefn()
+    for wkb, value in zip(geometries, values):
+        feature = ogr.Feature(definition)
+        feature.SetGeometry(ogr.CreateGeometryFromWkb(wkb))
+        feature.SetField("value", int(value))
+        layer.CreateFeature(feature)
+
+    ds = gdal.GetDriverByName("MEM").Create("", cols, rows, 1, gdal.GDT_Int32)
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(projection)
+    rb = ds.GetRasterBand(1)
+    rb.Fill(nodata)
+    gdal.RasterizeLayer(ds, [1], layer, options=["ATTRIBUTE=value"])
+    data = rb.ReadAsArray()
+    ds = source = None
+    return data
+
+
+def band_metadata(path):
+    """
+    Metadata dictionary of every band of a raster.
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError(f"Could not open raster {path}")
+    metadata = [ds.GetRasterBand(b).GetMetadata() for b in range(1, ds.RasterCount + 1)]
+    ds = None
+    return metadata
+
+
+def zonal_means(path, wkb, extent):
+    """
+    Mean of every band of a raster over a polygon, reading only the window around it.
+
+    Cells are taken by centre; a polygon smaller than a cell gets the cell under the
+    centre of its extent.
+
+    :param wkb: the polygon as WKB, in the CRS of the raster
+    :param extent: (xmin, ymin, xmax, ymax) of the polygon
+    :return: float64 array of one mean per band (NaN where the polygon has no data)
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError(f"Could not open raster {path}")
+    gt = ds.GetGeoTransform()
+    xmin, ymin, xmax, ymax = extent
+    row0, col0 = world_to_cell(gt, xmin, ymax)
+    row1, col1 = world_to_cell(gt, xmax, ymin)
+    nrows, ncols = row1 - row0 + 1, col1 - col0 + 1
+    window_gt = (
+        gt[0] + col0 * gt[1],
+        gt[1],
+        0.0,
+        gt[3] + row0 * gt[5],
+        0.0,
+        gt[5],
+    )
+    mask = (
+        rasterize([wkb], [1], window_gt, ncols, nrows, ds.GetProjection(), nodata=0)
+        == 1
+    )
+    if not mask.any():
+        row, col = world_to_cell(gt, (xmin + xmax) / 2, (ymin + ymax) / 2)
+        mask[row - row0, col - col0] = True
+
+    means = np.full(ds.RasterCount, np.nan)
+    for band in range(1, ds.RasterCount + 1):
+        values = read_window(ds, col0, row0, ncols, nrows, band)[mask]
+        values = values[~np.isnan(values)]
+        if values.size:
+            means[band - 1] = values.mean()
+    ds = None
+    return means
+
+
+def clip_to_polygon(path, wkb, extent, dst, band=1, strip_cells=2**22):
+    """
+    Clip a raster band to a polygon (by cell centre), cropped to the polygon's extent.
+
+    The window over the polygon is copied in strips of rows, each masked with the polygon
+    rasterized in memory; cells outside the polygon are nodata. ``dst`` may be a /vsimem/
+    path.
+
+    :param wkb: the polygon as WKB, in the CRS of the raster
+    :param extent: (xmin, ymin, xmax, ymax) of the polygon
+    :return: ``dst``
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError(f"Could not open raster {path}")
+    gt = ds.GetGeoTransform()
+    projection = ds.GetProjection()
+    rb = ds.GetRasterBand(band)
+    nodata = rb.GetNoDataValue()
+    if nodata is None:
+        nodata = -99999
+    xmin, ymin, xmax, ymax = extent
+    row0, col0 = world_to_cell(gt, xmin, ymax)
+    row1, col1 = world_to_cell(gt, xmax, ymin)
+    row0, col0 = max(row0, 0), max(col0, 0)
+    row1, col1 = min(row1, ds.RasterYSize - 1), min(col1, ds.RasterXSize - 1)
+    cols, rows = max(col1 - col0 + 1, 1), max(row1 - row0 + 1, 1)
+    window_gt = (gt[0] + col0 * gt[1], gt[1], 0.0, gt[3] + row0 * gt[5], 0.0, gt[5])
+
+    out = create_raster(dst, cols, rows, window_gt, projection, rb.DataType, nodata)
+    strip = max(1, strip_cells // cols)
+    for top in range(0, rows, strip):
+        n = min(strip, rows - top)
+        strip_gt = window_gt[:3] + (window_gt[3] + top * gt[5],) + window_gt[4:]
+        inside = rasterize([wkb], [1], strip_gt, cols, n, projection, 0) == 1
+        values = read_window(ds, col0, row0 + top, cols, n, band)
+        values[~inside | np.isnan(values)] = nodata
+        out.GetRasterBand(1).WriteArray(values, 0, top)
+    out.FlushCache()
+    out = ds = None
+    return dst
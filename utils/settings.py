@@ -1,6 +1,10 @@
 import os
 import json
 
+# Environment variable holding a JSON object of settings that take precedence over the
+# settings file, for headless runs
+SETTINGS_ENV = "GWAT_SETTINGS"
+
 
 def get_settings_path():
     return os.path.join(os.path.dirname(__file__), "..", "assets", "settings.json")
@@ -17,6 +21,9 @@ def save_settings(settings):
 
 
 def get_setting(key):
+    overrides = json.loads(os.environ.get(SETTINGS_ENV) or "{}")
+    if key in overrides:
+        return overrides[key]
     settings = read_settings()
     return settings.get(key, None)
 
@@ -28,7 +35,8 @@ def set_setting(key, value):
 
 
 def meteo_stations_path():
-    return os.path.join(
+    # A stations file with the same fields can replace the bundled one
+    return get_setting("meteo_stations") or os.path.join(
         os.path.dirname(os.path.dirname(__file__)),
         "assets",
         "meteo_stations.gpkg",
@@ -0,0 +1,418 @@
+"""
+Out-of-core (tiled) driver for the hydrology engine.
+
+The DEM is streamed in square tiles with a one-cell halo, so peak memory is bounded by the
+tile size rather than by the DEM size. Results are identical to the single-pass engine:
+
+- Fill: every tile is flooded from its own outlets and from the current filled values of
+  its halo. Tiles whose borders change mark their neighbours dirty, and sweeps repeat until
+  no border changes, i.e. until the spill elevations are reconciled across tiles.
+- Flow directions: a purely local operation on the filled DEM plus its halo.
+- Accumulation: each tile is accumulated on its own, recording where its flow leaves it.
+  The (small) graph of tile exits is then accumulated globally, and a second tile pass adds
+  the resulting inflows at the tile borders.
+"""
+
+import math
+import os
+
+import numpy as np
+from osgeo import gdal
+
+from gwat.utils import hydrology
+from gwat.utils.rasters import cell_size, create_raster, read_window
+
+
+# Rough peak memory per tile cell while flooding (arrays plus heap entries)
+BYTES_PER_CELL = 96
+MIN_TILE_SIZE = 64
+
+SCRATCH_NODATA = -99999.0
+
+
+def tile_size_for_budget(budget_mb):
+    """
+    Side (in cells) of the largest square tile that fits in ``budget_mb`` megabytes.
+    """
+    return max(MIN_TILE_SIZE, int(math.sqrt(budget_mb * 2**20 / BYTES_PER_CELL)))
+
+
+class TiledHydrology:
+    """
+    Fill, flow directions and accumulation of a DEM processed tile by tile.
+    """
+
+    def __init__(self, dem_path, tile_size, scratch_dir, progress=None):
+        self.dem = gdal.Open(dem_path, gdal.GA_ReadOnly)
+        if self.dem is None:
+            raise IOError(f"Could not open raster {dem_path}")
+        self.cols = self.dem.RasterXSize
+        self.rows = self.dem.RasterYSize
+        self.geotransform = self.dem.GetGeoTransform()
+        self.projection = self.dem.GetProjection()
+        self.cell_size = cell_size(self.geotransform)
+        self.tile_size = tile_size
+        self.scratch_dir = scratch_dir
+        self.progress = progress
+
+        self.tile_rows = math.ceil(self.rows / tile_size)
+        self.tile_cols = math.ceil(self.cols / tile_size)
+        self.tiles = [
+            (
+                r0,
+                c0,
+                min(tile_size, self.rows - r0),
+                min(tile_size, self.cols - c0),
+            )
+            for r0 in range(0, self.rows, tile_size)
+            for c0 in range(0, self.cols, tile_size)
+        ]
+        self.filled_path = os.path.join(scratch_dir, "filled.tif")
+        self.fdir_path = os.path.join(scratch_dir, "flow_directions.tif")
+        self.accumulation_path = os.path.join(scratch_dir, "accumulation.tif")
+
+    @property
+    def shape(self):
+        return self.rows, self.cols
+
+    def _aborted(self, fraction):
+        return self.progress is not None and bool(self.progress(min(fraction, 1.0)))
+
+    def _neighbours(self, t):
+        ti, tj = divmod(t, self.tile_cols)
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                i, j = ti + di, tj + dj
+                if (di or dj) and 0 <= i < self.tile_rows and 0 <= j < self.tile_cols:
+                    yield i * self.tile_cols + j
+
+    def _global_index(self, tile, local):
+        r0, c0, _, nc = tile
+        return (r0 + local // nc) * self.cols + c0 + local % nc
+
+    def _valid(self, tile):
+        r0, c0, nr, nc = tile
+        return np.isfinite(read_window(self.dem, c0, r0, nc, nr))
+
+    # Fill
+
+    def fill(self, minslope):
+        """
+        Fill the DEM into the scratch raster ``filled_path`` (float64).
+
+        Returns False when aborted.
+        """
+        ds = create_raster(
+            self.filled_path,
+            self.cols,
+            self.rows,
+            self.geotransform,
+            self.projection,
+            gdal.GDT_Float64,
+            SCRATCH_NODATA,
+        )
+        mindiff = hydrology.min_drops(self.cell_size, minslope)
+
+        # Current filled values along the first/last row and column of every tile
+        edge_rows, edge_cols = {}, {}
+        for r0, c0, nr, nc in self.tiles:
+            for r in (r0, r0 + nr - 1):
+                edge_rows.setdefault(r, np.full(self.cols, np.inf))
+            for c in (c0, c0 + nc - 1):
+                edge_cols.setdefault(c, np.full(self.rows, np.inf))
+
+        dirty = set(range(len(self.tiles)))
+        order = list(range(len(self.tiles)))
+        solved = 0
+        while dirty:
+            for t in order:
+                if t not in dirty:
+                    continue
+                dirty.discard(t)
+                if self._fill_tile(self.tiles[t], ds, mindiff, edge_rows, edge_cols):
+                    dirty.update(self._neighbours(t))
+                solved += 1
+                if self._aborted(solved / (solved + len(dirty))):
+                    return False
+            # Alternate the sweep direction, so spill levels travel both ways quickly
+            order.reverse()
+
+        ds.FlushCache()
+        ds = None
+        return True
+
+    def _ring(self, tile, edge_rows, edge_cols):
+        """
+        Current filled values of the one-cell halo around a tile (NaN where unknown).
+        """
+        r0, c0, nr, nc = tile
+        ring = np.full((nr + 2, nc + 2), np.nan)
+        c_from, c_to = max(c0 - 1, 0), min(c0 + nc + 1, self.cols)
+        r_from, r_to = max(r0 - 1, 0), min(r0 + nr + 1, self.rows)
+        if r0 - 1 in edge_rows:
+            ring[0, c_from - c0 + 1 : c_to - c0 + 1] = edge_rows[r0 - 1][c_from:c_to]
+        if r0 + nr in edge_rows:
+            ring[-1, c_from - c0 + 1 : c_to - c0 + 1] = edge_rows[r0 + nr][c_from:c_to]
+        if c0 - 1 in edge_cols:
+            ring[r_from - r0 + 1 : r_to - r0 + 1, 0] = edge_cols[c0 - 1][r_from:r_to]
+        if c0 + nc in edge_cols:
+            ring[r_from - r0 + 1 : r_to - r0 + 1, -1] = edge_cols[c0 + nc][r_from:r_to]
+        ring[1:-1, 1:-1] = np.nan
+        return ring
+
+    def _fill_tile(self, tile, ds, mindiff, edge_rows, edge_cols):
+        """
+        Flood one tile from its outlets and its halo. Returns True if its borders changed.
+        """
+        r0, c0, nr, nc = tile
+        # Two cells of padding: the halo ring, plus a frame so the ring has 8 neighbours
+        elev = read_window(self.dem, c0 - 2, r0 - 2, nc + 4, nr + 4)
+        valid = np.isfinite(elev)
+
+        outlet = np.zeros_like(valid)
+        outlet[1:-1, 1:-1] = hydrology._outlets(valid[1:-1, 1:-1])
+
+        ring = np.full(elev.shape, np.nan)
+        ring[1:-1, 1:-1] = self._ring(tile, edge_rows, edge_cols)
+        ring_seed = valid & np.isfinite(ring)
+
+        passable = np.zeros_like(valid)
+        passable[2:-2, 2:-2] = valid[2:-2, 2:-2]
+
+        seeds = np.flatnonzero(outlet | ring_seed)
+        values = np.where(outlet, elev, ring).ravel()[seeds]
+        filled = hydrology._flood(elev, passable, seeds, values, mindiff)[2:-2, 2:-2]
+        filled[~valid[2:-2, 2:-2]] = np.nan
+
+        ds.GetRasterBand(1).WriteArray(
+            np.where(np.isnan(filled), SCRATCH_NODATA, filled), c0, r0
+        )
+
+        changed = False
+        for line, store, key, span in (
+            (filled[0, :], edge_rows, r0, slice(c0, c0 + nc)),
+            (filled[-1, :], edge_rows, r0 + nr - 1, slice(c0, c0 + nc)),
+            (filled[:, 0], edge_cols, c0, slice(r0, r0 + nr)),
+            (filled[:, -1], edge_cols, c0 + nc - 1, slice(r0, r0 + nr)),
+        ):
+            if not np.array_equal(store[key][span], line, equal_nan=True):
+                store[key][span] = line
+                changed = True
+        return changed
+
+    # Flow directions
+
+    def flow_directions(self, output_path):
+        """
+        D8 flow directions of the filled DEM, written to ``output_path`` and to scratch.
+        """
+        filled_ds = gdal.Open(self.filled_path, gdal.GA_ReadOnly)
+        outputs = [
+            create_raster(
+                path,
+                self.cols,
+                self.rows,
+                self.geotransform,
+                self.projection,
+                gdal.GDT_Int16,
+                hydrology.NO_FLOW,
+            )
+            for path in (self.fdir_path, output_path)
+        ]
+        for n, (r0, c0, nr, nc) in enumerate(self.tiles):
+            filled = read_window(filled_ds, c0 - 1, r0 - 1, nc + 2, nr + 2)
+            fdir = hydrology.flow_directions(filled, self.cell_size)[1:-1, 1:-1]
+            for ds in outputs:
+                ds.GetRasterBand(1).WriteArray(fdir, c0, r0)
+            if self._aborted((n + 1) / len(self.tiles)):
+                return False
+        for ds in outputs:
+            ds.FlushCache()
+        outputs = filled_ds = None
+        return True
+
+    def write_filled(self, output_path):
+        """
+        Copy the scratch filled DEM to ``output_path`` as float32.
+        """
+        src = gdal.Open(self.filled_path, gdal.GA_ReadOnly)
+        ds = create_raster(
+            output_path,
+            self.cols,
+            self.rows,
+            self.geotransform,
+            self.projection,
+            gdal.GDT_Float32,
+            SCRATCH_NODATA,
+        )
+        for r0, c0, nr, nc in self.tiles:
+            ds.GetRasterBand(1).WriteArray(
+                src.GetRasterBand(1).ReadAsArray(c0, r0, nc, nr), c0, r0
+            )
+        ds.FlushCache()
+        ds = src = None
+        return output_path
+
+    # Accumulation
+
+    def _read_fdir(self, ds, tile):
+        r0, c0, nr, nc = tile
+        return ds.GetRasterBand(1).ReadAsArray(c0, r0, nc, nr).astype(np.int16)
+
+    def _tile_flow(self, ds, tile):
+        """
+        Flow graph of a tile: local receivers, and the cells whose flow leaves the tile.
+        """
+        r0, c0, _, _ = tile
+        fdir = self._read_fdir(ds, tile)
+        down, (src, r, c) = hydrology.downstream_index(fdir, return_exits=True)
+        exit_targets = (r0 + r) * self.cols + c0 + c
+        return fdir, down, src, exit_targets
+
+    def accumulate(self):
+        """
+        Accumulate the flow directions into the scratch raster ``accumulation_path``.
+
+        Returns False when aborted.
+        """
+        ds = gdal.Open(self.fdir_path, gdal.GA_ReadOnly)
+        n_tiles = len(self.tiles)
+
+        # 1. Per-tile accumulation. Record where each exit cell leaves the tile with how
+        #    much flow, and which exit every border cell drains to.
+        exit_cells, exit_acc, exit_targets = [], [], []
+        border_cells, border_exits = [], []
+        for n, tile in enumerate(self.tiles):
+            _, _, nr, nc = tile
+            _, down, src, targets = self._tile_flow(ds, tile)
+            acc = hydrology.accumulate(down, self._valid(tile).ravel())
+
+            exits = self._global_index(tile, src)
+            labels = hydrology.drainage_labels(down, src, exits)
+            border = np.zeros((nr, nc), dtype=bool)
+            border[[0, -1], :] = True
+            border[:, [0, -1]] = True
+            border = np.flatnonzero(border)
+
+            exit_cells.append(exits)
+            exit_acc.append(acc[src])
+            exit_targets.append(targets)
+            border_cells.append(self._global_index(tile, border))
+            border_exits.append(labels[border])
+            if self._aborted(0.5 * (n + 1) / n_tiles):
+                return False
+
+        exit_cells = np.concatenate(exit_cells)
+        exit_acc = np.concatenate(exit_acc)
+        exit_targets = np.concatenate(exit_targets)
+        border_cells = np.concatenate(border_cells)
+        border_exits = np.concatenate(border_exits)
+
+        # 2. Accumulate the graph of tile exits: each exit flows into a border cell of
+        #    another tile, which in turn drains to one of that tile's exits.
+        by_cell = np.argsort(exit_cells)
+        exit_cells, exit_acc, exit_targets = (
+            exit_cells[by_cell],
+            exit_acc[by_cell],
+            exit_targets[by_cell],
+        )
+        by_border = np.argsort(border_cells)
+        border_cells, border_exits = border_cells[by_border], border_exits[by_border]
+
+        next_exit = border_exits[np.searchsorted(border_cells, exit_targets)]
+        next_pos = np.full(exit_cells.size, -1, dtype=np.int64)
+        has = next_exit >= 0
+        next_pos[has] = np.searchsorted(exit_cells, next_exit[has])
+        exit_total = hydrology.accumulate(next_pos, exit_acc)
+
+        inflow_cells, inverse = np.unique(exit_targets, return_inverse=True)
+        inflow = np.bincount(inverse, weights=exit_total)
+        inflow_tile = (inflow_cells // self.cols) // self.tile_size * self.tile_cols + (
+            inflow_cells % self.cols
+        ) // self.tile_size
+
+        # 3. Second pass: re-accumulate every tile with its inflows
+        out = create_raster(
+            self.accumulation_path,
+            self.cols,
+            self.rows,
+            self.geotransform,
+            self.projection,
+            gdal.GDT_Float64,
+            SCRATCH_NODATA,
+        )
+        for n, tile in enumerate(self.tiles):
+            r0, c0, nr, nc = tile
+            _, down, _, _ = self._tile_flow(ds, tile)
+            valid = self._valid(tile)
+            weights = valid.ravel().astype(np.float64)
+            mine = inflow_tile == n
+            cells = inflow_cells[mine]
+            weights[(cells // self.cols - r0) * nc + cells % self.cols - c0] += inflow[mine]
+            acc = hydrology.accumulate(down, weights).reshape(nr, nc)
+            out.GetRasterBand(1).WriteArray(np.where(valid, acc, SCRATCH_NODATA), c0, r0)
+            if self._aborted(0.5 + 0.5 * (n + 1) / n_tiles):
+                return False
+        out.FlushCache()
+        out = ds = None
+        return True
+
+    def channel_cells(self, threshold, fdir_path=None, accumulation_path=None):
+        """
+        Extract the channel cells (accumulation greater than ``threshold``), tile by tile.
+
+        Returns the sorted global (flat) indexes of the channel cells and their receivers,
+        as expected by ``hydrology.strahler_order``, or None when aborted.
+        """
+        fdir_ds = gdal.Open(fdir_path or self.fdir_path, gdal.GA_ReadOnly)
+        acc_ds = gdal.Open(accumulation_path or self.accumulation_path, gdal.GA_ReadOnly)
+        channels, receivers = [], []
+        for n, tile in enumerate(self.tiles):
+            r0, c0, nr, nc = tile
+            _, down, src, targets = self._tile_flow(fdir_ds, tile)
+            acc = read_window(acc_ds, c0, r0, nc, nr).ravel()
+
+            down_global = np.full(down.size, -1, dtype=np.int64)
+            inside = down >= 0
+            down_global[inside] = self._global_index(tile, down[inside])
+            down_global[src] = targets
+
+            local = np.flatnonzero(acc > threshold)
+            channels.append(self._global_index(tile, local))
+            receivers.append(down_global[local])
+            if self._aborted((n + 1) / len(self.tiles)):
+                return None
+        fdir_ds = acc_ds = None
+
+        channels = np.concatenate(channels)
+        receivers = np.concatenate(receivers)
+        by_cell = np.argsort(channels)
+        return channels[by_cell], receivers[by_cell]
+
+    def write_strahler(self, output_path, channels, order, nodata=0):
+        """
+        Write the Strahler order of the channel cells, tile by tile.
+        """
+        ds = create_raster(
+            output_path,
+            self.cols,
+            self.rows,
+            self.geotransform,
+            self.projection,
+            gdal.GDT_Int16,
+            nodata,
+        )
+        rows, cols = channels // self.cols, channels % self.cols
+        tile_of = rows // self.tile_size * self.tile_cols + cols // self.tile_size
+        by_tile = np.argsort(tile_of, kind="stable")
+        bounds = np.searchsorted(tile_of[by_tile], np.arange(len(self.tiles) + 1))
+        for n, (r0, c0, nr, nc) in enumerate(self.tiles):
+            sel = by_tile[bounds[n] : bounds[n + 1]]
+            if not sel.size:
+                continue
+            grid = np.full((nr, nc), nodata, dtype=np.int16)
+            grid[rows[sel] - r0, cols[sel] - c0] = order[sel]
+            ds.GetRasterBand(1).WriteArray(grid, c0, r0)
+        ds.FlushCache()
+        ds = None
+        return output_path
@@ -0,0 +1,317 @@
+"""
+Execution traces of the plugin's algorithms.
+
+With the ``trace_runs`` setting on, a run of a traced algorithm (see `traced`) records a
+span for every child algorithm run through `run_child` or the artifact cache, and for every
+task of a TaskGraph: wall time, CPU time of the thread that ran it, growth of the peak
+resident set size, and the bytes and feature/cell counts of its output datasets. Child
+algorithms running in another process (SAGA, the gdal: command line tools) only show in the
+wall time. At the end of the run the spans are written to a Chrome trace (chrome://tracing,
+ui.perfetto.dev) and a summary table, in a traces/<algorithm>_<time> folder of the plugin
+output folder. Every top-level run has a trace of its own, kept in a context variable: runs
+started at the same time on other threads (QGIS background tasks) are traced apart, and
+TaskGraph hands the trace of its run to its workers. With ``trace_profile`` also on, the outermost span of every thread is
+profiled with cProfile and its stats dumped next to the trace (one .prof file per span).
+"""
+
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import processing
+from osgeo import gdal
+from qgis.core import QgsProcessingUtils, QgsRasterLayer, QgsVectorLayer
+
+from gwat.utils.files import get_plugin_output_dir, get_or_create_path
+from gwat.utils.settings import get_setting
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TRACES_DIRNAME = "traces"
+TRACE_FILE = "trace.json"
+SUMMARY_FILE = "summary.txt"
+
+# Tracer of the run in progress in the current context, shared with the tasks of the run
+_active = contextvars.ContextVar("gwat_tracer", default=None)
+_profiling = threading.local()
+
+
+def _peak_rss():
+    """
+    Peak resident set size of the process in bytes, None where unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _slug(name):
+    return re.sub(r"[^\w.-]+", "_", name).strip("_")[:60]
+
+
+def output_stats(results, context):
+    """
+    Bytes on disk (or in /vsimem/) and feature/cell counts of the output datasets of a run.
+    """
+    size, features, cells = 0, 0, 0
+    for value in (results or {}).values():
+        if isinstance(value, (QgsVectorLayer, QgsRasterLayer)):
+            layer = value
+        elif isinstance(value, str) and value:
+            layer = None
+            ds = gdal.OpenEx(value.split("|")[0])
+            if ds is not None:
+                for f in ds.GetFileList() or []:
+                    stat = gdal.VSIStatL(f)
+                    size += stat.size if stat is not None else 0
+                cells += ds.RasterXSize * ds.RasterYSize * ds.RasterCount
+                for i in range(ds.GetLayerCount()):
+                    features += max(ds.GetLayer(i).GetFeatureCount(), 0)
+                ds = None
+                continue
+            layer = QgsProcessingUtils.mapLayerFromString(value, context, False)
+        else:
+            continue
+        if isinstance(layer, QgsVectorLayer):
+            features += max(layer.featureCount(), 0)
+        elif isinstance(layer, QgsRasterLayer):
+            cells += layer.width() * layer.height() * layer.bandCount()
+    return {"bytes": size, "features": features, "cells": cells}
+
+
+class Tracer:
+    """
+    Spans of one run, recorded from any thread.
+    """
+
+    def __init__(self, name, root=None, profile=False):
+        self.name = name
+        self.root = root or os.path.join(
+            get_plugin_output_dir(),
+            TRACES_DIRNAME,
+            f"{_slug(name)}_{time.strftime('%Y%m%d_%H%M%S')}",
+        )
+        self.profile = profile
+        self.origin = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category="stage"):
+        """
+        Record the block as a span; the dict it yields is stored as the span's arguments.
+        """
+        record = {
+            "name": name,
+            "cat": category,
+            "tid": threading.get_ident(),
+            "thread": threading.current_thread().name,
+            "args": {},
+        }
+        profiler = None
+        if self.profile and not getattr(_profiling, "on", False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                _profiling.on = True
+            except ValueError:
+                # Python 3.12+ allows one profiler per process at a time
+                profiler = None
+        rss = _peak_rss()
+        cpu = time.thread_time()
+        start = time.perf_counter()
+        try:
+            yield record["args"]
+        finally:
+            end = time.perf_counter()
+            if profiler is not None:
+                profiler.disable()
+                _profiling.on = False
+            record["start"] = start - self.origin
+            record["wall"] = end - start
+            record["cpu"] = time.thread_time() - cpu
+            record["rss_delta"] = None if rss is None else _peak_rss() - rss
+            with self._lock:
+                record["index"] = len(self.spans)
+                self.spans.append(record)
+            if profiler is not None:
+                profiler.dump_stats(
+                    os.path.join(
+                        get_or_create_path(self.root),
+                        f"{record['index']:03d}_{_slug(name)}.prof",
+                    )
+                )
+
+    def chrome_trace(self):
+        """
+        The spans as a Chrome trace: complete ("X") events in microseconds.
+        """
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for span in self.spans:
+            threads[span["tid"]] = span["thread"]
+            events.append(
+                {
+                    "name": span["name"],
+                    "cat": span["cat"],
+                    "ph": "X",
+                    "ts": span["start"] * 1e6,
+                    "dur": span["wall"] * 1e6,
+                    "pid": pid,
+                    "tid": span["tid"],
+                    "args": {
+                        "cpu_s": span["cpu"],
+                        "rss_delta_bytes": span["rss_delta"],
+                        **span["args"],
+                    },
+                }
+            )
+        for tid, thread in threads.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": thread},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def summary(self):
+        """
+        Table of the spans, longest first, followed by the totals of every category/name.
+        """
+        header = (
+            f"{'Span':<48} {'Category':<10} {'Wall s':>9} {'CPU s':>9} "
+            f"{'RSS +MB':>8} {'Out MB':>9} {'Features':>10} {'Cells':>12}"
+        )
+        lines = [f"Trace of {self.name}", "", header, "-" * len(header)]
+        for span in sorted(self.spans, key=lambda s: s["wall"], reverse=True):
+            args = span["args"]
+            rss = span["rss_delta"]
+            lines.append(
+                f"{span['name'][:48]:<48} {span['cat'][:10]:<10} {span['wall']:>9.3f} "
+                f"{span['cpu']:>9.3f} "
+                f"{'' if rss is None else f'{rss / 2**20:.1f}':>8} "
+                f"{args.get('bytes', 0) / 2**20:>9.2f} "
+                f"{args.get('features', ''):>10} {args.get('cells', ''):>12}"
+            )
+
+        totals = {}
+        for span in self.spans:
+            if span["cat"] == "run":
+                continue
+            key = (span["cat"], span["name"].rsplit("/", 1)[-1])
+            count, wall, cpu = totals.get(key, (0, 0.0, 0.0))
+            totals[key] = (count + 1, wall + span["wall"], cpu + span["cpu"])
+        lines += [
+            "",
+            f"{'Total by name':<48} {'Category':<10} {'Count':>6} {'Wall s':>9} {'CPU s':>9}",
+        ]
+        for (category, name), (count, wall, cpu) in sorted(
+            totals.items(), key=lambda item: item[1][1], reverse=True
+        ):
+            lines.append(
+                f"{name[:48]:<48} {category[:10]:<10} {count:>6} {wall:>9.3f} {cpu:>9.3f}"
+            )
+        return "\n".join(lines)
+
+    def export(self):
+        """
+        Write the Chrome trace and the summary table.
+
+        :return: (trace path, summary text)
+        """
+        get_or_create_path(self.root)
+        trace = os.path.join(self.root, TRACE_FILE)
+        with open(trace, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f)
+        summary = self.summary()
+        with open(os.path.join(self.root, SUMMARY_FILE), "w", encoding="utf-8") as f:
+            f.write(summary + "\n")
+        return trace, summary
+
+
+@contextmanager
+def trace_run(name, feedback=None):
+    """
+    Trace a run if the ``trace_runs`` setting is on. Runs nested in a traced run join its
+    trace.
+    """
+    active = _active.get()
+    if active is not None or not get_setting("trace_runs"):
+        yield active
+        return
+    tracer = Tracer(name, profile=bool(get_setting("trace_profile")))
+    token = _active.set(tracer)
+    try:
+        with tracer.span(name, "run"):
+            yield tracer
+    finally:
+        _active.reset(token)
+        trace, summary = tracer.export()
+        if feedback is not None:
+            feedback.pushInfo(summary)
+            feedback.pushInfo(f"Trace written to {trace}")
+
+
+def traced(process_algorithm):
+    """
+    Decorator of processAlgorithm, tracing the runs of the algorithm (see trace_run).
+    """
+
+    @functools.wraps(process_algorithm)
+    def wrapper(self, parameters, context, feedback):
+        with trace_run(self.name(), feedback):
+            return process_algorithm(self, parameters, context, feedback)
+
+    return wrapper
+
+
+@contextmanager
+def span(name, category="stage"):
+    """
+    Record the block as a span of the run being traced, if any.
+    """
+    tracer = _active.get()
+    if tracer is None:
+        yield {}
+        return
+    with tracer.span(name, category) as args:
+        yield args
+
+
+def tracing():
+    return _active.get() is not None
+
+
+def run_child(algorithm_id, parameters, context, feedback):
+    """
+    processing.run of a child algorithm, recorded as a span when tracing.
+    """
+    with span(algorithm_id, "algorithm") as args:
+        results = processing.run(
+            algorithm_id,
+            parameters,
+            context=context,
+            feedback=feedback,
+            is_child_algorithm=True,
+        )
+    # Measured outside of the span, which is already recorded with these arguments
+    if tracing():
+        args.update(output_stats(results, context))
+    return results
@@ -0,0 +1,139 @@
+import os
+
+from qgis.core import (
+    QgsCoordinateTransform,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsFields,
+    QgsGeometry,
+    QgsPointXY,
+    QgsProcessingException,
+    QgsProcessingUtils,
+    QgsVectorFileWriter,
+    QgsWkbTypes,
+)
+
+from gwat.utils.boundaries import mask_rings
+
+
+def create_writer(path, fields, wkb_type, crs, context):
+    """
+    Create a vector file writer, picking the OGR driver from the extension of ``path``.
+    """
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = QgsVectorFileWriter.driverForExtension(
+        os.path.splitext(path)[1]
+    )
+    writer = QgsVectorFileWriter.create(
+        path, fields, wkb_type, crs, context.transformContext(), options
+    )
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise QgsProcessingException(writer.errorMessage())
+    return writer
+
+
+def merge_keyed(path, parts, key_field, context):
+    """
+    Merge layers sharing one schema into a single layer, tagging every feature with a key.
+
+    :param path: output file
+    :param parts: list of (key value, layer) where layer is a layer or a layer source/id
+    :param key_field: QgsField prepended to the fields of the merged layer
+    :return: ``path``, or None when there was nothing to merge
+    """
+    writer = None
+    for key, layer in parts:
+        if isinstance(layer, str):
+            layer = QgsProcessingUtils.mapLayerFromString(layer, context)
+        if layer is None:
+            continue
+        # The key goes first; the source "fid" would clash between parts
+        names = [f.name() for f in layer.fields() if f.name().lower() != "fid"]
+        if writer is None:
+            fields = QgsFields()
+            fields.append(key_field)
+            for name in names:
+                fields.append(layer.fields().field(name))
+            writer = create_writer(
+                path,
+                fields,
+                QgsWkbTypes.multiType(layer.wkbType()),
+                layer.crs(),
+                context,
+            )
+        for feat in layer.getFeatures():
+            out = QgsFeature(fields)
+            geometry = feat.geometry()
+            geometry.convertToMultiType()
+            out.setGeometry(geometry)
+            out.setAttributes([key] + [feat[name] for name in names])
+            writer.addFeature(out)
+    if writer is None:
+        return None
+    del writer
+    return path
+
+
+def extent_subset(layer, extent, crs, context, feedback=None):
+    """
+    Features of a layer whose bounding box intersects an extent, in a memory layer.
+
+    The filter rectangle is handed to the data provider, so file layers are read through
+    their spatial index and WFS layers request only that BBOX from the server.
+
+    :param extent: QgsRectangle in ``crs``
+    """
+    if crs.isValid() and crs != layer.crs():
+        transform = QgsCoordinateTransform(crs, layer.crs(), context.transformContext())
+        extent = transform.transformBoundingBox(extent)
+    request = QgsFeatureRequest().setFilterRect(extent)
+    return layer.materialize(request, feedback)
+
+
+def mask_geometry(mask, geotransform, row0=0, col0=0):
+    """
+    (Multi)polygon outlining the cells of a boolean mask.
+
+    :param mask: 2D boolean array, a window of the raster starting at (row0, col0)
+    :param geotransform: geotransform of the whole raster
+    :return: a QgsGeometry, empty if the mask is empty
+    """
+
+    def _ring(ring):
+        xs = geotransform[0] + (ring[:, 1] + col0) * geotransform[1]
+        ys = geotransform[3] + (ring[:, 0] + row0) * geotransform[5]
+        return [QgsPointXY(x, y) for x, y in zip(xs.tolist(), ys.tolist())]
+
+    exteriors, holes = [], []
+    for ring, is_exterior in mask_rings(mask):
+        polygon = QgsGeometry.fromPolygonXY([_ring(ring)])
+        (exteriors if is_exterior else holes).append(polygon)
+    if not exteriors:
+        return QgsGeometry()
+
+    # Every hole belongs to the smallest exterior around it. Subtracting all the holes
+    # from the union would also erase the islands lying inside the holes.
+    areas = [exterior.area() for exterior in exteriors]
+    own_holes = [[] for _ in exteriors]
+    for hole in holes:
+        box, area = hole.boundingBox(), hole.area()
+        inside = hole.pointOnSurface()
+        owners = [
+            n
+            for n, exterior in enumerate(exteriors)
+            if areas[n] > area
+            and exterior.boundingBox().contains(box)
+            and exterior.contains(inside)
+        ]
+        if owners:
+            own_holes[min(owners, key=areas.__getitem__)].append(hole)
+    parts = [
+        exterior.difference(QgsGeometry.unaryUnion(inner)) if inner else exterior
+        for exterior, inner in zip(exteriors, own_holes)
+    ]
+    geometry = QgsGeometry.unaryUnion(parts) if len(parts) > 1 else parts[0]
+    if not geometry.isGeosValid():
+        # Outlines pinched where a hole touches the outside at a single corner
+        geometry = geometry.makeValid()
+    geometry.convertToMultiType()
+    return geometry
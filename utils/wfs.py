@@ -1,32 +1,77 @@
-from qgis.core import QgsProject, QgsVectorLayer, Qgis
+from functools import partial
+
+from qgis.core import QgsApplication, QgsProject, QgsTask, QgsVectorLayer, Qgis
 from qgis.gui import Qgis
+from qgis.PyQt.QtCore import QTimer
 
-def add_wfs_layers(iface):
-    # Define the URL of the WFS layer
-    land_cover_url = "http://mapsportal.ypen.gr/geoserver/ows?SERVICE=WFS&VERSION=1.0.0&REQUEST=GetFeature&TYPENAME=geonode:gr_clc2018"
-    soil_url = "http://mapsportal.ypen.gr/geoserver/ows?SERVICE=WFS&VERSION=1.0.0&REQUEST=GetFeature&TYPENAME=geonode:edafmap_1997_7"
-    
-    # Check if layers are already loaded
+from gwat.utils.settings import get_setting
+from gwat.utils.wfs_mirror import WFS_LAYERS, WfsMirror, wfs_uri
+
+DEFAULT_TIMEOUT_S = 120
+
+
+def loaded_wfs_layers():
+    """
+    The Corine and soil layers already in the project, (None, None) if missing.
+    """
     land_cover_layer, soil_layer = None, None
     for layer in QgsProject.instance().mapLayers().values():
-        if layer.name() == "CORINE_LC_2018":
+        if layer.name() == WFS_LAYERS["corine"][0]:
             land_cover_layer = layer
-        elif layer.name() == "SOIL_MAP_1997":
+        elif layer.name() == WFS_LAYERS["soil"][0]:
             soil_layer = layer
-    
+    return land_cover_layer, soil_layer
+
+
+def local_wfs_layers():
+    """
+    Whether the Corine and soil layers can be added without contacting the WFS server.
+    """
+    if all(loaded_wfs_layers()):
+        return True
+    mirror = WfsMirror()
+    return all(mirror.has_layer(name) for name in WFS_LAYERS)
+
+
+def add_wfs_layers(iface, prefetch=None):
+    """
+    Add the Corine and soil layers to the project: the layers already loaded, else their
+    local mirror, else the layers of ``prefetch`` if given, else the WFS layers (loaded
+    here, blocking until the server answers).
+    """
+    # Check if layers are already loaded
+    land_cover_layer, soil_layer = loaded_wfs_layers()
+
     if land_cover_layer and soil_layer:
         iface.messageBar().pushMessage(
             "Info", "WFS Layers already loaded", level=Qgis.Info
         )
         return land_cover_layer, soil_layer
-    
-    # Add the WFS layer to the project
-    land_cover_layer = QgsVectorLayer(land_cover_url, "CORINE_LC_2018", "WFS")
-    soil_layer = QgsVectorLayer(soil_url, "SOIL_MAP_1997", "WFS")
-    
-    if land_cover_layer.isValid() and soil_layer.isValid():
+
+    # Add the local mirror of the layers if there is one, else the WFS layers
+    mirror = WfsMirror()
+    layers = {}
+    for name, (layer_name, typename) in WFS_LAYERS.items():
+        layer = mirror.layer(name)
+        if layer is None and prefetch is not None:
+            layer = prefetch.layers.get(name)
+        elif layer is None:
+            # restrictToRequestBBOX: only the features in the requested extent are downloaded
+            layer = QgsVectorLayer(wfs_uri(typename), layer_name, "WFS")
+        layers[name] = layer
+    land_cover_layer, soil_layer = layers["corine"], layers["soil"]
+
+    if (
+        land_cover_layer is not None
+        and soil_layer is not None
+        and land_cover_layer.isValid()
+        and soil_layer.isValid()
+    ):
         QgsProject.instance().addMapLayer(land_cover_layer)
         QgsProject.instance().addMapLayer(soil_layer)
+        if prefetch is not None:
+            # The project owns the layers now
+            prefetch.layers.clear()
         iface.messageBar().pushMessage(
             "Success", "WFS Layers added successfully", level=Qgis.Info
         )
@@ -35,6 +80,109 @@ def add_wfs_layers(iface):
             "Error", "Failed to load WFS layer", level=Qgis.Critical
         )
         return None, None
-    
+
     return land_cover_layer, soil_layer
-        
+
+
+class WfsLayerTask(QgsTask):
+    """
+    Open a WFS layer (capabilities, layer description and feature count) in the background.
+    """
+
+    def __init__(self, layer_name, uri):
+        super().__init__(f"Loading {layer_name}", QgsTask.CanCancel)
+        self.layer_name = layer_name
+        self.uri = uri
+        self.layer = None
+        self.feature_count = None
+
+    def run(self):
+        layer = QgsVectorLayer(self.uri, self.layer_name, "WFS")
+        if self.isCanceled() or not layer.isValid():
+            return False
+        self.feature_count = layer.featureCount()
+        # Hand the layer over to the main thread, where it is added to the project
+        layer.moveToThread(QgsApplication.instance().thread())
+        self.layer = layer
+        return True
+
+
+class WfsPrefetch:
+    """
+    Concurrent background loading of the Corine and soil WFS layers.
+
+    The layers are opened in QGIS tasks, so the GUI stays responsive while the server
+    answers. Callbacks registered with `when_done` run on the main thread once every layer
+    is loaded, has failed or has timed out (``wfs_timeout_s`` setting).
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or get_setting("wfs_timeout_s") or DEFAULT_TIMEOUT_S
+        self.tasks = {}
+        self.layers = {}
+        self.failed = set()
+        self.callbacks = []
+        self.started = 0
+
+    def start(self):
+        """
+        Start loading the layers that are neither loaded nor loading.
+        """
+        self.failed.clear()
+        for name, (layer_name, typename) in WFS_LAYERS.items():
+            if name in self.layers or name in self.tasks:
+                continue
+            task = WfsLayerTask(layer_name, wfs_uri(typename))
+            task.taskCompleted.connect(partial(self._completed, name, task))
+            task.taskTerminated.connect(partial(self._failed, name, task))
+            self.tasks[name] = task
+            QgsApplication.taskManager().addTask(task)
+        if self.tasks:
+            self.started += 1
+            QTimer.singleShot(
+                int(self.timeout * 1000), partial(self._timed_out, self.started)
+            )
+
+    def done(self):
+        return not self.tasks
+
+    def ready(self):
+        return all(name in self.layers for name in WFS_LAYERS)
+
+    def when_done(self, callback):
+        if self.done():
+            callback()
+        else:
+            self.callbacks.append(callback)
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+        self.callbacks.clear()
+
+    def _completed(self, name, task):
+        if self.tasks.get(name) is task:
+            del self.tasks[name]
+            self.layers[name] = task.layer
+            self._notify()
+
+    def _failed(self, name, task):
+        if self.tasks.get(name) is task:
+            del self.tasks[name]
+            self.failed.add(name)
+            self._notify()
+
+    def _timed_out(self, started):
+        if started != self.started:
+            # Timer of an earlier start: the layers have been requested again since
+            return
+        for name, task in list(self.tasks.items()):
+            task.cancel()
+            self._failed(name, task)
+
+    def _notify(self):
+        if self.done():
+            callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                callback()
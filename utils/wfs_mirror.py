@@ -0,0 +1,334 @@
+"""
+Local mirror of the Corine and soil WFS layers.
+
+The layers are downloaded tile by tile, with BBOX requests, into one GeoPackage whose
+tables carry an R-tree spatial index. Every feature is stored once, in the tile holding
+the centre of its bounding box. The digest and version of every tile are kept in a JSON
+file next to the GeoPackage, so a refresh only rewrites the tiles whose content changed
+on the server, along with the tiles checked so far. A feature crossing into an extent may
+be stored in a tile outside it, so the mirror only stands in for the WFS layers once the
+whole layer has been synced.
+"""
+
+import hashlib
+import json
+import math
+import os
+import time
+
+from qgis.core import (
+    QgsDataSourceUri,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsField,
+    QgsFields,
+    QgsProcessingException,
+    QgsRectangle,
+    QgsVectorFileWriter,
+    QgsVectorLayer,
+    QgsWkbTypes,
+)
+from qgis.PyQt.QtCore import QVariant
+
+from gwat.utils.files import get_plugin_output_dir, get_or_create_path
+from gwat.utils.settings import get_setting
+
+MIRROR_DIRNAME = "wfs_mirror"
+MIRROR_FILE = "wfs_mirror.gpkg"
+METADATA_FILE = "wfs_mirror.json"
+TILE_FIELD = "mirror_tile"
+DEFAULT_TILE_SIZE = 20000
+WFS_URL = "http://mapsportal.ypen.gr/geoserver/ows"
+
+# Mirrored layers: table name -> (layer name in the project, WFS type name)
+WFS_LAYERS = {
+    "corine": ("CORINE_LC_2018", "geonode:gr_clc2018"),
+    "soil": ("SOIL_MAP_1997", "geonode:edafmap_1997_7"),
+}
+
+
+def wfs_uri(typename, url=WFS_URL):
+    """
+    WFS data source of a layer, requesting only the features of the requested extent.
+    """
+    return (
+        "pagingEnabled='true' preferCoordinatesForWfsT11='false' "
+        f"restrictToRequestBBOX='1' srsname='EPSG:2100' typename='{typename}' "
+        f"url='{url}' version='1.0.0'"
+    )
+
+
+def _feature_digest(feature):
+    digest = hashlib.sha256(bytes(feature.geometry().asWkb()))
+    digest.update(repr(feature.attributes()).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class WfsMirror:
+    """
+    GeoPackage copy of the WFS layers, partitioned into square tiles.
+    """
+
+    def __init__(self, root=None, tile_size=None):
+        self.root = get_or_create_path(
+            root or os.path.join(get_plugin_output_dir(), MIRROR_DIRNAME)
+        )
+        self.path = os.path.join(self.root, MIRROR_FILE)
+        self.tile_size = (
+            tile_size or get_setting("wfs_mirror_tile_size") or DEFAULT_TILE_SIZE
+        )
+        self.metadata = self._read_metadata()
+
+    # Layers
+
+    def has_layer(self, name):
+        """
+        Whether the layer ``name`` is mirrored in full.
+        """
+        return self.covers(name)
+
+    def covers(self, name):
+        """
+        Whether the mirror holds every feature of the layer ``name``, i.e. the whole
+        layer was synced. A mirror of some extents does not: a feature intersecting them
+        is missing when the centre of its bounding box lies in a tile never synced.
+        """
+        meta = self.metadata["layers"].get(name)
+        return (
+            meta is not None
+            and bool(meta.get("complete"))
+            and os.path.exists(self.path)
+        )
+
+    def layer(self, name):
+        """
+        The mirrored layer ``name`` (a key of WFS_LAYERS), None if not mirrored in full.
+        """
+        if not self.has_layer(name):
+            return None
+        return self._open(name)
+
+    def substitute(self, layer):
+        """
+        For a WFS layer, or its mirrored layer: the mirror if the whole layer is mirrored,
+        else the WFS layer. Other layers are returned as they are.
+        """
+        name = self._mirrored_name(layer)
+        if name is None:
+            return layer
+        if self.covers(name):
+            mirrored = self._open(name)
+            if mirrored is not None:
+                return mirrored
+        if layer.providerType() == "WFS":
+            return layer
+        remote = QgsVectorLayer(
+            wfs_uri(WFS_LAYERS[name][1]), WFS_LAYERS[name][0], "WFS"
+        )
+        if not remote.isValid():
+            raise QgsProcessingException(
+                f"The local mirror of {WFS_LAYERS[name][0]} is incomplete and the "
+                "WFS server could not be reached"
+            )
+        return remote
+
+    def _open(self, name):
+        layer = QgsVectorLayer(
+            f"{self.path}|layername={name}", WFS_LAYERS[name][0], "ogr"
+        )
+        return layer if layer.isValid() else None
+
+    def _mirrored_name(self, layer):
+        """
+        The key of WFS_LAYERS of a WFS layer or of a layer of the mirror, else None.
+        """
+        if layer is None:
+            return None
+        if layer.providerType() == "WFS":
+            typename = QgsDataSourceUri(layer.source()).param("typename")
+            for name, (_, mirrored_typename) in WFS_LAYERS.items():
+                if typename == mirrored_typename:
+                    return name
+            return None
+        path, _, options = layer.source().partition("|")
+        if os.path.normcase(os.path.abspath(path)) != os.path.normcase(self.path):
+            return None
+        for option in options.split("|"):
+            key, _, value = option.partition("=")
+            if key == "layername" and value in WFS_LAYERS:
+                return value
+        return None
+
+    # Synchronization
+
+    def tile_of(self, point):
+        return (
+            f"{math.floor(point.x() / self.tile_size)}_"
+            f"{math.floor(point.y() / self.tile_size)}"
+        )
+
+    def tiles(self, extent):
+        """
+        Tiles covering an extent, as (tile id, rectangle). Extents of zero width or
+        height, or ending on a tile border, include the tile of their far border.
+        """
+        size = self.tile_size
+        for i in range(
+            math.floor(extent.xMinimum() / size),
+            math.floor(extent.xMaximum() / size) + 1,
+        ):
+            for j in range(
+                math.floor(extent.yMinimum() / size),
+                math.floor(extent.yMaximum() / size) + 1,
+            ):
+                yield f"{i}_{j}", QgsRectangle(
+                    i * size, j * size, (i + 1) * size, (j + 1) * size
+                )
+
+    def sync(self, name, url=WFS_URL, extent=None, rebuild=False, feedback=None):
+        """
+        Download the tiles of a layer that changed on the server since the last sync.
+
+        :param extent: only sync the tiles intersecting this extent (layer CRS), to
+            refresh part of a complete mirror; a new mirror stands in for the WFS layer
+            only once synced without extent
+        :param rebuild: drop the mirrored layer and download it again
+        :return: (number of tiles checked, number of tiles rewritten)
+        """
+        remote = QgsVectorLayer(wfs_uri(WFS_LAYERS[name][1], url), name, "WFS")
+        if not remote.isValid():
+            raise QgsProcessingException(f"Could not connect to the WFS layer {name}")
+
+        if not os.path.exists(self.path):
+            self.metadata = {"layers": {}}
+        meta = self.metadata["layers"].get(name)
+        if rebuild or meta is None or meta["tile_size"] != self.tile_size:
+            self._create_table(name, remote)
+            meta = {
+                "typename": WFS_LAYERS[name][1],
+                "crs": remote.crs().authid(),
+                "tile_size": self.tile_size,
+                "version": 0,
+                "synced": None,
+                # Every feature of the layer is mirrored
+                "complete": False,
+                # Tiles checked against the server, with features or not
+                "covered": [],
+                "tiles": {},
+            }
+            self.metadata["layers"][name] = meta
+            self._write_metadata()
+
+        local = QgsVectorLayer(f"{self.path}|layername={name}", name, "ogr")
+        provider = local.dataProvider()
+        local_fields = local.fields()
+        mapping = [local_fields.indexOf(f.name()) for f in remote.fields()]
+        tile_index = local_fields.indexOf(TILE_FIELD)
+
+        tiles = list(self.tiles(extent or remote.extent()))
+        covered = set(meta.setdefault("covered", []))
+        changed = 0
+        canceled = False
+        for n, (tile, rect) in enumerate(tiles):
+            if feedback is not None:
+                if feedback.isCanceled():
+                    canceled = True
+                    break
+                feedback.setProgress(100 * n / len(tiles))
+
+            features = [
+                f
+                for f in remote.getFeatures(QgsFeatureRequest().setFilterRect(rect))
+                if self.tile_of(f.geometry().boundingBox().center()) == tile
+            ]
+            digest = hashlib.sha256(
+                "".join(sorted(_feature_digest(f) for f in features)).encode("utf-8")
+            ).hexdigest()
+            covered.add(tile)
+            meta["covered"] = sorted(covered)
+            known = meta["tiles"].get(tile)
+            if known is not None and known["digest"] == digest:
+                continue
+            if known is None and not features:
+                continue
+
+            # Replace the tile
+            request = (
+                QgsFeatureRequest()
+                .setFilterExpression(f"\"{TILE_FIELD}\" = '{tile}'")
+                .setFlags(QgsFeatureRequest.NoGeometry)
+            )
+            provider.deleteFeatures([f.id() for f in local.getFeatures(request)])
+            out_features = []
+            for f in features:
+                out = QgsFeature(local_fields)
+                geometry = f.geometry()
+                geometry.convertToMultiType()
+                out.setGeometry(geometry)
+                for i, value in zip(mapping, f.attributes()):
+                    out.setAttribute(i, value)
+                out.setAttribute(tile_index, tile)
+                out_features.append(out)
+            provider.addFeatures(out_features)
+
+            meta["tiles"][tile] = {
+                "digest": digest,
+                "features": len(features),
+                "version": (known["version"] + 1) if known else 1,
+                "synced": time.time(),
+            }
+            changed += 1
+            # Saved per tile, so an interrupted sync resumes where it stopped
+            self._write_metadata()
+
+        if changed:
+            meta["version"] += 1
+        if extent is None and not canceled:
+            meta["complete"] = True
+        meta["synced"] = time.time()
+        self._write_metadata()
+        return len(tiles), changed
+
+    def _create_table(self, name, remote):
+        fields = QgsFields()
+        for field in remote.fields():
+            fields.append(field)
+        fields.append(QgsField(TILE_FIELD, QVariant.String))
+
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = "GPKG"
+        options.layerName = name
+        options.layerOptions = ["SPATIAL_INDEX=YES"]
+        options.actionOnExistingFile = (
+            QgsVectorFileWriter.CreateOrOverwriteLayer
+            if os.path.exists(self.path)
+            else QgsVectorFileWriter.CreateOrOverwriteFile
+        )
+        writer = QgsVectorFileWriter.create(
+            self.path,
+            fields,
+            QgsWkbTypes.multiType(remote.wkbType()),
+            remote.crs(),
+            remote.transformContext(),
+            options,
+        )
+        if writer.hasError() != QgsVectorFileWriter.NoError:
+            raise QgsProcessingException(
+                f"Could not create {self.path}: {writer.errorMessage()}"
+            )
+        del writer
+
+    # Metadata
+
+    def _read_metadata(self):
+        try:
+            with open(
+                os.path.join(self.root, METADATA_FILE), "r", encoding="utf-8"
+            ) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"layers": {}}
+
+    def _write_metadata(self):
+        with open(os.path.join(self.root, METADATA_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.metadata, f, indent=2)
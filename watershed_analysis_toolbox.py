@@ -23,6 +23,7 @@ __revision__ = "$Format:%H$"
 import os
 import sys
 import inspect
+from functools import partial
 
 from qgis.core import QgsApplication
 
@@ -38,7 +39,7 @@ from qgis.core import QgsApplication
 import processing
 
 from .processing_provider import WATProcessingProvider
-from .utils.wfs import add_wfs_layers
+from .utils.wfs import WfsPrefetch, add_wfs_layers, local_wfs_layers
 
 
 class WatershedAnalysisToolbox(object):
@@ -48,6 +49,8 @@ class WatershedAnalysisToolbox(object):
         self.settingsDialog = None
         self.PPointDialog = None
         self.provider = WATProcessingProvider()
+        self.wfsPrefetch = WfsPrefetch()
+        self.step2Dialog = None
 
     def initGui(self):
 
@@ -109,16 +112,37 @@ class WatershedAnalysisToolbox(object):
 
         QgsApplication.processingRegistry().addProvider(self.provider)
 
+        # Start loading the WFS layers of Step 2 in the background, unless Step 2 can
+        # use a local mirror of them
+        if not local_wfs_layers():
+            self.wfsPrefetch.start()
+
     def openStep1(self):
         processing.execAlgorithmDialog("gwat:step_1", {})
 
     def openStep2(self):
         # Add Corine & SCS layers
-        land_cover_layer, soil_layer = add_wfs_layers(self.iface)
-        if land_cover_layer and soil_layer:
-            processing.execAlgorithmDialog(
-                "gwat:step_2",
-                {"SOIL_LAYER": soil_layer, "LAND_COVER_LAYER": land_cover_layer},
+        if local_wfs_layers() or self.wfsPrefetch.ready():
+            land_cover_layer, soil_layer = add_wfs_layers(self.iface, self.wfsPrefetch)
+            if land_cover_layer and soil_layer:
+                processing.execAlgorithmDialog(
+                    "gwat:step_2",
+                    {"SOIL_LAYER": soil_layer, "LAND_COVER_LAYER": land_cover_layer},
+                )
+            return
+
+        # The WFS layers are still loading (or failed before: retry): open the dialog
+        # now and fill in the layers once they are loaded
+        self.wfsPrefetch.start()
+        self.step2Dialog = processing.createAlgorithmDialog("gwat:step_2", {})
+        self.step2Dialog.show()
+        self.wfsPrefetch.when_done(partial(self.bindWfsLayers, self.step2Dialog))
+
+    def bindWfsLayers(self, dialog):
+        land_cover_layer, soil_layer = add_wfs_layers(self.iface, self.wfsPrefetch)
+        if land_cover_layer and soil_layer and dialog.isVisible():
+            dialog.mainWidget().setParameters(
+                {"SOIL_LAYER": soil_layer, "LAND_COVER_LAYER": land_cover_layer}
             )
 
     def openStep3(self):
@@ -142,6 +166,7 @@ class WatershedAnalysisToolbox(object):
         self.PPointDialog.show()
 
     def unload(self):
+        self.wfsPrefetch.cancel()
         try:
             self.iface.removeToolBarIcon(self.step1)
             self.iface.removeToolBarIcon(self.step2)